@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Measures the cost of matching 404 paths against 1,000 and 10,000 redirect patterns.
+
+    Usage: python benchmarks/redirect_patterns.py
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+settings.configure()
+
+import django
+
+django.setup()
+
+from djangoseo.redirects import PatternMatcher
+
+
+SIZES = (1000, 10000)
+PATHS = 200
+
+
+def build_patterns(size):
+    patterns = []
+    for i in range(size):
+        if i % 2:
+            url_pattern = r'/catalog/section-%d/(\d+)/' % i
+        else:
+            url_pattern = r'/news/%d/(?:[\w-]+)/' % i
+        patterns.append({'url_pattern': url_pattern, 'redirect_path': '/target-%d/' % i})
+    return patterns
+
+
+def loop_match(patterns, path):
+    """ Matches the patterns one after another, as handle_seo_redirects used to. """
+    for pattern in patterns:
+        if re.match(pattern['url_pattern'], path):
+            return pattern
+
+
+def compiled_match(compiled, path):
+    """ Matches patterns compiled in advance one after another. """
+    for regex, pattern in compiled:
+        if regex.match(path):
+            return pattern
+
+
+def main():
+    rng = random.Random(0)
+    for size in SIZES:
+        patterns = build_patterns(size)
+        paths = []
+        for _ in range(PATHS // 2):
+            i = rng.randrange(size)
+            paths.append('/catalog/section-%d/42/' % i if i % 2 else '/news/%d/some-slug/' % i)
+            paths.append('/wp-login.php?x=%d' % rng.randrange(10 ** 6))
+
+        build = timeit.timeit(lambda: PatternMatcher(patterns), number=3) / 3
+        matcher = PatternMatcher(patterns)
+        assert all(combined for regex, index, combined in matcher.chunks)
+        compiled = [(re.compile(pattern['url_pattern']), pattern) for pattern in patterns]
+        for p in paths[:10]:
+            assert loop_match(patterns, p) is matcher.match(p), p
+
+        print('%d patterns, compiling the matcher: %.1f ms' % (size, build * 1e3))
+        # The loop compiles most patterns again for every path, a few paths are enough to time it
+        for name, func, count in (('loop', lambda p: loop_match(patterns, p), 10),
+                                  ('precompiled', lambda p: compiled_match(compiled, p), len(paths)),
+                                  ('combined', matcher.match, len(paths))):
+            duration = timeit.timeit(lambda: [func(p) for p in paths[:count]], number=1)
+            print('  %-12s %10.2f us per path' % (name, duration / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Measures the cost of resolving paths to view names on a urlconf with 2,000 patterns.
+
+    Usage: python benchmarks/resolve_to_name.py
+"""
+import os
+import random
+import sys
+import timeit
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+settings.configure(ROOT_URLCONF='benchmark_urls')
+
+import django
+
+django.setup()
+
+from django.urls import get_resolver, include, path, re_path
+
+from djangoseo.utils import ViewNameIndex, _pattern_name, _pattern_regex
+
+
+SECTIONS = 40
+PATTERNS_PER_SECTION = 50
+NUMBER = 2000
+
+
+def view(request, *args, **kwargs):
+    pass
+
+
+def build_urlconf():
+    """ 40 included sections of 25 regex and 25 route patterns each """
+    sections = []
+    for i in range(SECTIONS):
+        patterns = []
+        for j in range(PATTERNS_PER_SECTION // 2):
+            patterns.append(re_path(r'^item-%d/(?P<slug>[\w-]+)/$' % j, view, name='s%d_item_%d' % (i, j)))
+            patterns.append(path('page-%d/<int:pk>/' % j, view, name='s%d_page_%d' % (i, j)))
+        sections.append(path('section-%d/' % i, include(patterns)))
+    module = types.ModuleType('benchmark_urls')
+    module.urlpatterns = sections
+    sys.modules['benchmark_urls'] = module
+
+
+def walk_resolve_to_name(resolver, path):
+    """ Walks the resolver tree, as resolve_to_name used to. """
+    match = _pattern_regex(resolver).search(path)
+    if match:
+        new_path = path[match.end():]
+        for pattern in resolver.url_patterns:
+            if hasattr(pattern, 'url_patterns'):
+                name = walk_resolve_to_name(pattern, new_path)
+            elif _pattern_regex(pattern).search(new_path):
+                name = _pattern_name(pattern)
+            else:
+                name = None
+            if name:
+                return name
+
+
+def main():
+    build_urlconf()
+    resolver = get_resolver()
+    rng = random.Random(0)
+    paths = []
+    for _ in range(200):
+        i, j = rng.randrange(SECTIONS), rng.randrange(PATTERNS_PER_SECTION // 2)
+        paths.append(rng.choice(['/section-%d/item-%d/some-slug/' % (i, j), '/section-%d/page-%d/42/' % (i, j)]))
+    paths.append('/not/found/')
+
+    index = ViewNameIndex(resolver)
+    uncached = ViewNameIndex(resolver, cache_size=0)
+    for p in paths:
+        assert walk_resolve_to_name(resolver, p) == index.resolve(p) == uncached.resolve(p), p
+
+    results = [
+        ('tree walk', lambda: [walk_resolve_to_name(resolver, p) for p in paths]),
+        ('index', lambda: [uncached.resolve(p) for p in paths]),
+        ('index + LRU', lambda: [index.resolve(p) for p in paths]),
+    ]
+    build = timeit.timeit(lambda: ViewNameIndex(resolver), number=20) / 20
+    print('building the index: %.2f ms' % (build * 1e3))
+    for name, func in results:
+        duration = timeit.timeit(func, number=NUMBER // len(paths) or 1) / (NUMBER // len(paths) or 1)
+        print('%-12s %8.2f us per path' % (name, duration / len(paths) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,6 +32,22 @@ def get_path_admin(use_site=False, use_subdomains=False):
     })
 
 
+def get_path_prefix_admin(use_site=False, use_subdomains=False):
+    list_display = ['_prefix']
+    search_fields = ['_prefix']
+    list_filter = []
+    if use_site:
+        list_display.append('_site')
+        list_filter.append('_site')
+    if use_subdomains:
+        list_display.append('_subdomain')
+    return type('PathPrefixMetadataAdmin', (admin.ModelAdmin, ), {
+        'list_display': tuple(list_display),
+        'list_filter': tuple(list_filter),
+        'search_fields': tuple(search_fields)
+    })
+
+
 def get_model_instance_admin(use_site=False, use_subdomains=False):
     list_display = ['_content_type', '_object_id', '_path']
     search_fields = ['_path', '_content_type__name']
@@ -86,6 +102,7 @@ def register_seo_admin(admin_site, metadata_class, filter_list=None):
     use_subdomains = metadata_class._meta.use_subdomains
 
     path_admin = get_path_admin(use_sites, use_subdomains)
+    path_prefix_admin = get_path_prefix_admin(use_sites, use_subdomains)
     model_instance_admin = get_model_instance_admin(use_sites, use_subdomains)
     model_admin = get_model_admin(use_sites, use_subdomains)
     view_admin = get_view_admin(use_sites, use_subdomains)
@@ -123,6 +140,15 @@ def register_seo_admin(admin_site, metadata_class, filter_list=None):
 
         _register_admin(admin_site, metadata_class._meta.get_model('path'), PathAdmin)
 
+    if 'pathprefix' in backends:
+        class PathPrefixAdmin(path_prefix_admin):
+            form = get_path_prefix_form(metadata_class)
+            list_display = path_prefix_admin.list_display + get_list_display()
+            if filter_list:  # Cannot give the filter_list variable name 'list_filter', because there is a name conflict
+                list_filter = filter_list
+
+        _register_admin(admin_site, metadata_class._meta.get_model('pathprefix'), PathPrefixAdmin)
+
     if 'modelinstance' in backends:
         class ModelInstanceAdmin(model_instance_admin):
             form = get_modelinstance_form(metadata_class)
@@ -249,6 +275,22 @@ def get_path_form(metadata_class):
     return ModelMetadataForm
 
 
+def get_path_prefix_form(metadata_class):
+    model_class = metadata_class._meta.get_model('pathprefix')
+
+    # Get a list of fields, with _prefix at the start
+    important_fields = ['_prefix'] + core_choice_fields(metadata_class)
+    _fields = important_fields + list(fields_for_model(model_class,
+                                                  exclude=important_fields).keys())
+
+    class ModelMetadataForm(forms.ModelForm):
+        class Meta:
+            model = model_class
+            fields = _fields
+
+    return ModelMetadataForm
+
+
 def get_view_form(metadata_class):
     model_class = metadata_class._meta.get_model('view')
 
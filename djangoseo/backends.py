@@ -1,23 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
+import copy
+import hashlib
+import json
+import threading
 import six
 from collections import OrderedDict
+from functools import lru_cache
 
 from django.utils.translation import ugettext_lazy as _
 from django.db.utils import IntegrityError
 from django.conf import settings
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F, Func, Value, Subquery, IntegerField, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.template import Template, Context
+from django.utils.safestring import SafeData, mark_safe
 
-from djangoseo.utils import resolve_to_name, NotSet, Literal
+from djangoseo.utils import resolve_to_name, path_hash, NotSet, Literal, RenderedValue, PrefixTrie
+from djangoseo.cache import LocalCache, MetadataCache, global_scope, path_scope, content_type_scope, backend_scope
+from djangoseo.cache import site_scope
 
 RESERVED_FIELD_NAMES = ('_metadata', '_path', '_content_type', '_object_id',
                         '_content_object', '_view', '_site', 'objects',
-                        '_resolve_value', '_set_context', 'id', 'pk')
+                        '_resolve_value', '_set_context', '_loaded_path',
+                        '_get_cache_scopes', '_set_content_object', '_rendered',
+                        '_get_rendered', '_path_hash', '_prefix', '_matched_path',
+                        '_backend', 'id', 'pk')
 
 backend_registry = OrderedDict()
 
@@ -34,6 +46,69 @@ class MetadataBaseModel(models.Model):
         # TODO Rename to __metadata
         self._metadata = self.__class__._metadata()
 
+        # Remember the stored path, so that cache entries for the old path
+        # can be invalidated when the path changes.
+        self._loaded_path = self.__dict__.get('_path')
+
+    def _get_cache_scopes(self):
+        """ Returns the cache scopes that are affected by changes to this instance. """
+        return [global_scope(self._metadata._meta.name)]
+
+    def save(self, *args, **kwargs):
+        if self._metadata._meta.use_path_hash and hasattr(self, '_path_hash'):
+            self._path_hash = path_hash(self._path)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and '_path' in update_fields and '_path_hash' not in update_fields:
+                kwargs['update_fields'] = list(update_fields) + ['_path_hash']
+        if self._metadata._meta.store_rendered:
+            self._rendered = json.dumps(self._render_values())
+            self.__dict__.pop('_MetadataBaseModel__rendered_values', None)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and '_rendered' not in update_fields:
+                kwargs['update_fields'] = list(update_fields) + ['_rendered']
+        super(MetadataBaseModel, self).save(*args, **kwargs)
+
+    def _render_values(self):
+        """ Cleans and renders the explicit values of this instance, so that this
+            does not need to be done again whenever they are displayed.
+            Templated values depend on the context, they are left out.
+        """
+        rendered = {}
+        for name, element in self._metadata._meta.elements.items():
+            value = getattr(self, name) if element.editable else None
+            if not value or not isinstance(value, six.string_types) or '{' in value:
+                continue
+            cleaned = element.clean(value)
+            rendered[name] = {
+                'raw': value,
+                'value': cleaned,
+                'safe': isinstance(cleaned, SafeData),
+                'html': element.render(cleaned) if cleaned else '',
+            }
+        return rendered
+
+    def _get_rendered(self, name):
+        """ Returns the stored rendering of the value for the given name,
+            or None if the value has to be resolved and rendered.
+        """
+        try:
+            rendered = self.__rendered_values
+        except AttributeError:
+            rendered = self.__rendered_values = json.loads(self._rendered or '{}')
+        stored = rendered.get(name)
+        # Ignore renderings that are out of date, eg when the instance was changed but not saved
+        if stored is None or stored['raw'] != getattr(self, name, None):
+            return None
+        value = mark_safe(stored['value']) if stored['safe'] else stored['value']
+        return RenderedValue(value, stored['html'])
+
+    def _get_path_cache_scopes(self):
+        name = self._metadata._meta.name
+        scopes = [path_scope(name, self._path)]
+        if self._loaded_path is not None and self._loaded_path != self._path:
+            scopes.append(path_scope(name, self._loaded_path))
+        return scopes
+
     # TODO Rename to __resolve_value?
     def _resolve_value(self, name):
         """ Returns an appropriate value for the given name. """
@@ -80,21 +155,86 @@ class MetadataBaseModel(models.Model):
                 context = Context()
             if model_instance is not None:
                 context[model_instance._meta.model_name] = model_instance
-            value = Template(value).render(context)
+            value = get_template(value).render(context)
         return value
 
 
+@lru_cache(maxsize=getattr(settings, 'SEO_TEMPLATE_CACHE_SIZE', 512))
+def get_template(source):
+    """ Returns the compiled template for the given source, which is only parsed
+        the first time it is seen. Statistics are available from get_template.cache_info().
+    """
+    return Template(source)
+
+
+# Site ids by domain, along with the generation of the sites they were loaded at
+_site_ids = {}
+site_cache = MetadataCache(LocalCache(10, 5))
+
+
+def get_site_id(domain):
+    """ Returns the id of the site with the given domain, without a query once it is known.
+        Known ids are loaded again once a site has changed, in this or any other process.
+    """
+    generation = site_cache.get_generations([site_scope()])[0]
+    try:
+        site_generation, site_id = _site_ids[domain]
+        if site_generation == generation:
+            return site_id
+    except KeyError:
+        pass
+    site_id = Site.objects.get(domain=domain).id
+    _site_ids[domain] = (generation, site_id)
+    return site_id
+
+
+def resolve_site_id(site=None):
+    """ Returns the id of the given site, which may also be given by its domain.
+        The current site is used if no site is given.
+    """
+    if isinstance(site, Site):
+        return site.id
+    elif site is not None:
+        return site and get_site_id(site)
+    return settings.SITE_ID
+
+
+def clear_site_ids(sender, **kwargs):
+    _site_ids.clear()
+    site_cache.bump_generations_on_commit([site_scope()], kwargs.get('using'))
+
+
+models.signals.post_save.connect(clear_site_ids, sender=Site)
+models.signals.post_delete.connect(clear_site_ids, sender=Site)
+
+
+class SiteKey(Func):
+    """ The site of an instance, or 0 for instances that apply to all sites.
+        Both the site and all sites can then be found with an IN lookup, which
+        unlike "_site_id = X OR _site_id IS NULL" probes the index on this expression.
+        The 0 is part of the SQL rather than a parameter, so that the expression
+        in a query is the same as in the index.
+    """
+    template = 'COALESCE(%(expressions)s, 0)'
+    output_field = IntegerField()
+
+
+class ContentObjectForeignKey(GenericForeignKey):
+    """ A generic foreign key whose prefetching only caches the objects found.
+        GenericForeignKey assigns None to instances whose object no longer exists, which
+        also clears their content type and object id, and the metadata then cannot be rendered.
+    """
+    def get_prefetch_queryset(self, instances, queryset=None):
+        prefetch = super(ContentObjectForeignKey, self).get_prefetch_queryset(instances, queryset)
+        # Not a descriptor, so that the objects are put in the cache rather than assigned
+        return prefetch[:-1] + (False,)
+
+
 class BaseManager(models.Manager):
     def on_current_site(self, site=None):
-        if isinstance(site, Site):
-            site_id = site.id
-        elif site is not None:
-            site_id = site and Site.objects.get(domain=site).id
-        else:
-            site_id = settings.SITE_ID
+        site_id = resolve_site_id(site)
         # Exclude entries for other sites
-        where = ['_site_id IS NULL OR _site_id=%s']
-        return self.get_queryset().extra(where=where, params=[site_id])
+        return self.get_queryset().alias(_site_key=SiteKey('_site')).filter(_site_key__in=[site_id, 0])
 
     def by_params(self, site=None, language=None, subdomain=None):
         queryset = self.on_current_site(site)
@@ -148,11 +288,18 @@ class MetadataBackend(object):
     name = None
     verbose_name = None
     unique_together = None
+    # Fields used by get_instances to find the instances of a path
+    lookup_fields = None
+    # Whether the backend keeps its instances in memory, rather than querying the database
+    in_memory = False
 
     def get_unique_together(self, options):
         ut = []
         for ut_set in self.unique_together:
             ut_set = [a for a in ut_set]
+            if options.use_path_hash and '_path' in ut_set:
+                # The hash comes first for lookups, the path keeps paths with the same hash apart
+                ut_set.insert(ut_set.index('_path'), '_path_hash')
             if options.use_sites:
                 ut_set.append('_site')
             if options.use_i18n:
@@ -162,13 +309,43 @@ class MetadataBackend(object):
             ut.append(tuple(ut_set))
         return tuple(ut)
 
+    def get_indexes(self, options):
+        """ Returns an index matching the lookups of get_instances: the lookup fields and
+            language are compared for equality, the site is either matched or null, and
+            instances for a single subdomain are sorted before those for all subdomains.
+            Without sites, languages or subdomains, the unique index already serves this.
+        """
+        if not (options.use_sites or options.use_i18n or options.use_subdomains):
+            return []
+        fields = list(self.lookup_fields)
+        if options.use_path_hash and '_path' in fields:
+            fields[fields.index('_path')] = '_path_hash'
+        if options.use_i18n:
+            fields.append('_language')
+        subdomain_fields = ['_all_subdomains', '_subdomain'] if options.use_subdomains else []
+        if not options.use_sites:
+            return [models.Index(fields=fields + subdomain_fields)]
+        # The site is looked up as SiteKey, which needs an index on the expression
+        expressions = [F(name) for name in fields] + [SiteKey('_site')] + [F(name) for name in subdomain_fields]
+        name = 'seo_%s' % hashlib.md5(('%s.%s' % (options.name, self.name)).encode('utf-8')).hexdigest()[:20]
+        return [models.Index(*expressions, name=name)]
+
     def get_manager(self, options):
-        _get_instances = self.get_instances
+        backend = self
 
         class _Manager(BaseManager):
             def get_instances(self, path, site=None, language=None, context=None, subdomain=None):
                 queryset = self.by_params(site, language, subdomain)
-                return _get_instances(queryset, path, context)
+                return backend.get_instances(queryset, path, context)
+
+            def get_many_instances(self, paths, site=None, language=None, contexts=None, subdomain=None):
+                queryset = self.by_params(site, language, subdomain)
+                return backend.get_many_instances(queryset, paths, contexts)
+
+            def get_combined_instances(self, path, site=None, language=None, context=None, subdomain=None,
+                                       querysets=None):
+                queryset = self.by_params(site, language, subdomain)
+                return backend.get_combined_instances(queryset, path, context, querysets or {})
 
             if not options.use_sites:
                 def by_params(self, site=None, language=None, subdomain=None):
@@ -182,6 +359,29 @@ class MetadataBackend(object):
                     return queryset
         return _Manager
 
+    def get_combined_instances(self, queryset, path, context, querysets):
+        """ Returns the queryset used for this backend in a combined lookup.
+            The querysets of the preceding backends (by backend name) have not been
+            evaluated at this point, so they can only be used in subqueries.
+        """
+        return self.get_instances(queryset, path, context)
+
+    def get_many_instances(self, queryset, paths, contexts):
+        """ Returns a dict with the list of instances for each of the given paths.
+            contexts holds the context of each path, as filled in by the preceding backends.
+            Backends should override this to use a single query for all paths.
+        """
+        return dict((path, list(self.get_instances(queryset, path, contexts[path]) or [])) for path in paths)
+
+    def get_lookup_key(self, path, context):
+        """ Returns the value of the first lookup field that get_instances would look for,
+            or None if no instances can match. Used to find instances that are already in memory.
+        """
+        return path
+
+    def register(self, model, options):
+        """ Called with the model built from this backend for a metadata definition.
+        """
 
     @staticmethod
     def validate(options):
@@ -189,21 +389,116 @@ class MetadataBackend(object):
         """
 
 
+def filter_paths(queryset, paths):
+    """ Filters the given queryset on the given paths. If the paths are hashed,
+        the hash is looked up in the index, and the paths only resolve any collisions.
+    """
+    if queryset.model._metadata._meta.use_path_hash:
+        hashes = [path_hash(path) for path in paths]
+        if len(paths) == 1:
+            return queryset.filter(_path_hash=hashes[0], _path=paths[0])
+        return queryset.filter(_path_hash__in=hashes, _path__in=paths)
+    if len(paths) == 1:
+        return queryset.filter(_path=paths[0])
+    return queryset.filter(_path__in=paths)
+
+
+def filter_instances(instances, options, site=None, language=None, subdomain=None):
+    """ Filters instances that are already in memory like by_params would filter a queryset. """
+    site_id = resolve_site_id(site) if options.use_sites else None
+    matching = [
+        instance for instance in instances
+        if (not options.use_sites or instance._site_id in (site_id, None))
+        and (not options.use_i18n or not language or instance._language == language)
+        and (not options.use_subdomains or subdomain is None
+             or instance._subdomain == subdomain or instance._all_subdomains)
+    ]
+    if options.use_subdomains and subdomain is not None:
+        matching.sort(key=lambda instance: instance._all_subdomains)
+    return matching
+
+
+def group_instances(instances, attname):
+    """ Groups the given instances by the value of the given attribute, keeping their order. """
+    groups = {}
+    for instance in instances:
+        groups.setdefault(getattr(instance, attname), []).append(instance)
+    return groups
+
+
+def get_view_object(context):
+    """ Returns the object of the view being rendered, if there is one. """
+    view_context = context.get('view_context') if context else None
+    if view_context:
+        return view_context.get('object')
+
+
+def get_union_instances(querysets, subdomain_ordering=False):
+    """ Fetches the instances of all given querysets with a single UNION ALL query.
+        Instances are returned grouped by queryset, in the order the querysets are given.
+    """
+    # Every column of every model is selected, using NULL where a model does not have it
+    fields = OrderedDict()
+    for queryset in querysets:
+        for field in queryset.model._meta.concrete_fields:
+            fields.setdefault(field.attname, field)
+    aliases = OrderedDict((attname, 'seo_col%d' % i) for i, attname in enumerate(fields))
+
+    parts = []
+    for index, queryset in enumerate(querysets):
+        attnames = set(f.attname for f in queryset.model._meta.concrete_fields)
+        columns = OrderedDict([('seo_backend', Value(index, output_field=IntegerField()))])
+        for attname, alias in aliases.items():
+            if attname in attnames:
+                columns[alias] = F(attname)
+            else:
+                columns[alias] = Value(None, output_field=fields[attname])
+        parts.append(queryset.order_by().annotate(**columns).values_list(*columns))
+
+    ordering = ['seo_backend']
+    if subdomain_ordering and '_all_subdomains' in aliases:
+        ordering.append(aliases['_all_subdomains'])
+    rows = parts[0].union(*parts[1:], all=True) if len(parts) > 1 else parts[0]
+
+    instances = []
+    instances_by_queryset = [[] for queryset in querysets]
+    for row in rows.order_by(*ordering):
+        queryset = querysets[row[0]]
+        values = dict(zip(aliases, row[1:]))
+        field_names = [f.attname for f in queryset.model._meta.concrete_fields]
+        instance = queryset.model.from_db(queryset.db, field_names, [values[f] for f in field_names])
+        instances.append(instance)
+        instances_by_queryset[row[0]].append(instance)
+
+    # Honour any prefetching the backends asked for
+    for queryset, queryset_instances in zip(querysets, instances_by_queryset):
+        if queryset._prefetch_related_lookups and queryset_instances:
+            prefetch_related_objects(queryset_instances, *queryset._prefetch_related_lookups)
+    return instances
+
+
 class PathBackend(MetadataBackend):
     name = "path"
     verbose_name = "Path"
     unique_together = (("_path",),)
+    lookup_fields = ('_path',)
 
     def get_instances(self, queryset, path, context):
-        return queryset.filter(_path=path)
+        return filter_paths(queryset, [path])
+
+    def get_many_instances(self, queryset, paths, contexts):
+        return group_instances(filter_paths(queryset, paths), '_path')
 
     def get_model(self, options):
         class PathMetadataBase(MetadataBaseModel):
             _path = models.CharField(
                 _('path'),
-                max_length=255,
+                max_length=options.path_max_length,
             )
 
+            if options.use_path_hash:
+                _path_hash = models.BigIntegerField(editable=False)
+
             if options.use_sites:
                 _site = models.ForeignKey(
                     Site,
@@ -248,6 +543,9 @@ class PathBackend(MetadataBackend):
             def _populate_from_kwargs(self):
                 return {'path': self._path}
 
+            def _get_cache_scopes(self):
+                return self._get_path_cache_scopes()
+
             def _resolve_value(self, name):
                 value = super(PathMetadataBase, self)._resolve_value(name)
                 try:
@@ -258,20 +556,173 @@ class PathBackend(MetadataBackend):
             class Meta:
                 abstract = True
                 unique_together = self.get_unique_together(options)
+                indexes = self.get_indexes(options)
 
         return PathMetadataBase
 
 
+class PathPrefixBackend(MetadataBackend):
+    """ Metadata for every path starting with a given prefix, eg a whole section of a site.
+        All instances are kept in memory in a trie, so paths are matched without a query.
+        The trie is rebuilt when an instance is saved or deleted, in this or any other process.
+    """
+    name = "pathprefix"
+    verbose_name = "Path Prefix"
+    unique_together = (("_prefix",),)
+    lookup_fields = ('_prefix',)
+    in_memory = True
+
+    def __init__(self):
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    def get_indexes(self, options):
+        # Instances are never looked up in the database, the unique index is enough
+        return []
+
+    def get_trie(self, model):
+        """ Returns a trie of all instances, which is rebuilt whenever an instance has changed. """
+        meta = model._metadata._meta
+        generation = meta.cache.get_generations([backend_scope(meta.name, self.name)])[0]
+        loaded = self._loaded
+        if loaded is None or loaded[0] != generation:
+            with self._lock:
+                loaded = self._loaded
+                if loaded is None or loaded[0] != generation:
+                    trie = PrefixTrie()
+                    for instance in model._default_manager.get_queryset().order_by('pk'):
+                        trie.add(instance._prefix, instance)
+                    loaded = self._loaded = (generation, trie)
+        return loaded[1]
+
+    def match(self, model, path, site=None, language=None, subdomain=None):
+        """ Returns the instances of every prefix of the given path, longest prefix first,
+            so that values missing for a longer prefix are taken from a shorter one.
+            Instances are filtered like by_params would, and copied so that each lookup
+            can give them its own context.
+        """
+        if path is None:
+            return []
+        options = model._metadata._meta
+        instances = []
+        for candidates in self.get_trie(model).match(path):
+            for instance in filter_instances(candidates, options, site, language, subdomain):
+                instance = copy.copy(instance)
+                instance._matched_path = path
+                instances.append(instance)
+        return instances
+
+    def get_manager(self, options):
+        backend = self
+
+        class _Manager(super(PathPrefixBackend, self).get_manager(options)):
+            def get_instances(self, path, site=None, language=None, context=None, subdomain=None):
+                return backend.match(self.model, path, site, language, subdomain)
+
+            def get_many_instances(self, paths, site=None, language=None, contexts=None, subdomain=None):
+                return dict((path, backend.match(self.model, path, site, language, subdomain)) for path in paths)
+
+            def get_combined_instances(self, path, site=None, language=None, context=None, subdomain=None,
+                                       querysets=None):
+                return backend.match(self.model, path, site, language, subdomain)
+        return _Manager
+
+    def register(self, model, options):
+        scope = backend_scope(options.name, self.name)
+
+        def invalidate_trie(sender, **kwargs):
+            options.cache.bump_generations_on_commit([scope], kwargs.get('using'))
+
+        models.signals.post_save.connect(invalidate_trie, sender=model, weak=False)
+        models.signals.post_delete.connect(invalidate_trie, sender=model, weak=False)
+
+    def get_model(self, options):
+        class PathPrefixMetadataBase(MetadataBaseModel):
+            _prefix = models.CharField(
+                _('path prefix'),
+                max_length=options.path_max_length,
+                help_text=_('Metadata works for all paths starting with this prefix')
+            )
+
+            if options.use_sites:
+                _site = models.ForeignKey(
+                    Site,
+                    null=True,
+                    blank=True,
+                    verbose_name=_("site"),
+                    on_delete=models.PROTECT
+                )
+
+            if options.use_i18n:
+                _language = models.CharField(
+                    _("language"),
+                    max_length=5,
+                    null=True,
+                    blank=True,
+                    db_index=True,
+                    choices=settings.LANGUAGES
+                )
+
+            if options.use_subdomains:
+                _subdomain = models.CharField(
+                    _('subdomain'),
+                    max_length=100,
+                    blank=True,
+                    null=True,
+                    db_index=True
+                )
+                _all_subdomains = models.BooleanField(
+                    _('all subdomains'),
+                    default=False,
+                    help_text=_('Metadata works for all subdomains')
+                )
+
+            objects = self.get_manager(options)()
+
+            def __unicode__(self):
+                return self._prefix
+
+            def _process_context(self, context):
+                self.__context = context.get('view_context')
+
+            def _populate_from_kwargs(self):
+                return {'path': getattr(self, '_matched_path', None) or self._prefix}
+
+            def _resolve_value(self, name):
+                value = super(PathPrefixMetadataBase, self)._resolve_value(name)
+                try:
+                    return self._resolve_template(value, context=self.__context)
+                except AttributeError:
+                    return value
+
+            class Meta:
+                abstract = True
+                unique_together = self.get_unique_together(options)
+
+        return PathPrefixMetadataBase
+
+
 class ViewBackend(MetadataBackend):
     name = "view"
     verbose_name = "View"
     unique_together = (("_view",),)
+    lookup_fields = ('_view',)
 
     def get_instances(self, queryset, path, context):
-        view_name = ""
-        if path is not None:
-            view_name = resolve_to_name(path)
-        return queryset.filter(_view=view_name or "")
+        return queryset.filter(_view=self.get_lookup_key(path, context))
+
+    def get_lookup_key(self, path, context):
+        if path is None:
+            return ""
+        view_context = context.get('view_context') if context else None
+        request = view_context.get('request') if view_context else None
+        return resolve_to_name(path, request=request) or ""
+
+    def get_many_instances(self, queryset, paths, contexts):
+        view_names = dict((path, resolve_to_name(path) or "") for path in paths if path is not None)
+        instances = group_instances(queryset.filter(_view__in=set(view_names.values())), '_view')
+        return dict((path, [copy.copy(i) for i in instances.get(view_name, [])])
+                    for path, view_name in view_names.items())
 
     def get_model(self, options):
         class ViewMetadataBase(MetadataBaseModel):
@@ -339,6 +790,7 @@ class ViewBackend(MetadataBackend):
             class Meta:
                 abstract = True
                 unique_together = self.get_unique_together(options)
+                indexes = self.get_indexes(options)
 
         return ViewMetadataBase
 
@@ -347,19 +799,30 @@ class ModelInstanceBackend(MetadataBackend):
     name = "modelinstance"
     verbose_name = "Model Instance"
     unique_together = (("_path",), ("_content_type", "_object_id"))
+    lookup_fields = ('_path',)
 
     def get_instances(self, queryset, path, context):
-        return queryset.filter(_path=path)
+        queryset = filter_paths(queryset, [path])
+        # Fetch the content objects together with the metadata, unless the view already has it
+        if get_view_object(context) is None:
+            queryset = queryset.prefetch_related('_content_object')
+        return queryset
+
+    def get_many_instances(self, queryset, paths, contexts):
+        return group_instances(filter_paths(queryset, paths).prefetch_related('_content_object'), '_path')
 
     def get_model(self, options):
         class ModelInstanceMetadataBase(MetadataBaseModel):
             _path = models.CharField(
                 _('path'),
-                max_length=255,
+                max_length=options.path_max_length,
                 blank=True,
                 editable=False,
             )
 
+            if options.use_path_hash:
+                _path_hash = models.BigIntegerField(editable=False)
+
             _content_type = models.ForeignKey(
                 ContentType,
                 verbose_name=_("model"),
@@ -370,7 +833,7 @@ class ModelInstanceBackend(MetadataBackend):
                 verbose_name=_("ID")
             )
 
-            _content_object = GenericForeignKey('_content_type', '_object_id')
+            _content_object = ContentObjectForeignKey('_content_type', '_object_id')
 
             if options.use_sites:
                 _site = models.ForeignKey(
@@ -412,16 +875,32 @@ class ModelInstanceBackend(MetadataBackend):
 
             class Meta:
                 unique_together = self.get_unique_together(options)
+                indexes = self.get_indexes(options)
                 abstract = True
 
             def _process_context(self, context):
                 self.__context = context.get('view_context')
-                context['content_type'] = self._content_type
+                self._set_content_object(get_view_object(context))
+                context['content_type'] = ContentType.objects.get_for_id(self._content_type_id)
                 context['model_instance'] = self
 
+            def _set_content_object(self, obj):
+                """ Uses the given object as the content object, if it is the right one.
+                    This avoids fetching an object that is already in memory again.
+                """
+                if obj is None or getattr(obj, 'pk', None) != self._object_id:
+                    return
+                if ContentType.objects.get_for_model(obj).pk == self._content_type_id:
+                    self._content_object = obj
+
             def _populate_from_kwargs(self):
                 return {'model_instance': self._content_object}
 
+            def _get_cache_scopes(self):
+                scopes = self._get_path_cache_scopes()
+                scopes.append(content_type_scope(self._metadata._meta.name, self._content_type_id))
+                return scopes
+
             def _resolve_value(self, name):
                 value = super(ModelInstanceMetadataBase, self)._resolve_value(name)
                 try:
@@ -449,20 +928,52 @@ class ModelBackend(MetadataBackend):
     name = "model"
     verbose_name = "Model"
     unique_together = (("_content_type",),)
+    lookup_fields = ('_content_type',)
 
     def get_instances(self, queryset, path, context):
+        content_type_id = self.get_lookup_key(path, context)
+        if content_type_id is not None:
+            return queryset.filter(_content_type=content_type_id)
+
+    def get_lookup_key(self, path, context):
         if not context:
-            return
-        content_type = None
+            return None
         if 'content_type' in context:
-            content_type = context['content_type']
-        else:
-            view_context = context.get('view_context')
-            if view_context:
-                instance = view_context.get('object')
-                if instance:
-                    content_type = ContentType.objects.get_for_model(instance)
-        if content_type:
+            return context['content_type'].pk
+        instance = get_view_object(context)
+        if instance:
+            return ContentType.objects.get_for_model(instance).pk
+
+    def get_many_instances(self, queryset, paths, contexts):
+        content_types = {}
+        for path in paths:
+            content_type_id = self.get_lookup_key(path, contexts[path])
+            if content_type_id is not None:
+                content_types[path] = content_type_id
+        if not content_types:
+            return {}
+        instances = group_instances(queryset.filter(_content_type__in=set(content_types.values())),
+                                    '_content_type_id')
+        # Instances are shared by many paths, each path gets its own copy to hold its context
+        return dict((path, [copy.copy(i) for i in instances.get(content_type, [])])
+                    for path, content_type in content_types.items())
+
+    def get_combined_instances(self, queryset, path, context, querysets):
+        content_type = None
+        instance = get_view_object(context)
+        if instance:
+            content_type = ContentType.objects.get_for_model(instance).pk
+        # The content type of matching model instance metadata takes precedence
+        instance_queryset = querysets.get('modelinstance')
+        if instance_queryset is not None:
+            if instance_queryset.ordered:
+                instance_queryset = instance_queryset.reverse()
+            subquery = Subquery(instance_queryset.values('_content_type')[:1])
+            if content_type is not None:
+                content_type = Coalesce(subquery, Value(content_type))
+            else:
+                content_type = subquery
+        if content_type is not None:
             return queryset.filter(_content_type=content_type)
 
     def get_model(self, options):
@@ -522,7 +1033,12 @@ class ModelBackend(MetadataBackend):
                 self.__context = context.get('view_context')
 
             def _populate_from_kwargs(self):
-                return {'content_type': self._content_type}
+                return {'content_type': ContentType.objects.get_for_id(self._content_type_id)}
+
+            def _get_cache_scopes(self):
+                scopes = super(ModelMetadataBase, self)._get_cache_scopes()
+                scopes.append(content_type_scope(self._metadata._meta.name, self._content_type_id))
+                return scopes
 
             def _resolve_value(self, name):
                 value = super(ModelMetadataBase, self)._resolve_value(name)
@@ -533,6 +1049,7 @@ class ModelBackend(MetadataBackend):
             class Meta:
                 abstract = True
                 unique_together = self.get_unique_together(options)
+                indexes = self.get_indexes(options)
 
         return ModelMetadataBase
 
@@ -3,7 +3,6 @@
 #    * Move/rename namespace polluting attributes
 #    * Documentation
 #    * Make backends optional: Meta.backends = (path, modelinstance/model, view)
-import hashlib
 import logging
 import six
 import functools
@@ -15,14 +14,17 @@ from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
 from django.utils.safestring import mark_safe
-from django.core.cache import cache
-from django.utils.encoding import iri_to_uri
 from django.db.utils import DatabaseError
 
-from djangoseo.utils import NotSet, Literal, import_tracked_models
+from asgiref.sync import sync_to_async
+
+from djangoseo.utils import NotSet, Literal, RenderedValue, import_tracked_models, redirect_lookup
+from djangoseo.utils import redirect_target_filter, path_hash
 from djangoseo.options import Options
+from djangoseo.cache import global_scope, path_scope, content_type_scope, hash_path
 from djangoseo.fields import MetadataField, Tag, MetaTag, KeywordTag, Raw
-from djangoseo.backends import backend_registry, RESERVED_FIELD_NAMES
+from djangoseo.backends import backend_registry, get_union_instances, RESERVED_FIELD_NAMES
+from djangoseo.snapshot import get_snapshot
 
 
 logger = logging.getLogger(__name__)
@@ -30,20 +32,35 @@ logger = logging.getLogger(__name__)
 
 registry = OrderedDict()
 
+CACHE_MODES = ('field', 'bundle')
+
+# Key used for the rendered head html inside a bundled cache entry
+BUNDLE_HEAD = '__head__'
+
 
 class FormattedMetadata(object):
     """ Allows convenient access to selected metadata.
         Metadata for each field may be sourced from any one of the relevant instances passed.
     """
 
-    def __init__(self, metadata, instances, path, site=None, language=None, subdomain=None):
+    def __init__(self, metadata, instances, path, site=None, language=None, subdomain=None, content_type=None,
+                 object_id=None):
         self.__metadata = metadata
+        self.__cache = metadata._meta.cache
         if metadata._meta.use_cache:
+            name = metadata._meta.name
+            if content_type is not None:
+                # Metadata linked to an object is cached per object, rather than per path
+                path = '%s:%s' % (content_type.pk, object_id)
+                scopes = [global_scope(name), content_type_scope(name, content_type.pk)]
+            else:
+                scopes = [global_scope(name), path_scope(name, path)]
             if metadata._meta.use_sites and site:
-                hexpath = hashlib.md5(iri_to_uri(site.domain + path).encode('utf-8')).hexdigest()
+                hexpath = hash_path(site.domain + path)
             else:
-                hexpath = hashlib.md5(iri_to_uri(path).encode('utf-8')).hexdigest()
-            prefix_bits = ['djangoseo', self.__metadata.__class__.__name__, hexpath]
+                hexpath = hash_path(path)
+            generation = '-'.join(str(g) for g in self.__cache.get_generations(scopes))
+            prefix_bits = ['djangoseo', name, generation, hexpath]
             if metadata._meta.use_i18n:
                 prefix_bits.append(language)
             if metadata._meta.use_subdomains and subdomain is not None:
@@ -51,8 +68,14 @@ class FormattedMetadata(object):
             self.__cache_prefix = '.'.join(prefix_bits)
         else:
             self.__cache_prefix = None
+        # Paths without any metadata are remembered, to avoid querying every backend again
+        if self.__cache_prefix is not None and content_type is None:
+            self.__empty_key = '%s.__empty__' % self.__cache_prefix
+        else:
+            self.__empty_key = None
         self.__instances_original = instances
         self.__instances_cache = []
+        self.__bundle = None
 
     def __instances(self):
         """ Cache instances, allowing generators to be used and reused.
@@ -61,15 +84,29 @@ class FormattedMetadata(object):
         """
         for instance in self.__instances_cache:
             yield instance
+        if self.__empty_key is not None and not self.__instances_cache:
+            if self.__cache.get(self.__empty_key):
+                self.__instances_original = iter(())
+                self.__empty_key = None
         for instance in self.__instances_original:
             self.__instances_cache.append(instance)
             yield instance
+        if self.__empty_key is not None:
+            if not self.__instances_cache:
+                self.__cache.set(self.__empty_key, True, self.__metadata._meta.cache_timeout)
+            self.__empty_key = None
 
-    def _resolve_value(self, name):
+    def _resolve_value(self, name, rendered=True):
         """ Returns an appropriate value for the given name.
             This simply asks each of the instances for a value.
+            If an instance has stored the cleaned and rendered value, a RenderedValue is returned.
         """
+        rendered = rendered and self.__metadata._meta.store_rendered
         for instance in self.__instances():
+            if rendered:
+                value = instance._get_rendered(name)
+                if value is not None:
+                    return value
             value = instance._resolve_value(name)
             if value:
                 return value
@@ -83,13 +120,77 @@ class FormattedMetadata(object):
             elif isinstance(populate_from, Literal):
                 return populate_from.value
             elif populate_from is not NotSet:
-                return self._resolve_value(populate_from)
+                return self._resolve_value(populate_from, rendered=False)
+
+    def _resolve_group(self, name, values=None):
+        """ Returns the html output of all fields in the given group.
+            Already resolved values can be passed in to avoid resolving them again.
+        """
+        if values is None:
+            values = {}
+        output = []
+        for f in self.__metadata._meta.groups[name]:
+            value = values[f] or None if f in values else self._resolve_value(f)
+            output.append(six.text_type(BoundMetadataField(self.__metadata._meta.elements[f], value)))
+        return '\n'.join(output).strip()
+
+    def _get_bundle(self):
+        """ Returns a dict of every resolved field value, group output and the head html.
+            When the bundled cache is used, this is stored in a single cache entry,
+            so that a page costs one round trip to the cache instead of one per field.
+            Values missing from the bundle are looked up in the per-field
+            cache entries with a single get_many, and only the rest is resolved.
+        """
+        if self.__bundle is not None:
+            return self.__bundle
+
+        meta = self.__metadata._meta
+        use_bundle_cache = self.__cache_prefix is not None and meta.cache_mode == 'bundle'
+        bundle = None
+        if use_bundle_cache:
+            bundle_key = '%s.__bundle__' % self.__cache_prefix
+            bundle = self.__cache.get(bundle_key)
+        if bundle is None:
+            bundle = {}
+            if self.__cache_prefix is not None:
+                keys = OrderedDict(('%s.%s' % (self.__cache_prefix, name), name)
+                                   for name in list(meta.elements) + list(meta.groups))
+                keys[self.__cache_prefix] = BUNDLE_HEAD
+                bundle = dict((keys[key], value) for key, value in self.__cache.get_many(list(keys)).items())
+
+            for name in meta.elements:
+                if name not in bundle:
+                    bundle[name] = self._resolve_value(name) or ''
+            for name in meta.groups:
+                if name not in bundle:
+                    bundle[name] = self._resolve_group(name, bundle)
+            if BUNDLE_HEAD not in bundle:
+                bundle[BUNDLE_HEAD] = mark_safe('\n'.join(
+                    six.text_type(BoundMetadataField(e, bundle[f] or None))
+                    for f, e in meta.elements.items() if e.head))
+            if use_bundle_cache:
+                self.__cache.set(bundle_key, bundle, meta.cache_timeout)
+
+        self.__bundle = bundle
+        return bundle
+
+    def _materialize(self):
+        """ Resolves all values up front, so that no further queries are needed to read them. """
+        self._get_bundle()
+        return self
 
     def __getattr__(self, name):
+        if self.__bundle is not None or self.__cache_prefix and self.__metadata._meta.cache_mode == 'bundle':
+            if name in self.__metadata._meta.groups:
+                return self._get_bundle()[name] or None
+            elif name in self.__metadata._meta.elements:
+                return BoundMetadataField(self.__metadata._meta.elements[name], self._get_bundle()[name] or None)
+            raise AttributeError
+
         # If caching is enabled, work out a key
         if self.__cache_prefix:
             cache_key = '%s.%s' % (self.__cache_prefix, name)
-            value = cache.get(cache_key)
+            value = self.__cache.get(cache_key)
         else:
             cache_key = None
             value = None
@@ -98,8 +199,7 @@ class FormattedMetadata(object):
         if name in self.__metadata._meta.groups:
             if value is not None:
                 return value or None
-            value = '\n'.join(six.text_type(BoundMetadataField(self.__metadata._meta.elements[f], self._resolve_value(f)))
-                              for f in self.__metadata._meta.groups[name]).strip()
+            value = self._resolve_group(name)
 
         # Look for an element called "name"
         elif name in self.__metadata._meta.elements:
@@ -107,20 +207,23 @@ class FormattedMetadata(object):
                 return BoundMetadataField(self.__metadata._meta.elements[name], value or None)
             value = self._resolve_value(name)
             if cache_key is not None:
-                cache.set(cache_key, value or '')
+                self.__cache.set(cache_key, value or '', self.__metadata._meta.cache_timeout)
             return BoundMetadataField(self.__metadata._meta.elements[name], value)
         else:
             raise AttributeError
 
         if cache_key is not None:
-            cache.set(cache_key, value or '')
+            self.__cache.set(cache_key, value or '', self.__metadata._meta.cache_timeout)
 
         return value or None
 
     def __str__(self):
         """ String version of this object is the html output of head elements. """
+        if self.__bundle is not None or self.__cache_prefix is not None and self.__metadata._meta.cache_mode == 'bundle':
+            return self._get_bundle()[BUNDLE_HEAD]
+
         if self.__cache_prefix is not None:
-            value = cache.get(self.__cache_prefix)
+            value = self.__cache.get(self.__cache_prefix)
         else:
             value = None
 
@@ -128,7 +231,7 @@ class FormattedMetadata(object):
             value = mark_safe('\n'.join(six.text_type(getattr(self, f)) for f, e in
                                          self.__metadata._meta.elements.items() if e.head))
             if self.__cache_prefix is not None:
-                cache.set(self.__cache_prefix, value or '')
+                self.__cache.set(self.__cache_prefix, value or '', self.__metadata._meta.cache_timeout)
 
         return value
 
@@ -141,12 +244,18 @@ class BoundMetadataField(object):
 
     def __init__(self, field, value):
         self.field = field
-        if value:
+        self.html = None
+        if isinstance(value, RenderedValue):
+            self.value = value.value or None
+            self.html = value.html
+        elif value:
             self.value = field.clean(value)
         else:
             self.value = None
 
     def make_safe(self):
+        if self.html is not None:
+            return mark_safe(self.html)
         return mark_safe(self.field.render(self.value)) if self.value else ''
 
     def __str__(self):
@@ -193,6 +302,8 @@ class MetadataBase(type):
         for key in elements:
             assert key not in RESERVED_FIELD_NAMES, "Field name '%s' is not allowed" % key
 
+        assert options.cache_mode in CACHE_MODES, "Meta.cache_mode must be one of %s" % ', '.join(CACHE_MODES)
+
         # Preprocessing complete, here is the new class
         new_class = type.__new__(cls, name, bases, attrs)
 
@@ -226,6 +337,13 @@ class MetadataBase(type):
         return FormattedMetadata(cls(), cls._get_instances(path, context, site, language, subdomain),
                                  path, site, language, subdomain)
 
+    def _get_formatted_data_many(cls, paths, context=None, site=None, language=None, subdomain=None):
+        """ Return an ordered dict of objects to access the values of each of the given paths. """
+        paths = list(OrderedDict.fromkeys(paths))
+        instances = cls._get_instances_many(paths, context, site, language, subdomain)
+        return OrderedDict((path, FormattedMetadata(cls(), instances[path], path, site, language, subdomain))
+                           for path in paths)
+
     # TODO: Move this function out of the way (subclasses will want to define their own attributes)
     def _get_instances(cls, path, context=None, site=None, language=None, subdomain=None):
         """ A sequence of instances to discover metadata.
@@ -234,6 +352,22 @@ class MetadataBase(type):
         """
         backend_context = {'view_context': context}
 
+        if cls._meta.use_snapshot:
+            snapshot = get_snapshot(cls)
+            for model in cls._meta.models.values():
+                for instance in snapshot.get_instances(model, path, backend_context, site, language, subdomain):
+                    if hasattr(instance, '_process_context'):
+                        instance._process_context(backend_context)
+                    yield instance
+            return
+
+        if cls._meta.use_union_lookup:
+            for instance in cls._get_union_instances(path, backend_context, site, language, subdomain):
+                if hasattr(instance, '_process_context'):
+                    instance._process_context(backend_context)
+                yield instance
+            return
+
         for model in cls._meta.models.values():
             for instance in model.objects.get_instances(
                     path=path,
@@ -245,6 +379,67 @@ class MetadataBase(type):
                     instance._process_context(backend_context)
                 yield instance
 
+    def _get_instances_many(cls, paths, context=None, site=None, language=None, subdomain=None):
+        """ The instances for each of the given paths, in the same order as _get_instances.
+            Each backend is queried once for all paths.
+        """
+        if cls._meta.use_snapshot:
+            return dict((path, list(cls._get_instances(path, context, site, language, subdomain))) for path in paths)
+
+        backend_contexts = dict((path, {'view_context': context}) for path in paths)
+        instances = dict((path, []) for path in paths)
+        for model in cls._meta.models.values():
+            found = model.objects.get_many_instances(
+                paths=paths,
+                site=site,
+                language=language,
+                subdomain=subdomain,
+                contexts=backend_contexts)
+            for path in paths:
+                for instance in found.get(path, []):
+                    if hasattr(instance, '_process_context'):
+                        instance._process_context(backend_contexts[path])
+                    instances[path].append(instance)
+        return instances
+
+    def _get_union_instances(cls, path, backend_context, site=None, language=None, subdomain=None):
+        """ Fetches the instances of all backends with a single query, in the order
+            they would be looked up one after another.
+        """
+        querysets = OrderedDict()
+        found = OrderedDict()
+        for name, model in cls._meta.models.items():
+            queryset = model.objects.get_combined_instances(
+                path=path,
+                site=site,
+                language=language,
+                subdomain=subdomain,
+                context=backend_context,
+                querysets=querysets)
+            if isinstance(queryset, models.QuerySet):
+                querysets[name] = queryset
+            # Backends that keep their instances in memory return them directly
+            if queryset is not None:
+                found[name] = queryset
+        if not querysets:
+            instances = []
+        else:
+            instances = get_union_instances(list(querysets.values()),
+                                            subdomain_ordering=cls._meta.use_subdomains and subdomain is not None)
+        if len(found) == len(querysets):
+            return instances
+
+        by_model = {}
+        for instance in instances:
+            by_model.setdefault(instance.__class__, []).append(instance)
+        ordered = []
+        for name, queryset in found.items():
+            if name in querysets:
+                ordered.extend(by_model.get(queryset.model, []))
+            else:
+                ordered.extend(queryset)
+        return ordered
+
 
 @six.add_metaclass(MetadataBase)
 class Metadata(object):
@@ -272,6 +467,14 @@ def get_metadata(path, name=None, context=None, site=None, language=None, subdom
     return metadata._get_formatted_data(path, context, site, language, subdomain)
 
 
+def get_metadata_many(paths, name=None, context=None, site=None, language=None, subdomain=None):
+    """ Gets the metadata of many paths at once, using one query per backend.
+        Returns an ordered dict with the metadata for each path.
+    """
+    metadata = _get_metadata_model(name)
+    return metadata._get_formatted_data_many(paths, context, site, language, subdomain)
+
+
 def get_linked_metadata(obj, name=None, context=None, site=None, language=None, subdomain=None):
     """ Gets metadata linked from the given object. """
     # XXX Check that 'modelinstance' and 'model' metadata are installed in backends
@@ -286,6 +489,8 @@ def get_linked_metadata(obj, name=None, context=None, site=None, language=None,
             instance_md = InstanceMetadata.objects.get(_content_type=content_type, _object_id=obj.pk)
         except InstanceMetadata.DoesNotExist:
             instance_md = InstanceMetadata(_content_object=obj)
+        else:
+            instance_md._set_content_object(obj)
         instances.append(instance_md)
     if ModelMetadata is not None:
         try:
@@ -293,7 +498,73 @@ def get_linked_metadata(obj, name=None, context=None, site=None, language=None,
         except ModelMetadata.DoesNotExist:
             model_md = ModelMetadata(_content_type=content_type)
         instances.append(model_md)
-    return FormattedMetadata(Metadata, instances, '', site, language, subdomain)
+    return FormattedMetadata(Metadata, instances, '', site, language, subdomain, content_type, obj.pk)
+
+
+async def aget_metadata(path, name=None, context=None, site=None, language=None, subdomain=None):
+    """ Coroutine version of get_metadata, for use in async views.
+        All values are resolved in a single hop to a thread, the returned metadata
+        can then be read without any further database queries.
+    """
+    return await sync_to_async(_get_materialized(get_metadata))(path, name, context, site, language, subdomain)
+
+
+async def aget_linked_metadata(obj, name=None, context=None, site=None, language=None, subdomain=None):
+    """ Coroutine version of get_linked_metadata, see aget_metadata. """
+    return await sync_to_async(_get_materialized(get_linked_metadata))(obj, name, context, site,
+                                                                       language, subdomain)
+
+
+def _get_materialized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)._materialize()
+    return wrapper
+
+
+def get_linked_metadata_many(objects, name=None, context=None, site=None, language=None, subdomain=None):
+    """ Gets the metadata linked from each of the given objects, which may be of different models.
+        Model instance metadata is fetched with one query per content type, model metadata with one query.
+        Returns a list with the metadata of each object, in the given order.
+    """
+    Metadata = _get_metadata_model(name)
+    InstanceMetadata = Metadata._meta.get_model('modelinstance')
+    ModelMetadata = Metadata._meta.get_model('model')
+    objects = list(objects)
+    content_types = ContentType.objects.get_for_models(*set(obj.__class__ for obj in objects))
+
+    instance_mds = {}
+    if InstanceMetadata is not None:
+        object_ids = OrderedDict()
+        for obj in objects:
+            object_ids.setdefault(content_types[obj.__class__], set()).add(obj.pk)
+        for content_type, pks in object_ids.items():
+            for instance_md in InstanceMetadata.objects.filter(_content_type=content_type, _object_id__in=pks):
+                instance_mds.setdefault((content_type.pk, instance_md._object_id), instance_md)
+
+    model_mds = {}
+    if ModelMetadata is not None and objects:
+        for model_md in ModelMetadata.objects.filter(_content_type__in=set(content_types.values())):
+            model_mds.setdefault(model_md._content_type_id, model_md)
+
+    result = []
+    for obj in objects:
+        content_type = content_types[obj.__class__]
+        instances = []
+        if InstanceMetadata is not None:
+            instance_md = instance_mds.get((content_type.pk, obj.pk))
+            if instance_md is None:
+                instance_md = InstanceMetadata(_content_object=obj)
+            else:
+                instance_md._set_content_object(obj)
+            instances.append(instance_md)
+        if ModelMetadata is not None:
+            model_md = model_mds.get(content_type.pk)
+            if model_md is None:
+                model_md = ModelMetadata(_content_type=content_type)
+            instances.append(model_md)
+        result.append(FormattedMetadata(Metadata, instances, '', site, language, subdomain, content_type, obj.pk))
+    return result
 
 
 def create_metadata_instance(metadata_class, instance):
@@ -367,6 +638,7 @@ def _handle_redirects_callback(model_class, sender, instance, **kwargs):
     """
     # avoid RuntimeError for apps without enabled redirects
     from .models import Redirect
+    from .redirects import invalidate_site_redirects
 
     if not instance.pk:
         return
@@ -374,12 +646,18 @@ def _handle_redirects_callback(model_class, sender, instance, **kwargs):
         after = instance.get_absolute_url()
         before = sender.objects.filter(id=instance.id).first().get_absolute_url()
         if before != after:
-            Redirect.objects.get_or_create(
-                old_path=before,
-                new_path=after,
-                site=Site.objects.get_current(),
-                all_subdomains=True
+            site = Site.objects.get_current()
+            # Redirects to the old URL are pointed at the new one, so that clients never follow a chain
+            Redirect.objects.filter(redirect_target_filter(before), site=site).exclude(
+                **redirect_lookup(after)).update(new_path=after, new_path_hash=path_hash(after))
+            # An object that gets an earlier URL back would otherwise redirect in a loop
+            Redirect.objects.filter(redirect_target_filter(before), site=site, **redirect_lookup(after)).delete()
+            Redirect.objects.update_or_create(
+                site=site,
+                defaults={'new_path': after, 'all_subdomains': True},
+                **redirect_lookup(before)
             )
+            invalidate_site_redirects(site.id)
     except Exception as e:
         logger.exception('Failed to create new redirect')
 
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+""" Cache helpers shared by the metadata and redirect lookups.
+
+    Cached entries are never deleted directly. Instead, each entry key includes
+    the current value of one or more generation counters, which are bumped
+    whenever the underlying rows change. Old entries are then simply never read
+    again and expire on their own.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.utils.encoding import iri_to_uri
+
+
+GENERATION_KEY = 'djangoseo.generation.%s'
+
+
+def hash_path(path):
+    return hashlib.md5(iri_to_uri(path).encode('utf-8')).hexdigest()
+
+
+def global_scope(name):
+    """ Scope for changes that can affect any path (eg model and view metadata). """
+    return '%s.global' % name
+
+
+def path_scope(name, path):
+    """ Scope for changes that only affect a single path. """
+    return '%s.path.%s' % (name, hash_path(path))
+
+
+def content_type_scope(name, content_type_id):
+    """ Scope for changes that only affect objects of a single content type. """
+    return '%s.ct.%s' % (name, content_type_id)
+
+
+def backend_scope(name, backend_name):
+    """ Scope for changes to any instance of a backend, for backends that keep their instances in memory. """
+    return '%s.backend.%s' % (name, backend_name)
+
+
+def snapshot_scope(name):
+    """ Scope for changes to any metadata of a definition, used to refresh its snapshot. """
+    return '%s.snapshot' % name
+
+
+def site_scope():
+    """ Scope for changes to any site, used to refresh the site ids known by domain. """
+    return 'sites'
+
+
+def redirect_scope(site_id):
+    """ Scope for changes to the redirects of a site. """
+    return 'redirects.%s' % site_id
+
+
+def redirect_pattern_scope(site_id):
+    """ Scope for changes to the redirect patterns of a site. """
+    return 'redirectpatterns.%s' % site_id
+
+
+class LocalCache(object):
+    """ A bounded, thread-safe LRU cache with expiry, kept in process memory. """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MetadataCache(object):
+    """ The django cache, optionally with a LocalCache in front of it.
+        Values are cached locally for as long as they are cached in the django cache,
+        generation counters only for the (short) timeout of the local cache.
+        Invalidations from other processes are therefore picked up once the
+        local copy of the counters expires.
+    """
+
+    def __init__(self, local=None):
+        self.local = local
+
+    def get(self, key, default=None):
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+        value = cache.get(key)
+        if value is None:
+            return default
+        if self.local is not None:
+            self.local.set(key, value, None)
+        return value
+
+    def get_many(self, keys):
+        found = {}
+        if self.local is not None:
+            for key in keys:
+                value = self.local.get(key)
+                if value is not None:
+                    found[key] = value
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = cache.get_many(missing)
+            if self.local is not None:
+                for key, value in fetched.items():
+                    self.local.set(key, value, None)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        cache.set(key, value, timeout)
+        if self.local is not None:
+            self.local.set(key, value, None if timeout is DEFAULT_TIMEOUT else timeout)
+
+    def get_generations(self, scopes):
+        """ Returns the current generation for each of the given scopes,
+            using at most a single round trip to the cache.
+        """
+        keys = [GENERATION_KEY % scope for scope in scopes]
+        found = {}
+        if self.local is not None:
+            for key in keys:
+                value = self.local.get(key)
+                if value is not None:
+                    found[key] = value
+        missing = [key for key in keys if key not in found]
+        if missing:
+            fetched = cache.get_many(missing)
+            for key in missing:
+                value = fetched.get(key)
+                if value is None:
+                    value = _init_generation(key)
+                found[key] = value
+                if self.local is not None:
+                    self.local.set(key, value)
+        return [found[key] for key in keys]
+
+    def bump_generations(self, scopes):
+        """ Invalidates all entries cached under the given scopes. """
+        for scope in set(scopes):
+            key = GENERATION_KEY % scope
+            try:
+                value = cache.incr(key)
+            except ValueError:
+                value = _init_generation(key)
+            if self.local is not None:
+                self.local.set(key, value)
+
+    def bump_generations_on_commit(self, scopes, using=None):
+        """ Invalidates all entries cached under the given scopes once the current transaction
+            is committed, right away outside of a transaction. Bumping earlier would let another
+            request cache the rows that are about to change under the new generation.
+        """
+        scopes = list(scopes)
+        transaction.on_commit(lambda: self.bump_generations(scopes), using=using)
+
+
+def _init_generation(key):
+    # Counters start at the current time rather than zero, so that entries
+    # cached before a counter was evicted cannot be mistaken for fresh ones.
+    value = int(time.time() * 1000)
+    if not cache.add(key, value, None):
+        value = cache.get(key, value)
+    return value
+
+
+def get_generations(scopes):
+    """ Returns the current generation for each of the given scopes,
+        using a single round trip to the cache.
+    """
+    return MetadataCache().get_generations(scopes)
+
+
+def bump_generations(scopes):
+    """ Invalidates all entries cached under the given scopes. """
+    MetadataCache().bump_generations(scopes)
+
+
+def invalidate_metadata(sender, instance, **kwargs):
+    """ Callback to be attached to the post_save and post_delete signals
+        of metadata backend models.
+    """
+    instance._metadata._meta.cache.bump_generations_on_commit(instance._get_cache_scopes(), kwargs.get('using'))
+    instance._loaded_path = instance.__dict__.get('_path')
+
+
+def invalidate_snapshot(sender, instance, **kwargs):
+    """ Callback to be attached to the post_save and post_delete signals
+        of metadata backend models, when a snapshot is used.
+    """
+    meta = instance._metadata._meta
+    meta.cache.bump_generations_on_commit([snapshot_scope(meta.name)], kwargs.get('using'))
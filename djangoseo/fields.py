@@ -7,7 +7,7 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils.html import conditional_escape
 
-from djangoseo.utils import escape_tags, NotSet, Literal
+from djangoseo.utils import escape_tags, compile_tags_re, NotSet, Literal
 
 
 VALID_HEAD_TAGS = "head title base link meta script".split()
@@ -46,6 +46,8 @@ class MetadataField(object):
         if valid_tags is not None:
             valid_tags = set(valid_tags)
         self.valid_tags = valid_tags
+        # The tags to reenable when cleaning are compiled once, not on every value
+        self.valid_tags_re = compile_tags_re(self.get_valid_tags())
 
         # Track creation order for field ordering
         self.creation_counter = MetadataField.creation_counter
@@ -82,6 +84,10 @@ class MetadataField(object):
             kwargs.setdefault('verbose_name', self.verbose_name)
         return self.field(**kwargs)
 
+    def get_valid_tags(self):
+        """ Returns the tags that are not escaped when cleaning a value. """
+        return self.valid_tags
+
     def clean(self, value):
         return value
 
@@ -103,8 +109,11 @@ class Tag(MetadataField):
         field_kwargs.setdefault('blank', True)
         super(Tag, self).__init__(name, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
+    def get_valid_tags(self):
+        return self.valid_tags or VALID_INLINE_TAGS
+
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags or VALID_INLINE_TAGS)
+        value = escape_tags(value, self.valid_tags_re)
 
         return value.strip()
 
@@ -131,7 +140,7 @@ class MetaTag(MetadataField):
         super(MetaTag, self).__init__(name, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags)
+        value = escape_tags(value, self.valid_tags_re)
 
         # Replace newlines with spaces
         return value.replace("\n", " ").strip()
@@ -154,12 +163,16 @@ class KeywordTag(MetaTag):
                         field_kwargs, help_text)
 
     def clean(self, value):
-        value = escape_tags(value, self.valid_tags)
+        value = escape_tags(value, self.valid_tags_re)
 
         # Remove double quote, replace newlines with commas
         return value.replace('"', '&#34;').replace("\n", ", ").strip()
 
 
+RAW_BEFORE_TAGS = re.compile("^([^<>]*)<")
+RAW_AFTER_TAGS = re.compile(">([^<>]*)$")
+
+
 # TODO: if max_length is given, use a CharField and pass it through
 class Raw(MetadataField):
     def __init__(self, head=True, editable=True, populate_from=NotSet,
@@ -171,25 +184,24 @@ class Raw(MetadataField):
         field_kwargs.setdefault('blank', True)
         super(Raw, self).__init__(None, head, editable, populate_from, valid_tags, choices, help_text, verbose_name, field, field_kwargs)
 
-    def clean(self, value):
+    def get_valid_tags(self):
         # Find a suitable set of valid tags using self.head and self.valid_tags
         if self.head:
             valid_tags = set(VALID_HEAD_TAGS)
             if self.valid_tags is not None:
                 valid_tags = valid_tags & self.valid_tags
-        else:
-            valid_tags = self.valid_tags
+            return valid_tags
+        return self.valid_tags
 
-        value = escape_tags(value, valid_tags)
+    def clean(self, value):
+        value = escape_tags(value, self.valid_tags_re)
 
         if self.head:
             # Remove text before tags
-            before_tags = re.compile("^([^<>]*)<")
-            value = before_tags.sub('<', value)
+            value = RAW_BEFORE_TAGS.sub('<', value)
 
             # Remove text after tags
-            after_tags = re.compile(">([^<>]*)$")
-            value = after_tags.sub('>', value)
+            value = RAW_AFTER_TAGS.sub('>', value)
 
         return value
 
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoseo.redirects import backfill_redirect_hashes
+
+
+class Command(BaseCommand):
+    help = ("Fill in the path hashes of redirects stored before the hash columns were added. "
+            "Run it once after migrating the redirects table, redirects without a hash are not found.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of redirects updated at a time.")
+
+    def handle(self, *args, **options):
+        from djangoseo.models import Redirect
+
+        if Redirect is None:
+            raise CommandError("Redirects are not enabled, set SEO_USE_REDIRECTS to use them.")
+        count = backfill_redirect_hashes(options['batch_size'])
+        self.stdout.write("Filled in the path hashes of %d redirects." % count)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+import sys
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoseo.management.commands.import_redirects import FORMATS, get_format
+from djangoseo.redirects import REDIRECT_COLUMNS
+
+
+class Command(BaseCommand):
+    help = ("Export redirects to a CSV file with a header row, or a file with a JSON object per line, "
+            "in the format read by import_redirects. Redirects are streamed from the database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="File to write, or - to write to standard output.")
+        parser.add_argument('--format', choices=FORMATS, help="Format of the file, by default its extension.")
+        parser.add_argument('--domain', help="Domain of the site to export the redirects of, by default all sites.")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Number of redirects fetched at a time.")
+
+    def handle(self, *args, **options):
+        from djangoseo.models import Redirect
+
+        if Redirect is None:
+            raise CommandError("Redirects are not enabled, set SEO_USE_REDIRECTS to use them.")
+
+        file_format = get_format(options['file'], options['format'])
+        domains = dict(Site.objects.values_list('pk', 'domain'))
+        redirects = Redirect.objects.order_by('site_id', 'pk')
+        if options['domain']:
+            site_ids = [pk for pk, domain in domains.items() if domain == options['domain']]
+            if not site_ids:
+                raise CommandError("There is no site with the domain %s." % options['domain'])
+            redirects = redirects.filter(site_id=site_ids[0])
+        rows = redirects.values_list('site_id', 'old_path', 'new_path', 'subdomain', 'all_subdomains')
+
+        if options['file'] == '-':
+            count = self.write_rows(sys.stdout, file_format, rows, domains, options['chunk_size'])
+        else:
+            with io.open(options['file'], 'w', encoding='utf-8', newline='') as stream:
+                count = self.write_rows(stream, file_format, rows, domains, options['chunk_size'])
+        if options['file'] != '-':
+            self.stdout.write("Exported %d redirects." % count)
+
+    def write_rows(self, stream, file_format, rows, domains, chunk_size):
+        if file_format == 'csv':
+            writer = csv.writer(stream, lineterminator='\n')
+            writer.writerow(REDIRECT_COLUMNS)
+        count = 0
+        for site_id, old_path, new_path, subdomain, all_subdomains in rows.iterator(chunk_size=chunk_size):
+            values = (domains[site_id], old_path, new_path, subdomain or '', all_subdomains)
+            if file_format == 'csv':
+                writer.writerow(values[:-1] + ('true' if all_subdomains else 'false',))
+            else:
+                stream.write(json.dumps(dict(zip(REDIRECT_COLUMNS, values))) + '\n')
+            count += 1
+        return count
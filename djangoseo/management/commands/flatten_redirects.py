@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoseo.redirects import flatten_redirects
+
+
+class Command(BaseCommand):
+    help = ("Point every redirect straight at the end of its chain of redirects, so that clients never "
+            "follow more than one redirect. Redirects in a cycle are reported and left as they are. "
+            "Redirects are handled in batches, so memory use depends on the batch size and the length "
+            "of the chains, not on the number of redirects.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--domain', help="Domain of the site to flatten the redirects of, by default all sites.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of redirects handled at a time.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be changed.")
+
+    def handle(self, *args, **options):
+        from djangoseo.models import Redirect
+
+        if Redirect is None:
+            raise CommandError("Redirects are not enabled, set SEO_USE_REDIRECTS to use them.")
+
+        sites = Site.objects.order_by('pk')
+        if options['domain']:
+            sites = sites.filter(domain=options['domain'])
+            if not sites:
+                raise CommandError("There is no site with the domain %s." % options['domain'])
+
+        for site in sites:
+            changed, cycles = flatten_redirects(site.pk, options['batch_size'], options['dry_run'])
+            for cycle in cycles:
+                self.stderr.write("Redirect cycle on %s: %s" % (site.domain, ' -> '.join(cycle + cycle[:1])))
+            verb = "Would flatten" if options['dry_run'] else "Flattened"
+            self.stdout.write("%s %d redirects on %s, found %d cycles." % (verb, changed, site.domain, len(cycles)))
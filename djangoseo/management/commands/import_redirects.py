@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+import sys
+from collections import OrderedDict, namedtuple
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from djangoseo.redirects import (REDIRECT_COLUMNS, normalize_old_path, normalize_new_path,
+                                 invalidate_site_redirects)
+from djangoseo.utils import path_hash
+
+
+FORMATS = ('csv', 'jsonl')
+CONFLICTS = ('skip', 'update', 'error')
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('', '0', 'false', 'no', 'off')
+
+# Number of rows between progress reports
+PROGRESS_EVERY = 50000
+
+ExistingRedirect = namedtuple('ExistingRedirect', ('pk', 'new_path', 'subdomain', 'all_subdomains'))
+
+
+def get_format(filename, value):
+    """ Returns the given format, or the format matching the extension of the file. """
+    if value:
+        return value
+    for name in FORMATS:
+        if filename.endswith('.' + name):
+            return name
+    raise CommandError("Cannot tell the format of %s, use --format." % filename)
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = to_text(value).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError("Not a boolean: %r" % value)
+
+
+def to_text(value):
+    return '' if value is None else '%s' % value
+
+
+class Command(BaseCommand):
+    help = ("Import redirects from a CSV file with a header row, or a file with a JSON object per line. "
+            "The columns are %s; only old_path and new_path are required. "
+            "Rows are streamed and written in batches." % ', '.join(REDIRECT_COLUMNS))
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="File to import, or - to read from standard input.")
+        parser.add_argument('--format', choices=FORMATS, help="Format of the file, by default its extension.")
+        parser.add_argument('--domain', help="Domain of the site of rows without one, by default the current site.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of redirects written at a time.")
+        parser.add_argument('--on-conflict', choices=CONFLICTS, default='skip',
+                            help="What to do with redirects from a path that already has one: keep the existing "
+                                 "redirect (skip), replace it (update) or stop (error), keeping the batches already "
+                                 "written. Within a file, the first of several redirects from a path is used, "
+                                 "or the last one with update.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Check the file and report what would be imported, without keeping anything: "
+                                 "the import runs in a transaction that is rolled back.")
+
+    def handle(self, *args, **options):
+        from djangoseo.models import Redirect
+
+        if Redirect is None:
+            raise CommandError("Redirects are not enabled, set SEO_USE_REDIRECTS to use them.")
+        self.redirect_model = Redirect
+        self.options = options
+        self.use_path_hash = Redirect.use_path_hash
+        if options['domain']:
+            try:
+                self.default_site = Site.objects.get(domain=options['domain'])
+            except Site.DoesNotExist:
+                raise CommandError("There is no site with the domain %s." % options['domain'])
+        else:
+            self.default_site = Site.objects.get_current()
+        self.site_ids = dict(Site.objects.values_list('domain', 'pk'))
+        self.stats = OrderedDict((key, 0) for key in ('rows', 'created', 'updated', 'skipped', 'duplicates',
+                                                      'invalid'))
+        # Sites with redirects written by committed batches
+        self.touched_sites = set()
+        # Redirects stored after this one were written by previous batches of this import
+        self.last_existing_pk = Redirect.objects.aggregate(last=Max('pk'))['last'] or 0
+
+        try:
+            if options['dry_run']:
+                # Everything is written as usual and then rolled back, so that the summary is exact
+                with transaction.atomic():
+                    self.import_options_file()
+                    transaction.set_rollback(True)
+            else:
+                self.import_options_file()
+        finally:
+            # Batches written before an error are kept, and must be seen
+            if not options['dry_run']:
+                for site_id in self.touched_sites:
+                    invalidate_site_redirects(site_id)
+        prefix = "Dry run: " if options['dry_run'] else ""
+        self.stdout.write(prefix + self.get_summary())
+
+    def import_options_file(self):
+        if self.options['file'] == '-':
+            self.import_file(sys.stdin, get_format('-', self.options['format']))
+        else:
+            with io.open(self.options['file'], encoding='utf-8', newline='') as stream:
+                self.import_file(stream, get_format(self.options['file'], self.options['format']))
+
+    def get_summary(self):
+        return ("%(rows)d rows, %(created)d created, %(updated)d updated, %(skipped)d skipped, "
+                "%(duplicates)d duplicates, %(invalid)d invalid." % self.stats)
+
+    def read_rows(self, stream, file_format):
+        """ Yields the line number and a dict of the values of each row. """
+        if file_format == 'csv':
+            reader = csv.DictReader(stream)
+            missing = set(('old_path', 'new_path')) - set(reader.fieldnames or ())
+            if missing:
+                raise CommandError("The CSV header lacks the columns %s." % ', '.join(sorted(missing)))
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_num, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    row = e
+                yield line_num, row
+
+    def clean(self, row):
+        """ Returns the values of a redirect from the given row, or raises ValueError. """
+        if isinstance(row, Exception):
+            raise ValueError("Invalid JSON: %s" % row)
+        if not isinstance(row, dict):
+            raise ValueError("Expected an object")
+        domain = to_text(row.get('site')).strip()
+        if domain:
+            try:
+                site_id = self.site_ids[domain]
+            except KeyError:
+                raise ValueError("There is no site with the domain %s" % domain)
+        else:
+            site_id = self.default_site.pk
+        if 'new_path' not in row or row['new_path'] is None:
+            raise ValueError("The new path is missing")
+        return {
+            'site_id': site_id,
+            'old_path': normalize_old_path(row.get('old_path')),
+            'new_path': normalize_new_path(row['new_path']),
+            'subdomain': to_text(row.get('subdomain')).strip(),
+            'all_subdomains': parse_bool(row.get('all_subdomains')),
+        }
+
+    def import_file(self, stream, file_format):
+        batch = OrderedDict()
+        for line_num, row in self.read_rows(stream, file_format):
+            self.stats['rows'] += 1
+            try:
+                redirect = self.clean(row)
+            except ValueError as e:
+                self.stats['invalid'] += 1
+                self.stderr.write("Line %d: %s" % (line_num, e))
+                continue
+            redirect['line'] = line_num
+
+            key = (redirect['site_id'], redirect['old_path'])
+            # Redirects repeated from a previous batch are found in the database, see prepare_batch
+            if key in batch:
+                self.stats['duplicates'] += 1
+                if self.options['on_conflict'] != 'update':
+                    continue
+            batch[key] = redirect
+            if len(batch) >= self.options['batch_size']:
+                self.write_batch(batch)
+                batch = OrderedDict()
+
+            if self.options['verbosity'] > 0 and self.stats['rows'] % PROGRESS_EVERY == 0:
+                self.stdout.write(self.get_summary())
+        if batch:
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        """ Creates the redirects of the given batch, and updates or skips those that already exist. """
+        Redirect = self.redirect_model
+        with transaction.atomic():
+            existing = self.find_existing(batch)
+            new, changed, counted = self.prepare_batch(batch, existing)
+            # Conflicts with redirects created since the lookup above are ignored
+            Redirect.objects.bulk_create(new, ignore_conflicts=True)
+            Redirect.objects.bulk_update(changed, ['new_path', 'new_path_hash', 'subdomain', 'all_subdomains'])
+            # Looked up again, as bulk_create() does not tell which rows it ignored
+            stored = self.find_existing(batch)
+            created = len([redirect for redirect in new if (redirect.site_id, redirect.old_path) in stored
+                           and stored[redirect.site_id, redirect.old_path][1:]
+                           == (redirect.new_path, redirect.subdomain, redirect.all_subdomains)])
+            updated = Redirect.objects.filter(pk__in=counted).count()
+        self.stats['created'] += created
+        self.stats['skipped'] += len(new) - created
+        self.stats['updated'] += updated
+        self.touched_sites.update(site_id for site_id, old_path in batch)
+
+    def find_existing(self, batch):
+        """ Returns the primary key and values of the stored redirects of the given batch, by site and old path. """
+        Redirect = self.redirect_model
+        paths = OrderedDict()
+        for site_id, old_path in batch:
+            paths.setdefault(site_id, []).append(old_path)
+
+        existing = {}
+        for site_id, old_paths in paths.items():
+            lookup = {'site_id': site_id, 'old_path__in': old_paths}
+            if self.use_path_hash:
+                lookup['old_path_hash__in'] = [path_hash(old_path) for old_path in old_paths]
+            rows = Redirect.objects.filter(**lookup).values_list(
+                'old_path', 'pk', 'new_path', 'subdomain', 'all_subdomains')
+            for row in rows:
+                existing[site_id, row[0]] = ExistingRedirect(*row[1:])
+        return existing
+
+    def prepare_batch(self, batch, existing):
+        """ Returns the redirects of the given batch to create and to update, and the primary keys of
+            those to count as updated. Counts those skipped, and those repeated from a previous batch.
+        """
+        Redirect = self.redirect_model
+        new = []
+        changed = []
+        counted = []
+        for key, values in batch.items():
+            if key in existing and existing[key].pk > self.last_existing_pk:
+                # Written by a previous batch: a duplicate, as within a batch
+                self.stats['duplicates'] += 1
+                if self.options['on_conflict'] != 'update':
+                    continue
+                redirect = Redirect(pk=existing[key].pk)
+                changed.append(redirect)
+            elif key in existing:
+                if self.options['on_conflict'] == 'error':
+                    raise CommandError("Line %d: there already is a redirect from %s." % (values['line'], key[1]))
+                if self.options['on_conflict'] == 'skip':
+                    self.stats['skipped'] += 1
+                    continue
+                redirect = Redirect(pk=existing[key].pk)
+                changed.append(redirect)
+                counted.append(redirect.pk)
+            else:
+                redirect = Redirect()
+                new.append(redirect)
+            for name in ('site_id', 'old_path', 'new_path', 'subdomain', 'all_subdomains'):
+                setattr(redirect, name, values[name])
+            # bulk_create() does not call save(), which sets the hashes otherwise
+            if self.use_path_hash:
+                redirect.old_path_hash = path_hash(redirect.old_path)
+            redirect.new_path_hash = path_hash(redirect.new_path)
+        return new, changed, counted
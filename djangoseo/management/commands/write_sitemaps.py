@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import os
+from xml.sax.saxutils import escape
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoseo.sitemaps import MetadataSitemap
+
+
+SITEMAP_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+SITEMAP_FOOTER = '</urlset>\n'
+INDEX_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+INDEX_FOOTER = '</sitemapindex>\n'
+
+
+class Command(BaseCommand):
+    help = ("Write gzipped sitemap files with every path that has metadata, along with a sitemap index. "
+            "Paths are streamed from the database, so memory use does not depend on the number of paths.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help="Directory to write the sitemap files to.")
+        parser.add_argument('--name', help="Name of the metadata definition to use.")
+        parser.add_argument('--backends', default=','.join(MetadataSitemap.backends),
+                            help="Comma separated metadata backends to take the paths from.")
+        parser.add_argument('--domain', help="Domain of the site to list the paths of, by default the current site.")
+        parser.add_argument('--protocol', default='https', help="Protocol of the URLs.")
+        parser.add_argument('--base-url',
+                            help="URL the sitemap files are served from, by default the root of the domain.")
+        parser.add_argument('--limit', type=int, default=50000, help="Maximum number of URLs in a sitemap file.")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Number of paths fetched at a time.")
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if options['domain']:
+            try:
+                site = Site.objects.get(domain=options['domain'])
+            except Site.DoesNotExist:
+                raise CommandError("There is no site with the domain %s." % options['domain'])
+        else:
+            site = Site.objects.get_current()
+        url_prefix = '%s://%s' % (options['protocol'], site.domain)
+        base_url = options['base_url'] or url_prefix + '/'
+        if not base_url.endswith('/'):
+            base_url += '/'
+
+        sitemap = MetadataSitemap(name=options['name'], backends=options['backends'].split(','), site=site)
+        items = sitemap.items()
+        if hasattr(items, 'iterator'):
+            items = items.iterator(chunk_size=options['chunk_size'])
+
+        filenames = []
+        output = None
+        count = 0
+        total = 0
+        for item in items:
+            if output is None or count >= options['limit']:
+                if output is not None:
+                    output.write(SITEMAP_FOOTER)
+                    output.close()
+                filenames.append('sitemap-%d.xml.gz' % (len(filenames) + 1))
+                output = gzip.open(os.path.join(directory, filenames[-1]), 'wt', encoding='utf-8')
+                output.write(SITEMAP_HEADER)
+                count = 0
+            output.write('<url><loc>%s</loc></url>\n' % escape(url_prefix + sitemap.location(item)))
+            count += 1
+            total += 1
+        if output is not None:
+            output.write(SITEMAP_FOOTER)
+            output.close()
+
+        with open(os.path.join(directory, 'sitemap.xml'), 'w') as index:
+            index.write(INDEX_HEADER)
+            for filename in filenames:
+                index.write('<sitemap><loc>%s</loc></sitemap>\n' % escape(base_url + filename))
+            index.write(INDEX_FOOTER)
+
+        self.stdout.write("Wrote %d URLs to %d sitemap files." % (total, len(filenames)))
@@ -8,7 +8,8 @@ from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ImproperlyConfigured
 
 from .models import Redirect
-from .utils import handle_seo_redirects
+from .utils import handle_seo_redirects, redirect_lookup
+from .redirects import get_redirect_index, may_redirect
 
 
 logger = getLogger(__name__)
@@ -65,25 +66,41 @@ class RedirectFallbackMiddleware(MiddlewareMixin):
             return response
 
         subdomain = getattr(request, 'subdomain', '')
-        full_path = request.get_full_path()
         current_site = get_current_site(request)
 
-        redirect = Redirect.objects.filter(
-            Q(site=current_site),
-            Q(old_path=full_path),
-            Q(subdomain=subdomain) | Q(all_subdomains=True)
-        ).order_by('all_subdomains').first()
+        # Most 404s have no redirect, which the Bloom filter can tell without a query
+        if (getattr(settings, 'SEO_REDIRECT_BLOOM_FILTER', False)
+                and not getattr(settings, 'SEO_REDIRECT_INDEX', False)
+                and not may_redirect(current_site.id, request.get_full_path())):
+            return response
 
-        if redirect is None and settings.APPEND_SLASH and not request.path.endswith('/'):
-            redirect = Redirect.objects.filter(
-                Q(site=current_site),
-                Q(old_path=request.get_full_path(force_append_slash=True)),
-                Q(subdomain=subdomain) | Q(all_subdomains=True)
-            ).order_by('all_subdomains').first()
-        if redirect is not None:
-            if redirect.new_path == '':
+        paths = [request.get_full_path()]
+        if settings.APPEND_SLASH and not request.path.endswith('/'):
+            paths.append(request.get_full_path(force_append_slash=True))
+
+        new_path = None
+        for path in paths:
+            new_path = self.get_new_path(current_site, subdomain, path)
+            if new_path is not None:
+                break
+        if new_path is not None:
+            if new_path == '':
                 return self.response_gone_class()
-            return self.response_redirect_class(redirect.new_path)
+            return self.response_redirect_class(new_path)
 
         # No redirect was found. Return the response.
         return response
+
+    def get_new_path(self, site, subdomain, path):
+        """ Returns the path the given path redirects to, or None if there is no redirect. """
+        if getattr(settings, 'SEO_REDIRECT_INDEX', False):
+            return get_redirect_index(site.id).get(path, subdomain)
+
+        redirect = Redirect.objects.filter(
+            Q(site=site),
+            Q(**redirect_lookup(path)),
+            Q(subdomain=subdomain) | Q(all_subdomains=True)
+        ).order_by('all_subdomains').first()
+        if redirect is not None:
+            return redirect.new_path
+        return None
@@ -7,7 +7,8 @@ from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.contrib import admin
 
-from .utils import create_dynamic_model, register_model_in_admin
+from .utils import create_dynamic_model, register_model_in_admin, path_hash
+from .redirects import invalidate_redirects, invalidate_redirect_patterns
 
 
 RedirectPattern = None
@@ -77,52 +78,14 @@ def setup():
             'search_fields': ['redirect_path'],
         })
 
-        class RedirectMeta:
-            verbose_name = _('redirect')
-            verbose_name_plural = _('redirects')
-            unique_together = (('site', 'old_path'),)
-            ordering = ('old_path',)
+        # Long paths can be looked up by a fixed width hash, rather than indexing the full path
+        Redirect = create_redirect_model('Redirect', getattr(settings, 'SEO_REDIRECT_PATH_HASH', False))
 
-        def redirect_str_method(self):
-            return '%s -> %s' % (self.old_path, self.new_path)
-
-        from django.contrib.sites.models import Site
-
-        Redirect = create_dynamic_model('Redirect', **{
-            'site': models.ForeignKey(
-                to=Site,
-                on_delete=models.CASCADE,
-                verbose_name=_('site'),
-                related_name='seo_redirect'
-            ),
-            # A fixed length of two thousand characters is needed to support IE and other browsers.
-            'old_path': models.CharField(
-                verbose_name=_('redirect from'),
-                max_length=2000,
-                db_index=True,
-                help_text=_("This should be an absolute path, excluding the domain name. Example: '/events/search/'."),
-            ),
-            'new_path': models.CharField(
-                verbose_name=_('redirect to'),
-                max_length=2000,
-                blank=True,
-                help_text=_("This can be either an absolute path (as above) or a full URL starting with 'http://'."),
-            ),
-            'subdomain': models.CharField(
-                verbose_name=_('subdomain'),
-                max_length=250,
-                blank=True,
-                null=True,
-                default=''
-            ),
-            'all_subdomains': models.BooleanField(
-                verbose_name=_('all subdomains'),
-                default=False,
-                help_text=_('Will works for all subdomains')
-            ),
-            '__str__': redirect_str_method,
-            'Meta': RedirectMeta
-        })
+        # Keep the redirect indexes and pattern matchers of each process up to date
+        models.signals.post_save.connect(invalidate_redirects, sender=Redirect, weak=False)
+        models.signals.post_delete.connect(invalidate_redirects, sender=Redirect, weak=False)
+        models.signals.post_save.connect(invalidate_redirect_patterns, sender=RedirectPattern, weak=False)
+        models.signals.post_delete.connect(invalidate_redirect_patterns, sender=RedirectPattern, weak=False)
 
         RedirectAdmin = type('RedirectAdmin', (admin.ModelAdmin,), {
             'list_display': ('old_path', 'new_path'),
@@ -136,3 +99,71 @@ def setup():
 
     from djangoseo.base import register_signals
     register_signals()
+
+
+def create_redirect_model(model_name, use_path_hash=False, app_label='djangoseo'):
+    """ Creates the model of redirects. Whether paths are looked up by their hash is
+        decided here once, and kept in the use_path_hash attribute of the model.
+        Redirects are always found by their target through its hash, see redirect_target_filter.
+    """
+    from django.contrib.sites.models import Site
+
+    class RedirectMeta:
+        verbose_name = _('redirect')
+        verbose_name_plural = _('redirects')
+        unique_together = (('site', 'old_path_hash', 'old_path') if use_path_hash else ('site', 'old_path'),)
+        ordering = ('old_path',)
+
+    def redirect_str_method(self):
+        return '%s -> %s' % (self.old_path, self.new_path)
+
+    def redirect_save_method(self, *args, **kwargs):
+        if use_path_hash:
+            self.old_path_hash = path_hash(self.old_path)
+        self.new_path_hash = path_hash(self.new_path)
+        super(model, self).save(*args, **kwargs)
+
+    model = create_dynamic_model(model_name, app_label=app_label, **{
+        'site': models.ForeignKey(
+            to=Site,
+            on_delete=models.CASCADE,
+            verbose_name=_('site'),
+            related_name='seo_%s' % model_name.lower()
+        ),
+        # A fixed length of two thousand characters is needed to support IE and other browsers.
+        'old_path': models.CharField(
+            verbose_name=_('redirect from'),
+            max_length=2000,
+            db_index=not use_path_hash,
+            help_text=_("This should be an absolute path, excluding the domain name. Example: '/events/search/'."),
+        ),
+        'new_path': models.CharField(
+            verbose_name=_('redirect to'),
+            max_length=2000,
+            blank=True,
+            help_text=_("This can be either an absolute path (as above) or a full URL starting with 'http://'."),
+        ),
+        'subdomain': models.CharField(
+            verbose_name=_('subdomain'),
+            max_length=250,
+            blank=True,
+            null=True,
+            default=''
+        ),
+        'all_subdomains': models.BooleanField(
+            verbose_name=_('all subdomains'),
+            default=False,
+            help_text=_('Will works for all subdomains')
+        ),
+        'use_path_hash': use_path_hash,
+        '__str__': redirect_str_method,
+        'save': redirect_save_method,
+        'Meta': RedirectMeta
+    })
+    if use_path_hash:
+        # Null until filled in by save() or the backfill_redirect_hashes command,
+        # so that the column can be added to an existing table
+        model.add_to_class('old_path_hash', models.BigIntegerField(null=True, editable=False))
+    # Indexed instead of new_path, which is too long for a good index
+    model.add_to_class('new_path_hash', models.BigIntegerField(null=True, editable=False, db_index=True))
+    return model
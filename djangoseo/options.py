@@ -10,6 +10,9 @@ try:
 except ImportError:
     from django.db.models.options import get_verbose_name as camel_case_to_spaces
 from django.db import models
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from djangoseo.cache import LocalCache, MetadataCache, invalidate_metadata, invalidate_snapshot
 
 
 class Options(object):
@@ -19,6 +22,15 @@ class Options(object):
         self.use_subdomains = meta.pop('use_subdomains', False)
         self.use_redirect = meta.pop('use_redirect', False)
         self.use_cache = meta.pop('use_cache', False)
+        self.cache_mode = meta.pop('cache_mode', 'field')
+        self.cache_timeout = meta.pop('cache_timeout', DEFAULT_TIMEOUT)
+        self.local_cache_size = meta.pop('local_cache_size', 0)
+        self.local_cache_timeout = meta.pop('local_cache_timeout', 5)
+        self.use_union_lookup = meta.pop('use_union_lookup', False)
+        self.store_rendered = meta.pop('store_rendered', False)
+        self.use_path_hash = meta.pop('use_path_hash', False)
+        self.path_max_length = meta.pop('path_max_length', 255)
+        self.use_snapshot = meta.pop('use_snapshot', False)
         self.groups = meta.pop('groups', {})
         self.seo_views = meta.pop('seo_views', [])
         self.verbose_name = meta.pop('verbose_name', None)
@@ -27,7 +39,12 @@ class Options(object):
         self._set_seo_models(meta.pop('seo_models', []))
         self.bulk_help_text = help_text
         self.original_meta = meta
+        if self.local_cache_size:
+            self.cache = MetadataCache(LocalCache(self.local_cache_size, self.local_cache_timeout))
+        else:
+            self.cache = MetadataCache()
         self.models = OrderedDict()
+        self.snapshot = None
         self.name = None
         self.elements = None
         self.metadata = None
@@ -60,6 +77,10 @@ class Options(object):
                     field.help_text = self.bulk_help_text.get(key)
                 fields[key] = field
 
+        # Cleaned and rendered values, stored when an instance is saved
+        if self.store_rendered:
+            fields['_rendered'] = models.TextField(default='', blank=True, editable=False)
+
         # 0. Abstract base model with common fields
         base_meta = type('Meta', (), self.original_meta)
 
@@ -75,7 +96,8 @@ class Options(object):
     def _add_backend(self, backend):
         """ Builds a subclass model for the given backend """
         md_type = backend.verbose_name
-        base = backend().get_model(self)
+        backend = backend()
+        base = backend.get_model(self)
         # TODO: Rename this field
         new_md_attrs = {'_metadata': self.metadata, '__module__': __name__}
 
@@ -83,14 +105,29 @@ class Options(object):
         new_md_meta['verbose_name'] = '%s (%s)' % (self.verbose_name, md_type)
         new_md_meta['verbose_name_plural'] = '%s (%s)' % (self.verbose_name_plural, md_type)
         new_md_meta['unique_together'] = base._meta.unique_together
+        new_md_meta['indexes'] = [index.clone() for index in base._meta.indexes]
         new_md_attrs['Meta'] = type("Meta", (), new_md_meta)
         new_md_attrs['_metadata_type'] = backend.name
+        new_md_attrs['_backend'] = backend
 
         if six.PY2:
             md_type = str(md_type)
 
         model = type("%s%s" % (self.name, "".join(md_type.split())), (base, self.MetadataBaseModel), new_md_attrs.copy())
         self.models[backend.name] = model
+
+        # Invalidate cached values whenever metadata is changed
+        if self.use_cache:
+            models.signals.post_save.connect(invalidate_metadata, sender=model, weak=False)
+            models.signals.post_delete.connect(invalidate_metadata, sender=model, weak=False)
+
+        # Refresh the snapshot whenever metadata is changed
+        if self.use_snapshot:
+            models.signals.post_save.connect(invalidate_snapshot, sender=model, weak=False)
+            models.signals.post_delete.connect(invalidate_snapshot, sender=model, weak=False)
+
+        backend.register(model, self)
+
         # This is a little dangerous, but because we set __module__ to __name__, the model needs tobe accessible here
         globals()[model.__name__] = model
 
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+""" In-process indexes of redirects and redirect patterns, so that 404 responses
+    can be checked for a redirect without querying the database.
+
+    The redirects of a site are loaded the first time they are needed. Saving
+    or deleting a redirect bumps the generation of the site's redirect scope,
+    after which the redirects are loaded again on the next lookup.
+    Redirect patterns are handled the same way.
+
+    Alternatively, a Bloom filter of the old paths of a site's redirects can be kept
+    in the shared cache, so that most paths without a redirect need no query either.
+"""
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.utils.encoding import iri_to_uri
+from six.moves.urllib.parse import urlsplit, urlunsplit
+
+from djangoseo.cache import LocalCache, MetadataCache, redirect_scope, redirect_pattern_scope
+from djangoseo.utils import path_hash
+
+logger = logging.getLogger(__name__)
+
+
+# Generations are kept locally for a few seconds, changes made by other processes are seen after that
+redirect_cache = MetadataCache(LocalCache(1000, 5))
+
+_indexes = {}
+_matchers = {}
+_bloom_filters = {}
+_lock = threading.Lock()
+
+BLOOM_FILTER_KEY = 'djangoseo.redirect_bloom.%s'
+BLOOM_FILTER_LOCK_KEY = 'djangoseo.redirect_bloom_lock.%s'
+# Seconds before a filter is built again, after it could not be built or stored
+BLOOM_FILTER_RETRY_DELAY = 300
+
+# Numbered backreferences would point to the wrong group once patterns are combined
+NUMBERED_BACKREFERENCE = re.compile(r'(?<!\\)\\(?:[1-9]|g<\d)')
+
+
+class RedirectIndex(object):
+    """ All redirects of a site, by old path. """
+
+    def __init__(self, site_id, generation):
+        from djangoseo.models import Redirect
+
+        self.generation = generation
+        rows = Redirect.objects.filter(site_id=site_id).values_list(
+            'old_path', 'subdomain', 'all_subdomains', 'new_path')
+        self.paths = dict((row[0], row[1:]) for row in rows.iterator())
+
+    def get(self, path, subdomain=''):
+        """ Returns the new path of the redirect from the given path, or None if there is none. """
+        try:
+            redirect_subdomain, all_subdomains, new_path = self.paths[path]
+        except KeyError:
+            return None
+        if all_subdomains or redirect_subdomain == subdomain:
+            return new_path
+        return None
+
+
+def get_redirect_index(site_id):
+    """ Returns the redirect index of the given site, loading it again if a redirect has changed. """
+    generation = redirect_cache.get_generations([redirect_scope(site_id)])[0]
+    index = _indexes.get(site_id)
+    if index is None or index.generation != generation:
+        with _lock:
+            index = _indexes.get(site_id)
+            if index is None or index.generation != generation:
+                index = _indexes[site_id] = RedirectIndex(site_id, generation)
+    return index
+
+
+def invalidate_redirects(sender, instance, **kwargs):
+    """ Callback to be attached to the post_save and post_delete signals of redirects. """
+    invalidate_site_redirects(instance.site_id, kwargs.get('using'))
+
+
+def invalidate_site_redirects(site_id, using=None):
+    """ Marks everything loaded from the redirects of the given site as out of date, once the
+        current transaction is committed. Needed after changes that do not send signals, such as
+        update() and bulk_create(). This covers the redirect index and the Bloom filter.
+    """
+    redirect_cache.bump_generations_on_commit([redirect_scope(site_id)], using)
+
+
+def flatten_redirects(site_id, batch_size=1000, dry_run=False):
+    """ Points every redirect of the given site straight at the end of its chain, so that clients
+        never follow more than one redirect. Chains only continue through redirects that apply to
+        every subdomain the redirect before them applies to, and only through paths, not full URLs.
+        Redirects that are part of a cycle, or lead into one, are left as they are.
+        Redirects are handled batch_size at a time, following the chains of a batch together,
+        one query per hop, so that memory does not grow with the number of redirects.
+        Returns the number of redirects changed, and the list of cycles found.
+    """
+    from djangoseo.models import Redirect
+
+    count = 0
+    cycles = []
+    found_cycles = set()
+    last_pk = 0
+    while True:
+        batch = list(Redirect.objects.filter(site_id=site_id, pk__gt=last_pk).order_by('pk').values_list(
+            'pk', 'old_path', 'new_path', 'subdomain', 'all_subdomains')[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        changed = []
+        for pk, new_path, target, cycle in _follow_chains(Redirect, site_id, batch):
+            if cycle:
+                # Each redirect of a cycle, and each leading into it, finds the same cycle
+                start = cycle.index(min(cycle))
+                cycle = cycle[start:] + cycle[:start]
+                if tuple(cycle) not in found_cycles:
+                    found_cycles.add(tuple(cycle))
+                    cycles.append(cycle)
+            elif target != new_path:
+                changed.append(Redirect(pk=pk, new_path=target, new_path_hash=path_hash(target)))
+        count += len(changed)
+        if changed and not dry_run:
+            Redirect.objects.bulk_update(changed, ['new_path', 'new_path_hash'])
+    if count and not dry_run:
+        invalidate_site_redirects(site_id)
+    return count, cycles
+
+
+def _follow_chains(model, site_id, batch):
+    """ Follows the chains of the given redirects to their end. Yields the primary key, new path,
+        target and cycle of each redirect, where the cycle is None unless the chain ends in one.
+    """
+    hops = {}
+    # The chain so far, the path reached and the subdomain (None for all) of each redirect
+    active = [(pk, new_path, [old_path], new_path, None if all_subdomains else subdomain)
+              for pk, old_path, new_path, subdomain, all_subdomains in batch]
+    while active:
+        missing = set(path for pk, new_path, chain, path, subdomain in active
+                      if path.startswith('/') and path not in hops)
+        if missing:
+            hops.update((path, None) for path in missing)
+            lookup = {'site_id': site_id, 'old_path__in': missing}
+            if model.use_path_hash:
+                lookup['old_path_hash__in'] = [path_hash(path) for path in missing]
+            rows = model.objects.filter(**lookup).values_list('old_path', 'new_path', 'subdomain', 'all_subdomains')
+            for old_path, new_path, subdomain, all_subdomains in rows:
+                hops[old_path] = (new_path, subdomain, all_subdomains)
+
+        following_active = []
+        for pk, new_path, chain, path, subdomain in active:
+            hop = hops.get(path) if path.startswith('/') else None
+            if hop is None or not (hop[2] or subdomain is not None and hop[1] == subdomain):
+                yield pk, new_path, path, None
+            elif path in chain:
+                yield pk, new_path, None, chain[chain.index(path):]
+            else:
+                following_active.append((pk, new_path, chain + [path], hop[0], subdomain))
+        active = following_active
+
+
+def backfill_redirect_hashes(batch_size=1000, model=None):
+    """ Fills in the path hashes of redirects stored before the hash columns were added, which
+        cannot be found by their path (with SEO_REDIRECT_PATH_HASH) or by their target until then.
+        Returns the number of redirects updated.
+    """
+    if model is None:
+        from djangoseo.models import Redirect as model
+    fields = ['old_path_hash', 'new_path_hash'] if model.use_path_hash else ['new_path_hash']
+    missing = Q()
+    for field in fields:
+        missing |= Q(**{'%s__isnull' % field: True})
+
+    count = 0
+    site_ids = set()
+    last_pk = 0
+    while True:
+        batch = list(model.objects.filter(missing, pk__gt=last_pk).order_by('pk').only(
+            'pk', 'site', 'old_path', 'new_path')[:batch_size])
+        if not batch:
+            break
+        for redirect in batch:
+            if model.use_path_hash:
+                redirect.old_path_hash = path_hash(redirect.old_path)
+            redirect.new_path_hash = path_hash(redirect.new_path)
+            site_ids.add(redirect.site_id)
+        model.objects.bulk_update(batch, fields)
+        count += len(batch)
+        last_pk = batch[-1].pk
+    for site_id in site_ids:
+        invalidate_site_redirects(site_id)
+    return count
+
+
+class PatternMatcher(object):
+    """ Redirect patterns compiled into combined regexes, with one named group around each pattern.
+        Alternatives are tried in order, so the first matching pattern wins, as when matching them
+        one after another. Patterns are combined in chunks, as the regex engine saves every group
+        of a regex at each alternative, which makes very long alternations slow.
+        Patterns that cannot be combined, eg because they reuse a group name,
+        are matched on their own instead.
+    """
+    chunk_size = 25
+
+    def __init__(self, patterns, generation=None):
+        self.generation = generation
+        self.patterns = list(patterns)
+        # (regex, index of the first pattern, whether the regex combines several patterns)
+        self.chunks = []
+        for start in range(0, len(self.patterns), self.chunk_size):
+            chunk = self.patterns[start:start + self.chunk_size]
+            regex = None
+            if not any(NUMBERED_BACKREFERENCE.search(pattern['url_pattern']) for pattern in chunk):
+                try:
+                    regex = re.compile('|'.join('(?P<_seo_rp%d>%s)' % (i, pattern['url_pattern'])
+                                                for i, pattern in enumerate(chunk)))
+                except re.error:
+                    pass
+            if regex is not None:
+                self.chunks.append((regex, start, True))
+                continue
+            for index, pattern in enumerate(chunk, start):
+                try:
+                    self.chunks.append((re.compile(pattern['url_pattern']), index, False))
+                except re.error:
+                    logger.warning('Invalid redirect pattern %r', pattern['url_pattern'])
+
+    def match(self, path):
+        """ Returns the first pattern matching the start of the given path, or None. """
+        for regex, index, combined in self.chunks:
+            match = regex.match(path)
+            if match is not None:
+                if combined:
+                    index += int(match.lastgroup[len('_seo_rp'):])
+                return self.patterns[index]
+        return None
+
+
+def get_pattern_matcher(site_id, subdomain=''):
+    """ Returns the matcher of the redirect patterns of the given site and subdomain,
+        compiling it again if a pattern of the site has changed.
+        Patterns for the subdomain come before those for all subdomains.
+    """
+    from djangoseo.models import RedirectPattern
+
+    generation = redirect_cache.get_generations([redirect_pattern_scope(site_id)])[0]
+    key = (site_id, subdomain)
+    matcher = _matchers.get(key)
+    if matcher is None or matcher.generation != generation:
+        with _lock:
+            matcher = _matchers.get(key)
+            if matcher is None or matcher.generation != generation:
+                patterns = RedirectPattern.objects.filter(
+                    Q(site_id=site_id),
+                    Q(subdomain=subdomain) | Q(all_subdomains=True)
+                ).order_by('all_subdomains', 'pk').values('url_pattern', 'redirect_path', 'subdomain',
+                                                          'all_subdomains')
+                matcher = _matchers[key] = PatternMatcher(patterns, generation)
+    return matcher
+
+
+def invalidate_redirect_patterns(sender, instance, **kwargs):
+    """ Callback to be attached to the post_save and post_delete signals of redirect patterns. """
+    redirect_cache.bump_generations_on_commit([redirect_pattern_scope(instance.site_id)], kwargs.get('using'))
+
+
+class BloomFilter(object):
+    """ A set of strings that can only tell for sure that a string is not in it.
+        A string that was not added is reported as present with the given error rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Two halves of a single digest are combined into as many hashes as needed
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def bloom_filter_keys(old_path):
+    """ Returns the strings added to a Bloom filter for a redirect from the given path:
+        the path itself, and the path without a trailing slash, as requests for it
+        are also redirected when APPEND_SLASH is on. A request then needs a single check.
+    """
+    keys = [old_path]
+    path, sep, query = old_path.partition('?')
+    if len(path) > 1 and path.endswith('/'):
+        keys.append(path[:-1] + sep + query)
+    return keys
+
+
+def build_bloom_filter(site_id):
+    """ Builds the Bloom filter of the redirects of the given site and keeps it in this process.
+        Returns the generation of the redirects it was built from, and the filter.
+    """
+    from djangoseo.models import Redirect
+
+    started = time.time()
+    generation = redirect_cache.get_generations([redirect_scope(site_id)])[0]
+    redirects = Redirect.objects.filter(site_id=site_id).order_by()
+    bloom_filter = BloomFilter(redirects.count() * 2, getattr(settings, 'SEO_REDIRECT_BLOOM_ERROR_RATE', 0.01))
+    for old_path in redirects.values_list('old_path', flat=True).iterator(chunk_size=10000):
+        for key in bloom_filter_keys(old_path):
+            bloom_filter.add(key)
+    loaded = _bloom_filters[site_id] = (generation, bloom_filter)
+    logger.info('Built the redirect Bloom filter of site %s: %d KB in %.1f ms',
+                site_id, len(bloom_filter.bits) // 1024, (time.time() - started) * 1000)
+    return loaded
+
+
+def store_bloom_filter(site_id, loaded):
+    """ Stores a Bloom filter returned by build_bloom_filter in the shared cache, for the other processes.
+        Returns whether it was stored: some cache backends silently drop values that are too large,
+        eg memcached those over 1 MB by default.
+    """
+    key = BLOOM_FILTER_KEY % site_id
+    cache.set(key, loaded, None)
+    if not cache.has_key(key):
+        logger.warning('The redirect Bloom filter of site %s (%d KB) could not be stored in the cache, '
+                       'other processes look up redirects in the database', site_id, len(loaded[1].bits) // 1024)
+        return False
+    return True
+
+
+def _build_bloom_filter_in_background(site_id):
+    def build():
+        stored = False
+        try:
+            stored = store_bloom_filter(site_id, build_bloom_filter(site_id))
+        except Exception:
+            logger.exception('Failed to build the redirect Bloom filter')
+        finally:
+            if stored:
+                cache.delete(BLOOM_FILTER_LOCK_KEY % site_id)
+            else:
+                # Keep the lock for a while, rather than building the filter again on every request
+                cache.set(BLOOM_FILTER_LOCK_KEY % site_id, True, BLOOM_FILTER_RETRY_DELAY)
+            connection.close()
+
+    # Only one process builds the filter at a time, the others keep querying until it is ready
+    if cache.add(BLOOM_FILTER_LOCK_KEY % site_id, True, BLOOM_FILTER_RETRY_DELAY):
+        thread = threading.Thread(target=build, name='djangoseo-redirect-bloom-%s' % site_id)
+        thread.daemon = True
+        thread.start()
+
+
+def may_redirect(site_id, path):
+    """ Returns False if there is certainly no redirect from the given path, either as it is
+        or with a slash appended. Returns True if there may be one, or if this is not known
+        because the Bloom filter of the site is out of date and is being built again.
+    """
+    generation = redirect_cache.get_generations([redirect_scope(site_id)])[0]
+    loaded = _bloom_filters.get(site_id)
+    if loaded is None or loaded[0] != generation:
+        loaded = cache.get(BLOOM_FILTER_KEY % site_id)
+        if loaded is None or loaded[0] != generation:
+            _build_bloom_filter_in_background(site_id)
+            return True
+        _bloom_filters[site_id] = loaded
+    return path in loaded[1]
+
+
+# Columns of imported and exported redirects
+REDIRECT_COLUMNS = ('site', 'old_path', 'new_path', 'subdomain', 'all_subdomains')
+
+# Length of the path columns of redirects
+REDIRECT_PATH_MAX_LENGTH = 2000
+
+
+def normalize_old_path(value):
+    """ Returns the given path in the form it is looked up in, as the path and query of a request.
+        Full URLs are reduced to their path. Raises ValueError for anything else.
+    """
+    value = (value or '').strip()
+    parts = urlsplit(value)
+    if parts.scheme in ('http', 'https'):
+        value = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    elif parts.scheme or parts.netloc or not value.startswith('/'):
+        raise ValueError("The old path must be an absolute path or URL: %r" % value)
+    else:
+        value = urlunsplit(('', '', parts.path, parts.query, ''))
+    value = iri_to_uri(value)
+    if len(value) > REDIRECT_PATH_MAX_LENGTH:
+        raise ValueError("The old path is longer than %d characters" % REDIRECT_PATH_MAX_LENGTH)
+    return value
+
+
+def normalize_new_path(value):
+    """ Returns the given redirect target, which can be an absolute path, a full URL,
+        or empty for paths that are gone. Raises ValueError for anything else.
+    """
+    value = (value or '').strip()
+    parts = urlsplit(value)
+    is_path = not parts.scheme and not parts.netloc and value.startswith('/')
+    if value and not is_path and parts.scheme not in ('http', 'https'):
+        raise ValueError("The new path must be an absolute path or URL: %r" % value)
+    value = iri_to_uri(value)
+    if len(value) > REDIRECT_PATH_MAX_LENGTH:
+        raise ValueError("The new path is longer than %d characters" % REDIRECT_PATH_MAX_LENGTH)
+    return value
@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
-from djangoseo.base import Metadata, Tag, KeywordTag, MetaTag, Raw, Literal, get_metadata, get_linked_metadata
+from djangoseo.base import Metadata, Tag, KeywordTag, MetaTag, Raw, Literal, get_metadata, get_linked_metadata, \
+    get_metadata_many, get_linked_metadata_many, aget_metadata, aget_linked_metadata
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.contrib.sitemaps import Sitemap
+
+from djangoseo.base import _get_metadata_model
+
+
+class MetadataSitemap(Sitemap):
+    """ A sitemap of every path that has metadata, for use with django.contrib.sitemaps.
+        Only the paths are selected, so large tables can be paginated (or streamed
+        by the write_sitemaps command) without loading any metadata instances.
+    """
+    backends = ('path', 'modelinstance')
+
+    def __init__(self, name=None, backends=None, site=None, language=None, subdomain=None):
+        self.metadata = _get_metadata_model(name)
+        if backends is not None:
+            self.backends = backends
+        self.site = site
+        self.language = language
+        self.subdomain = subdomain
+
+    def items(self):
+        querysets = []
+        for backend in self.backends:
+            model = self.metadata._meta.get_model(backend)
+            if model is None:
+                continue
+            queryset = model.objects.by_params(self.site, self.language, self.subdomain)
+            querysets.append(queryset.exclude(_path='').order_by().values_list('_path', flat=True))
+        if not querysets:
+            return []
+        # A path with metadata in several backends is only listed once
+        if len(querysets) > 1:
+            queryset = querysets[0].union(*querysets[1:])
+        else:
+            queryset = querysets[0].distinct()
+        return queryset.order_by('_path')
+
+    def location(self, item):
+        return item
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" In-process snapshots of all metadata of a definition.
+
+    A snapshot holds every instance of every backend in read only dicts, keyed
+    by the value get_instances looks up, so instances are found without a query.
+    A snapshot is never changed once it is built. When the generation of the
+    definition's snapshot scope changes, a new snapshot is built and replaces
+    the old one in a single assignment.
+
+    The objects of model instance metadata are part of the snapshot too, so
+    saving or deleting one of them also refreshes it.
+"""
+import copy
+import functools
+import logging
+import sys
+import threading
+import time
+from types import MappingProxyType
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import signals
+
+from djangoseo.backends import filter_instances
+from djangoseo.cache import snapshot_scope
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+class Snapshot(object):
+    """ All instances of the backends of a metadata definition, grouped by lookup key.
+        The number of instances, their approximate size in bytes and the time taken
+        to load them are kept in count, size and load_time.
+    """
+
+    def __init__(self, metadata, generation):
+        started = time.time()
+        self.generation = generation
+        self.count = 0
+        self.size = 0
+        tables = {}
+        content_type_ids = set()
+        for name, model in metadata._meta.models.items():
+            backend = model._backend
+            if backend.in_memory:
+                continue
+            attname = model._meta.get_field(backend.lookup_fields[0]).attname
+            attnames = [field.attname for field in model._meta.concrete_fields]
+            grouped = {}
+            queryset = model._default_manager.get_queryset().order_by('pk')
+            if backend.name == 'modelinstance':
+                queryset = queryset.prefetch_related('_content_object')
+            for instance in queryset:
+                grouped.setdefault(getattr(instance, attname), []).append(instance)
+                if backend.name == 'modelinstance':
+                    content_type_ids.add(instance._content_type_id)
+                self.count += 1
+                self.size += sys.getsizeof(instance) + sys.getsizeof(instance.__dict__)
+                self.size += sum(sys.getsizeof(getattr(instance, a)) for a in attnames)
+            tables[name] = MappingProxyType(dict((key, tuple(instances)) for key, instances in grouped.items()))
+        self.tables = MappingProxyType(tables)
+        for content_type_id in content_type_ids:
+            content_model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if content_model is not None:
+                watch_content_model(metadata, content_model)
+        self.load_time = time.time() - started
+        logger.info("Loaded metadata snapshot for %s: %d instances, about %d KB, in %.1f ms",
+                    metadata._meta.name, self.count, self.size // 1024, self.load_time * 1000)
+
+    def get_instances(self, model, path, context, site=None, language=None, subdomain=None):
+        """ Returns copies of the instances get_instances would return for the given model,
+            so that each lookup can give them its own context.
+        """
+        backend = model._backend
+        if backend.name not in self.tables:
+            return model.objects.get_instances(path=path, site=site, language=language,
+                                               subdomain=subdomain, context=context) or []
+        key = backend.get_lookup_key(path, context)
+        if key is None:
+            return []
+        instances = filter_instances(self.tables[backend.name].get(key, ()), model._metadata._meta,
+                                     site, language, subdomain)
+        return [copy.copy(instance) for instance in instances]
+
+
+def invalidate_content_object(metadata, sender, **kwargs):
+    """ Callback attached to the post_save and post_delete signals of the models
+        of content objects in a snapshot, which is then built again.
+    """
+    meta = metadata._meta
+    meta.cache.bump_generations_on_commit([snapshot_scope(meta.name)], kwargs.get('using'))
+
+
+def watch_content_model(metadata, model):
+    """ Refreshes the snapshot of the given metadata definition when objects of the given model change. """
+    callback = functools.partial(invalidate_content_object, metadata)
+    uid = 'djangoseo.snapshot.%s.%s' % (metadata._meta.name, model._meta.label)
+    signals.post_save.connect(callback, sender=model, weak=False, dispatch_uid=uid)
+    signals.post_delete.connect(callback, sender=model, weak=False, dispatch_uid=uid)
+
+
+def get_snapshot(metadata):
+    """ Returns the snapshot of the given metadata definition, building a new one
+        if anything has changed since the current one was built.
+    """
+    meta = metadata._meta
+    generation = meta.cache.get_generations([snapshot_scope(meta.name)])[0]
+    snapshot = meta.snapshot
+    if snapshot is None or snapshot.generation != generation:
+        with _lock:
+            snapshot = meta.snapshot
+            if snapshot is None or snapshot.generation != generation:
+                snapshot = meta.snapshot = Snapshot(metadata, generation)
+    return snapshot
@@ -54,6 +54,42 @@ class MetadataNode(template.Node):
             except VariableDoesNotExist:
                 pass
 
+        # Metadata is shared by all calls with the same arguments while rendering a request
+        memo = self.get_request_memo(context)
+        memo_key = (self.metadata_name, path, tuple(sorted(kwargs.items())))
+        if hasattr(target, 'pk'):
+            memo_key += (target.__class__, target.pk)
+        try:
+            hash(memo_key)
+        except TypeError:
+            memo = None
+        if memo is not None and memo_key in memo:
+            metadata = memo[memo_key]
+        else:
+            metadata = self.get_metadata(context, target, path, kwargs)
+            if memo is not None:
+                memo[memo_key] = metadata
+
+        # If a variable name is given, store the result there
+        if self.variable_name is not None:
+            context.dicts[0][self.variable_name] = metadata
+            return ""
+        else:
+            return six.text_type(metadata)
+
+    @staticmethod
+    def get_request_memo(context):
+        """ Returns a dict for metadata resolved while handling the current request, if any. """
+        request = context.get('request')
+        if request is None:
+            return None
+        try:
+            return request._seo_metadata_memo
+        except AttributeError:
+            request._seo_metadata_memo = {}
+            return request._seo_metadata_memo
+
+    def get_metadata(self, context, target, path, kwargs):
         metadata = None
         # If the target is a django model object
         if hasattr(target, 'pk'):
@@ -66,13 +102,7 @@ class MetadataNode(template.Node):
                 metadata = get_metadata(path, self.metadata_name, context, **kwargs)
             except Exception as e:
                 raise template.TemplateSyntaxError(e)
-
-        # If a variable name is given, store the result there
-        if self.variable_name is not None:
-            context.dicts[0][self.variable_name] = metadata
-            return ""
-        else:
-            return six.text_type(metadata)
+        return metadata
 
 
 def do_get_metadata(parser, token):
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
 import re
 import importlib
@@ -10,12 +11,14 @@ from django.utils.functional import lazy
 from django.utils.safestring import mark_safe
 from django.utils.module_loading import import_string
 from django.utils.html import conditional_escape
+from django.utils.encoding import iri_to_uri
 from django.conf import settings
 from django.db import models
-from django.db.models import Q
-from django.urls import (URLResolver as RegexURLResolver, URLPattern as RegexURLPattern, Resolver404, get_resolver,
+from django.urls import (URLResolver as RegexURLResolver, URLPattern as RegexURLPattern, get_resolver,
                          clear_url_caches)
 
+from djangoseo.cache import LocalCache
+
 logger = logging.getLogger(__name__)
 
 
@@ -39,57 +42,194 @@ class Literal(object):
         self.value = value
 
 
-def _pattern_resolve_to_name(pattern, path):
+class RenderedValue(object):
+    """ A value that has already been cleaned, along with its html output """
+
+    def __init__(self, value, html):
+        self.value = value
+        self.html = html
+
+
+VIEW_NAME_CACHE_SIZE = getattr(settings, 'SEO_VIEW_NAME_CACHE_SIZE', 1024)
+
+# Regular expression syntax that ends the literal text at the start of a pattern
+REGEX_SPECIAL_CHARS = '.^$*+?{}[]|()'
+
+
+def path_hash(path):
+    """ Returns a 64 bit hash of the given path, as a signed integer to fit in a BigIntegerField. """
+    digest = hashlib.blake2b(iri_to_uri(path).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def redirect_lookup(old_path, model=None):
+    """ Returns the lookup arguments for redirects from the given path,
+        using the hash of the path if the redirect model has one.
+    """
+    if model is None:
+        from djangoseo.models import Redirect as model
+    lookup = {'old_path': old_path}
+    if model.use_path_hash:
+        lookup['old_path_hash'] = path_hash(old_path)
+    return lookup
+
+
+def redirect_target_filter(new_path):
+    """ Returns the filter for redirects to the given path, which uses the index on its hash.
+        Redirects stored before the hash was added, and not yet filled in by the
+        backfill_redirect_hashes command, are found by the path alone.
+    """
+    return models.Q(new_path=new_path) & (models.Q(new_path_hash=path_hash(new_path))
+                                          | models.Q(new_path_hash__isnull=True))
+
+
+def _pattern_regex(pattern):
     if django.VERSION < (2, 0):
-        match = pattern.regex.search(path)
-    else:
-        match = pattern.pattern.regex.search(path)
-    if match:
-        name = ""
-        if pattern.name:
-            name = pattern.name
-        elif hasattr(pattern, '_callback_str'):
-            name = pattern._callback_str
-        else:
-            name = "%s.%s" % (pattern.callback.__module__, pattern.callback.func_name)
-        return name
+        return pattern.regex
+    return pattern.pattern.regex
 
 
-def _resolver_resolve_to_name(resolver, path):
-    tried = []
-    django1 = django.VERSION < (2, 0)
-    if django1:
-        match = resolver.regex.search(path)
-    else:
-        match = resolver.pattern.regex.search(path)
-    if match:
-        new_path = path[match.end():]
+def _pattern_name(pattern):
+    if pattern.name:
+        return pattern.name
+    elif hasattr(pattern, '_callback_str'):
+        return pattern._callback_str
+    return "%s.%s" % (pattern.callback.__module__, getattr(pattern.callback, '__name__', ''))
+
+
+def _static_prefix(pattern):
+    """ Returns the literal text every match of the given pattern starts with,
+        and whether the pattern matches nothing but that text.
+    """
+    source = pattern if django.VERSION < (2, 0) else pattern.pattern
+    # Patterns that depend on the active language (eg i18n_patterns) have no fixed text
+    if not isinstance(getattr(source, '_regex', getattr(source, '_route', None)), six.string_types):
+        return '', False
+    regex = _pattern_regex(pattern)
+    if not regex.pattern.startswith('^') or '|' in regex.pattern or regex.flags & re.IGNORECASE:
+        return '', False
+    source = regex.pattern
+    prefix = []
+    i = 1
+    while i < len(source):
+        if source[i] == '\\' and i + 1 < len(source) and not source[i + 1].isalnum():
+            prefix.append(source[i + 1])
+            i += 2
+        elif source[i] == '\\' or source[i] in REGEX_SPECIAL_CHARS:
+            break
+        else:
+            prefix.append(source[i])
+            i += 1
+    if i < len(source) and source[i] in '*+?{':
+        # The quantifier applies to the last literal character
+        return ''.join(prefix[:-1]), False
+    return ''.join(prefix), i == len(source)
+
+
+class ViewNameIndex(object):
+    """ Resolves paths to view names for a single URL resolver.
+        The resolver tree is flattened once into a list of url patterns, along with
+        the chain of patterns leading to them and the literal text their paths must start with.
+        Only the patterns whose literal text matches are tried, in their original order.
+        Results are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, resolver, cache_size=VIEW_NAME_CACHE_SIZE):
+        self.resolver = resolver
+        self.entries = []
+        self.prefixes = {}
+        self._add_patterns(resolver, (), '', True)
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in self.prefixes))
+        self.names = LocalCache(cache_size, None)
+
+    def _add_patterns(self, resolver, chain, prefix, static):
+        chain = chain + (resolver,)
+        if static:
+            resolver_prefix, static = _static_prefix(resolver)
+            prefix += resolver_prefix
         for pattern in resolver.url_patterns:
-            try:
-                if isinstance(pattern, RegexURLPattern):
-                    name = _pattern_resolve_to_name(pattern, new_path)
-                elif isinstance(pattern, RegexURLResolver):
-                    name = _resolver_resolve_to_name(pattern, new_path)
-            except Resolver404 as e:
-                if django1:
-                    tried.extend([(pattern.regex.pattern + '   ' + t) for t in e.args[0]['tried']])
-                else:
-                    tried.extend([(pattern.pattern.regex.pattern + '   ' + t) for t in e.args[0]['tried']])
-            else:
+            if isinstance(pattern, RegexURLResolver):
+                self._add_patterns(pattern, chain, prefix, static)
+            elif isinstance(pattern, RegexURLPattern):
+                pattern_prefix = prefix + _static_prefix(pattern)[0] if static else prefix
+                self.prefixes.setdefault(pattern_prefix, []).append(len(self.entries))
+                self.entries.append((chain, pattern))
+
+    def _match(self, chain, pattern, path):
+        for resolver in chain:
+            match = _pattern_regex(resolver).search(path)
+            if not match:
+                return None
+            path = path[match.end():]
+        if _pattern_regex(pattern).search(path):
+            return _pattern_name(pattern)
+
+    def resolve(self, path):
+        name = self.names.get(path)
+        if name is None:
+            name = ''
+            candidates = set()
+            for length in self.prefix_lengths:
+                candidates.update(self.prefixes.get(path[:length], ()))
+            for index in sorted(candidates):
+                name = self._match(*self.entries[index], path=path)
                 if name:
-                    return name
-                if django1:
-                    tried.append(pattern.regex.pattern)
-                else:
-                    tried.append(pattern.pattern.regex.pattern)
-        raise Resolver404({'tried': tried, 'path': new_path})
+                    break
+            self.names.set(path, name or '')
+        return name or None
 
 
-def resolve_to_name(path, urlconf=None):
-    try:
-        return _resolver_resolve_to_name(get_resolver(urlconf), path)
-    except Resolver404:
-        return None
+class PrefixTrie(object):
+    """ A character trie of path prefixes. All stored prefixes of a path are found
+        in a single walk along the path, whatever the number of prefixes stored.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # Values are kept under the None key, which never clashes with a character
+        node.setdefault(None, []).append(value)
+        self.size += 1
+
+    def match(self, path):
+        """ Returns the lists of values stored for each prefix of the given path, longest prefix first. """
+        found = []
+        node = self.root
+        if None in node:
+            found.append(node[None])
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found.append(node[None])
+        found.reverse()
+        return found
+
+
+_view_name_indexes = {}
+
+
+def resolve_to_name(path, urlconf=None, request=None):
+    """ Returns the name of the view for the given path.
+        If the path is that of the given request, the view it was resolved to is used.
+    """
+    if request is not None and urlconf is None and getattr(request, 'urlconf', None) is None:
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is not None and resolver_match.url_name and path == request.path_info:
+            return resolver_match.url_name
+
+    resolver = get_resolver(urlconf)
+    index = _view_name_indexes.get(urlconf)
+    # The resolver is replaced whenever clear_url_caches() is called
+    if index is None or index.resolver is not resolver:
+        index = _view_name_indexes[urlconf] = ViewNameIndex(resolver)
+    return index.resolve(path)
 
 
 def _replace_quot(match):
@@ -97,10 +237,22 @@ def _replace_quot(match):
     return u'<%s%s>' % (unescape(match.group(1)), unescape(match.group(3)))
 
 
+def compile_tags_re(valid_tags):
+    """ Compiles the regular expression used by escape_tags to reenable
+        the given tags, or returns None if no tags are allowed.
+    """
+    if not valid_tags:
+        return None
+    return re.compile(r'&lt;(\s*/?\s*(%s))(.*?\s*)&gt;' %
+                      u'|'.join(re.escape(tag) for tag in valid_tags))
+
+
 def escape_tags(value, valid_tags):
     """ Strips text from the given html string, leaving only tags.
         This functionality requires BeautifulSoup, nothing will be
         done otherwise.
+        valid_tags is either a list of tag names, or a regular expression
+        from compile_tags_re(), which saves compiling it on every call.
         This isn't perfect. Someone could put javascript in here:
               <a onClick="alert('hi');">test</a>
             So if you use valid_tags, you still need to trust your data entry.
@@ -117,9 +269,7 @@ def escape_tags(value, valid_tags):
 
     # 2. Reenable certain tags
     if valid_tags:
-        # TODO: precompile somewhere once?
-        tag_re = re.compile(r'&lt;(\s*/?\s*(%s))(.*?\s*)&gt;' %
-                            u'|'.join(re.escape(tag) for tag in valid_tags))
+        tag_re = valid_tags if hasattr(valid_tags, 'sub') else compile_tags_re(valid_tags)
         value = tag_re.sub(_replace_quot, value)
 
     # Allow comments to be hidden
@@ -201,7 +351,8 @@ def handle_seo_redirects(request):
     Handle SEO redirects. Create Redirect instance if exists redirect pattern.
     :param request: Django request
     """
-    from .models import RedirectPattern, Redirect
+    from .models import Redirect
+    from .redirects import get_pattern_matcher
 
     if not getattr(settings, 'SEO_USE_REDIRECTS', False):
         return
@@ -210,22 +361,16 @@ def handle_seo_redirects(request):
     current_site = get_current_site(request)
     subdomain = getattr(request, 'subdomain', '')
 
-    redirect_patterns = RedirectPattern.objects.filter(
-        Q(site=current_site),
-        Q(subdomain=subdomain) | Q(all_subdomains=True)
-    ).order_by('all_subdomains')
-
-    for redirect_pattern in redirect_patterns:
-        if re.match(redirect_pattern.url_pattern, full_path):
-            kwargs = {
-                'site': current_site,
-                'old_path': full_path,
-                'new_path': redirect_pattern.redirect_path,
-                'subdomain': redirect_pattern.subdomain,
-                'all_subdomains': redirect_pattern.all_subdomains
-            }
-            try:
-                Redirect.objects.get_or_create(**kwargs)
-            except Exception:
-                logger.warning('Failed to create redirection', exc_info=True, extra=kwargs)
-            break
+    redirect_pattern = get_pattern_matcher(current_site.id, subdomain).match(full_path)
+    if redirect_pattern is not None:
+        kwargs = {
+            'site': current_site,
+            'new_path': redirect_pattern['redirect_path'],
+            'subdomain': redirect_pattern['subdomain'],
+            'all_subdomains': redirect_pattern['all_subdomains']
+        }
+        kwargs.update(redirect_lookup(full_path))
+        try:
+            Redirect.objects.get_or_create(**kwargs)
+        except Exception:
+            logger.warning('Failed to create redirection', exc_info=True, extra=kwargs)
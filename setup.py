@@ -18,7 +18,7 @@ setup(
     name="django-seo",
     version=read_version(),
     packages=find_packages(exclude=["docs*", "tests*"]),
-    install_requires=['Django>=1.10'],
+    install_requires=['Django>=3.2', 'asgiref'],
     author="Will Hardy",
     author_email="djangoseo@willhardy.com.au",
     description="A framework for managing SEO metadata in Django.",
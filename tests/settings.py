@@ -74,9 +74,11 @@ MEDIA_URL = '/media/'
 
 SITE_ID = 1
 
-CACHE_BACKEND = 'dummy://'
-# Enable when testing cache
-# CACHE_BACKEND = "locmem://?timeout=30&max_entries=400"
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 
 SEO_MODELS = ('userapp',)
 
@@ -4,6 +4,8 @@ from __future__ import unicode_literals
 from django.db import models
 from django.urls import reverse
 
+from djangoseo.models import create_redirect_model
+
 
 class Page(models.Model):
     title = models.CharField(max_length=255, default="", blank=True)
@@ -49,3 +51,7 @@ class Tag(models.Model):
 
     def __str__(self):
         return self.name
+
+
+# Redirects looked up by the hash of their path, as with SEO_REDIRECT_PATH_HASH
+HashedRedirect = create_redirect_model('HashedRedirect', use_path_hash=True, app_label='tests.userapp')
@@ -130,6 +130,95 @@ class WithCacheI18n(seo.Metadata):
         use_i18n = True
 
 
+class WithCacheSubdomains(seo.Metadata):
+    title = seo.Tag(head=True, populate_from=seo.Literal("1234"))
+    subtitle = seo.Tag(head=True)
+
+    class Meta:
+        use_cache = True
+        use_i18n = True
+        use_subdomains = True
+
+
+class WithCacheBundle(seo.Metadata):
+    title = seo.Tag(head=True, populate_from=seo.Literal("1234"))
+    subtitle = seo.Tag(head=True)
+    raw = seo.Raw(head=False, valid_tags='b')
+
+    class Meta:
+        use_cache = True
+        cache_mode = 'bundle'
+        groups = {'extra': ('subtitle', 'raw')}
+
+
+class WithLocalCache(seo.Metadata):
+    title = seo.Tag(head=True, populate_from=seo.Literal("1234"))
+    subtitle = seo.Tag(head=True)
+
+    class Meta:
+        use_cache = True
+        cache_mode = 'bundle'
+        local_cache_size = 10
+        local_cache_timeout = 60
+
+
+class WithUnionLookup(seo.Metadata):
+    title = seo.Tag(head=True, populate_from=seo.Literal("example.com"))
+    heading = seo.Tag(head=True)
+
+    class Meta:
+        use_union_lookup = True
+        use_subdomains = True
+        seo_models = ('userapp.page',)
+
+
+class WithUnionLookupSites(seo.Metadata):
+    title = seo.Tag(head=True)
+
+    class Meta:
+        use_union_lookup = True
+        use_sites = True
+        use_i18n = True
+
+
+class WithStoredRendered(seo.Metadata):
+    title = seo.Tag(head=True, populate_from=seo.Literal("example.com"))
+    description = seo.MetaTag()
+    raw = seo.Raw()
+
+    class Meta:
+        store_rendered = True
+        backends = ('path',)
+
+
+class WithPathHash(seo.Metadata):
+    title = seo.Tag(head=True)
+
+    class Meta:
+        use_path_hash = True
+        path_max_length = 2000
+        seo_models = ('userapp.page',)
+
+
+class WithPathPrefix(seo.Metadata):
+    title = seo.Tag(head=True)
+    description = seo.MetaTag()
+
+    class Meta:
+        backends = ('path', 'pathprefix')
+        use_subdomains = True
+
+
+class WithSnapshot(seo.Metadata):
+    title = seo.Tag(head=True)
+    heading = seo.Tag(head=True)
+
+    class Meta:
+        use_snapshot = True
+        use_sites = True
+        seo_models = ('userapp.page',)
+
+
 class WithBackends(seo.Metadata):
     title = seo.Tag()
 
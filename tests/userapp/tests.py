@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import asyncio
+import gzip
 import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
 
 import django
 try:
@@ -8,7 +19,7 @@ try:
 except ImportError:
     import six
 from django.test import TestCase, override_settings
-from django.http import Http404
+from django.http import Http404, HttpResponseNotFound
 try:
     from django.test import TransactionTestCase
 except ImportError:
@@ -17,26 +28,39 @@ from django.test.client import FakePayload, RequestFactory
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
-from django.conf import settings
-from django.db import models, IntegrityError, transaction
+from django.db import connection, models, IntegrityError, transaction
+from django.test.utils import CaptureQueriesContext
 from django.core.handlers.wsgi import WSGIRequest
-from django.template import Template, RequestContext, TemplateSyntaxError
+from django.template import Context, Template, RequestContext, TemplateSyntaxError
 from django.core.cache import cache
 from django.utils.encoding import iri_to_uri
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.apps import apps
 from django.contrib import admin
 
+from djangoseo.utils import resolve_to_name, path_hash, redirect_lookup, redirect_target_filter, ViewNameIndex
 from djangoseo.utils import create_dynamic_model, register_model_in_admin, import_tracked_models
-from djangoseo.seo import get_metadata as seo_get_metadata
+from djangoseo.seo import get_metadata as seo_get_metadata, get_linked_metadata as seo_get_linked_metadata
+from djangoseo.seo import get_metadata_many as seo_get_metadata_many, get_linked_metadata_many as seo_get_linked_metadata_many
+from djangoseo.seo import aget_metadata as seo_aget_metadata, aget_linked_metadata as seo_aget_linked_metadata
 from djangoseo.base import registry
+from djangoseo.backends import get_template, get_site_id, SiteKey
+from djangoseo.cache import LocalCache, get_generations, bump_generations, global_scope, path_scope, backend_scope
+from djangoseo.cache import snapshot_scope, site_scope, redirect_scope, redirect_pattern_scope
 from djangoseo.models import RedirectPattern, Redirect
-from djangoseo.middleware import RedirectsMiddleware
+from djangoseo.sitemaps import MetadataSitemap
+from djangoseo.middleware import RedirectsMiddleware, RedirectFallbackMiddleware
+from djangoseo.redirects import redirect_cache, PatternMatcher, BloomFilter, bloom_filter_keys, build_bloom_filter
+from djangoseo.management.commands.import_redirects import Command as ImportRedirects
+from djangoseo.redirects import backfill_redirect_hashes, _bloom_filters, BLOOM_FILTER_KEY, BLOOM_FILTER_LOCK_KEY
 from .views import product_detail
-from .models import Page, Product, NoPath, Tag, Category
-from .seo import Coverage, WithSites, WithI18n, WithBackends, WithSubdomains
+from .models import Page, Product, NoPath, Tag, Category, HashedRedirect
+from .seo import (Coverage, WithSites, WithI18n, WithBackends, WithSubdomains, WithCache, WithCacheBundle,
+                  WithLocalCache, WithUnionLookup, WithUnionLookupSites, WithStoredRendered, WithSEOModels,
+                  WithPathHash, WithPathPrefix, WithSnapshot)
 
-from django.urls import reverse
+from django.urls import reverse, resolve, get_resolver
 
 """ Test suite for SEO framework.
 
@@ -176,6 +200,125 @@ class DataSelection(TestCase):
         path_metadata.save()
         self.assertEqual(seo_get_metadata(path, name="WithSites").title.value, None)
 
+    def test_sites_by_domain(self):
+        """ Sites given by domain are only looked up once. """
+        site = Site.objects.get_current()
+        WithSites._meta.get_model('path').objects.create(_site=site, title="Site Path title", _path="/abc/")
+        self.assertEqual(seo_get_metadata("/abc/", name="WithSites", site=site.domain).title.value, 'Site Path title')
+        with CaptureQueriesContext(connection) as queries:
+            seo_get_metadata("/abc/", name="WithSites", site=site.domain).title.value
+        self.assertFalse([q for q in queries if 'django_site' in q['sql']])
+
+        # Changing a site clears the known domains
+        site.domain = 'example.org'
+        site.save()
+        self.assertEqual(seo_get_metadata("/abc/", name="WithSites", site='example.org').title.value,
+                         'Site Path title')
+        with self.assertRaises(Site.DoesNotExist):
+            seo_get_metadata("/abc/", name="WithSites", site='example.com').title
+
+    def test_sites_by_domain_remote_change(self):
+        """ Sites changed by other processes are seen once the local counters expire. """
+        site = Site.objects.get_current()
+        self.assertEqual(get_site_id(site.domain), site.id)
+
+        # Simulate another process moving the domain to a new site
+        Site.objects.filter(pk=site.pk).update(domain='example.org')
+        Site.objects.bulk_create([Site(domain=site.domain, name=site.domain)])
+        bump_generations([site_scope()])
+        self.assertEqual(get_site_id(site.domain), site.id)
+
+        with mock.patch('djangoseo.cache.time.time', return_value=time.time() + 6):
+            self.assertNotEqual(get_site_id(site.domain), site.id)
+            self.assertEqual(get_site_id(site.domain), Site.objects.get(domain=site.domain).id)
+
+    def test_lookup_indexes(self):
+        """ Each backend model has an index matching its lookups. """
+        expected = {
+            'path': ['_path', '_all_subdomains', '_subdomain'],
+            'modelinstance': ['_path', '_all_subdomains', '_subdomain'],
+            'model': ['_content_type', '_all_subdomains', '_subdomain'],
+            'view': ['_view', '_all_subdomains', '_subdomain'],
+        }
+        for backend, fields in expected.items():
+            model = WithSubdomains._meta.get_model(backend)
+            self.assertEqual([index.fields for index in model._meta.indexes], [fields])
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            self.assertIn(model._meta.indexes[0].name, constraints)
+        self.assertEqual(WithI18n._meta.get_model('view')._meta.indexes[0].fields, ['_view', '_language'])
+        self.assertEqual(Coverage._meta.get_model('path')._meta.indexes, [])
+
+        # The site is indexed as the expression it is looked up with
+        for backend in ('path', 'modelinstance', 'model', 'view'):
+            model = WithSites._meta.get_model(backend)
+            index = model._meta.indexes[0]
+            self.assertEqual(len(index.expressions), 2)
+            self.assertIsInstance(index.expressions[1], SiteKey)
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            self.assertIn(index.name, constraints)
+
+    def test_path_hash(self):
+        """ Paths can be looked up by their hash. """
+        PathMetadata = WithPathHash._meta.get_model('path')
+        path = '/long/%s/' % ('x' * 1000)
+        PathMetadata.objects.create(_path=path, title="Long path")
+        PathMetadata.objects.create(_path='/short/', title="Short path")
+        self.assertEqual(PathMetadata.objects.get(_path=path)._path_hash, path_hash(path))
+        self.assertEqual(seo_get_metadata(path, name="WithPathHash").title.value, "Long path")
+        self.assertEqual(seo_get_metadata('/other/', name="WithPathHash").title.value, None)
+        metadata = seo_get_metadata_many([path, '/short/'], name="WithPathHash")
+        self.assertEqual([m.title.value for m in metadata.values()], ["Long path", "Short path"])
+
+        # Model instance metadata keeps the hash up to date
+        page = Page.objects.create(type="hash", title="Page")
+        instance_md = WithPathHash._meta.get_model('modelinstance').objects.get(_object_id=page.pk)
+        self.assertEqual(instance_md._path_hash, path_hash(page.get_absolute_url()))
+        instance_md.title = "Page title"
+        instance_md.save()
+        self.assertEqual(seo_get_metadata(page.get_absolute_url(), name="WithPathHash").title.value, "Page title")
+
+        self.assertEqual(PathMetadata._meta.unique_together, (('_path_hash', '_path'),))
+        self.assertFalse(PathMetadata._meta.get_field('_path').db_index)
+
+    def test_path_hash_collision(self):
+        """ Paths with the same hash are stored and found apart. """
+        PathMetadata = WithPathHash._meta.get_model('path')
+        with mock.patch('djangoseo.backends.path_hash', return_value=42):
+            PathMetadata.objects.create(_path='/one/', title="One")
+            PathMetadata.objects.create(_path='/two/', title="Two")
+            self.assertEqual(seo_get_metadata('/one/', name="WithPathHash").title.value, "One")
+            self.assertEqual(seo_get_metadata('/two/', name="WithPathHash").title.value, "Two")
+            # The same path is still rejected
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    PathMetadata.objects.create(_path='/one/', title="Again")
+        self.assertEqual(set(PathMetadata.objects.values_list('_path_hash', flat=True)), {42})
+
+    def test_sites_lookup(self):
+        """ The current site and all sites are found with a single IN lookup, rather than an OR with IS NULL. """
+        site = Site.objects.get_current()
+        other_site = Site.objects.create(domain="example.org", name="example.org")
+        PathMetadata = WithSites._meta.get_model('path')
+        PathMetadata.objects.create(_path='/abc/', _site=site, title="Current site")
+        PathMetadata.objects.create(_path='/abc/', _site=other_site, title="Other site")
+        PathMetadata.objects.create(_path='/abc/', title="All sites")
+        queryset = PathMetadata.objects.on_current_site().filter(_path='/abc/')
+        self.assertEqual(sorted(queryset.values_list('title', flat=True)), ["All sites", "Current site"])
+        sql = str(queryset.query)
+        self.assertIn('IN (%d, 0)' % site.id, sql)
+        self.assertNotIn('IS NULL', sql)
+
+    @skipUnless(connection.vendor == 'sqlite', "The query plan is checked for SQLite")
+    def test_sites_query_plan(self):
+        """ Both the lookup field and the site are looked up in the index. """
+        for backend, lookup in (('path', '_path'), ('modelinstance', '_path'), ('view', '_view')):
+            model = WithSites._meta.get_model(backend)
+            plan = model.objects.on_current_site().filter(**{lookup: '/abc/'}).explain()
+            self.assertIn('USING INDEX %s (%s=? AND <expr>=?)' % (model._meta.indexes[0].name, lookup), plan)
+            self.assertNotIn('SCAN', plan)
+
     def test_i18n(self):
         """ Tests the i18n support, allowing a language to be associated with metadata entries.
         """
@@ -412,6 +555,44 @@ class ValueResolution(TestCase):
         # Data direct from another field's populate_from
         self.assertEqual(self.context1.populate_from2.value, None)
 
+    def page_queries(self, queries):
+        return [q for q in queries if 'userapp_page' in q['sql']]
+
+    def test_content_object_prefetched(self):
+        """ The content object is fetched together with the metadata. """
+        with CaptureQueriesContext(connection) as queries:
+            metadata = get_metadata(path=self.page1.get_absolute_url())
+            self.assertEqual(metadata.populate_from7.value, u'model instance content: Page one content.')
+        self.assertEqual(len(self.page_queries(queries)), 1)
+
+    def test_content_object_missing(self):
+        """ Metadata is still rendered when the content object was deleted without any signal. """
+        path = self.page2.get_absolute_url()
+        Page.objects.filter(pk=self.page2.pk)._raw_delete(connection.alias)
+        metadata = get_metadata(path=path)
+        self.assertEqual(metadata.keywords.value, 'MMD Keywords, , more keywords')
+        self.assertEqual(metadata.description.value, 'MMD Description for  and')
+
+    def test_content_object_from_view(self):
+        """ The object of the view is reused as the content object. """
+        context = {'object': self.page1}
+        with CaptureQueriesContext(connection) as queries:
+            metadata = seo_get_metadata(self.page1.get_absolute_url(), name="Coverage", context=context)
+            self.assertEqual(metadata.populate_from7.value, u'model instance content: Page one content.')
+        self.assertEqual(len(self.page_queries(queries)), 0)
+
+        # Some other object is not mistaken for the content object
+        context = {'object': self.page2}
+        metadata = seo_get_metadata(self.page1.get_absolute_url(), name="Coverage", context=context)
+        self.assertEqual(metadata.populate_from7.value, u'model instance content: Page one content.')
+
+    def test_content_object_linked(self):
+        """ The object given for linked metadata is reused as the content object. """
+        with CaptureQueriesContext(connection) as queries:
+            metadata = seo_get_linked_metadata(self.page1, name="Coverage")
+            self.assertEqual(metadata.populate_from7.value, u'model instance content: Page one content.')
+        self.assertEqual(len(self.page_queries(queries)), 0)
+
     def test_fallback_order(self):
         path = self.page1.get_absolute_url()
         # Collect instances from all four metadata model for the same path
@@ -482,6 +663,64 @@ class ValueResolution(TestCase):
         self.assertEqual(self.context1.description.value, 'MMD Description for MD Page One Title and MD Page One Title')
         self.assertEqual(self.context2.description.value, 'MMD Description for Page two content. and Page two content.')
 
+    def test_template_cache(self):
+        """ Templates are only compiled once for each distinct source. """
+        get_template.cache_clear()
+        get_metadata(path=self.page2.get_absolute_url()).description.value
+        info = get_template.cache_info()
+        self.assertEqual((info.hits, info.misses), (0, 1))
+
+        # Same source, different context
+        self.assertEqual(get_metadata(path=self.page1.get_absolute_url()).description.value,
+                         'MMD Description for MD Page One Title and MD Page One Title')
+        info = get_template.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_get_metadata_many(self):
+        """ Bulk lookups give the same values as individual lookups. """
+        path1 = self.page1.get_absolute_url()
+        path2 = self.page2.get_absolute_url()
+        Coverage._meta.get_model('path').objects.create(_path=path2, title='path title')
+        paths = [path2, '/no/metadata/', path1, path2]
+
+        with CaptureQueriesContext(connection) as queries:
+            metadata = seo_get_metadata_many(paths, name="Coverage")
+            for path in paths:
+                six.text_type(metadata[path])
+        # One query for each backend, and one for the content objects
+        self.assertEqual(len(queries), 5)
+
+        self.assertEqual(list(metadata), [path2, '/no/metadata/', path1])
+        for path in paths:
+            single = get_metadata(path=path)
+            self.assertEqual(six.text_type(metadata[path]), six.text_type(single))
+            for name in ('title', 'keywords', 'description', 'populate_from7'):
+                self.assertEqual(getattr(metadata[path], name).value, getattr(single, name).value)
+        self.assertEqual(metadata[path2].title.value, 'path title')
+        self.assertEqual(metadata[path1].description.value,
+                         'MMD Description for MD Page One Title and MD Page One Title')
+
+    def test_get_linked_metadata_many(self):
+        """ Bulk linked lookups give the same values as individual lookups. """
+        product = Product.objects.create(meta_title="Product title")
+        objects = [self.page2, product, self.page1]
+
+        with CaptureQueriesContext(connection) as queries:
+            metadata = seo_get_linked_metadata_many(objects, name="Coverage")
+            for obj_metadata in metadata:
+                six.text_type(obj_metadata)
+            self.assertEqual(metadata[2].populate_from7.value, u'model instance content: Page one content.')
+        # One query for each content type, and one for all model metadata
+        self.assertEqual(len(queries), 3)
+
+        self.assertEqual(len(metadata), 3)
+        for obj, obj_metadata in zip(objects, metadata):
+            single = seo_get_linked_metadata(obj, name="Coverage")
+            self.assertEqual(six.text_type(obj_metadata), six.text_type(single))
+            for name in ('title', 'keywords', 'description'):
+                self.assertEqual(getattr(obj_metadata, name).value, getattr(single, name).value)
+        self.assertEqual(metadata[2].keywords.value, 'MD Keywords')
+
     def test_view_variable_substitution(self):
         """ Simple check to see if view variable substitution is happening """
         response = self.client.get(reverse('userapp_my_view', args=["abc123"]))
@@ -500,6 +739,293 @@ class ValueResolution(TestCase):
             pass
 
 
+class UnionLookup(TestCase):
+    """ Checks that the combined lookup resolves values like the separate lookups. """
+
+    def setUp(self):
+        self.page = Page.objects.create(type='union', content='Union content')
+        self.path = self.page.get_absolute_url()
+        self.page_content_type = ContentType.objects.get_for_model(Page)
+        self.path_md = WithUnionLookup._meta.get_model('path').objects.create(
+            _path=self.path, title='path title', heading='path heading')
+        self.modelinstance_md = WithUnionLookup._meta.get_model('modelinstance').objects.get(
+            _content_type=self.page_content_type, _object_id=self.page.id)
+        self.modelinstance_md.title = 'model instance title'
+        self.modelinstance_md.heading = 'model instance heading'
+        self.modelinstance_md.save()
+        self.model_md = WithUnionLookup._meta.get_model('model').objects.create(
+            _content_type=self.page_content_type, title='model title', heading='model heading for {{ page.type }}')
+        self.view_md = WithUnionLookup._meta.get_model('view').objects.create(
+            _view='userapp_page_detail', title='view title', heading='view heading')
+
+    def check_values(self, title, heading, subdomain=None):
+        metadata = seo_get_metadata(self.path, name='WithUnionLookup', subdomain=subdomain)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(metadata.title.value, title)
+            self.assertEqual(metadata.heading.value, heading)
+        # All backends are looked up at once
+        lookups = [q for q in queries.captured_queries if 'djangoseo_withunionlookup' in q['sql']]
+        self.assertEqual(len(lookups), 1)
+
+    def test_fallback_order(self):
+        self.check_values('path title', 'path heading')
+
+        self.path_md.delete()
+        self.check_values('model instance title', 'model instance heading')
+
+        self.modelinstance_md.title = ''
+        self.modelinstance_md.heading = ''
+        self.modelinstance_md.save()
+        self.check_values('example.com', 'model heading for union')
+
+        self.model_md.delete()
+        self.check_values('example.com', 'view heading')
+
+    def test_subdomains(self):
+        self.path_md._all_subdomains = True
+        self.path_md.save()
+        WithUnionLookup._meta.get_model('path').objects.create(
+            _path=self.path, _subdomain='msk', title='msk title')
+        self.check_values('path title', 'path heading', subdomain='spb')
+        self.check_values('msk title', 'path heading', subdomain='msk')
+
+    def test_sites_and_languages(self):
+        """ The site and language are matched in each part of the combined lookup. """
+        current_site = Site.objects.get_current()
+        other_site = Site.objects.create(domain='example.net', name='example.net')
+        model = WithUnionLookupSites._meta.get_model('path')
+        model.objects.create(_path='/union/', _language='en', title='All sites')
+        model.objects.create(_path='/union/', _site=current_site, _language='de', title='German')
+        model.objects.create(_path='/union/', _site=other_site, _language='fr', title='Other site')
+
+        def title(site, language):
+            with CaptureQueriesContext(connection) as queries:
+                metadata = seo_get_metadata('/union/', name='WithUnionLookupSites', site=site, language=language)
+                value = metadata.title.value
+            self.assertEqual(len([q for q in queries.captured_queries
+                                  if 'djangoseo_withunionlookupsites' in q['sql']]), 1)
+            return value
+
+        self.assertEqual(title(current_site, 'en'), 'All sites')
+        self.assertEqual(title(other_site, 'en'), 'All sites')
+        self.assertEqual(title(current_site, 'de'), 'German')
+        self.assertEqual(title(other_site, 'de'), None)
+        self.assertEqual(title(other_site, 'fr'), 'Other site')
+        self.assertEqual(title(current_site, 'fr'), None)
+
+    def test_content_object_missing(self):
+        """ Metadata is still rendered when the content object was deleted without any signal. """
+        self.path_md.delete()
+        Page.objects.filter(pk=self.page.pk)._raw_delete(connection.alias)
+        self.check_values('model instance title', 'model instance heading')
+
+
+class PathPrefixes(TestCase):
+    """ Tests metadata for all paths starting with a prefix. """
+
+    def setUp(self):
+        # Rows from other tests are rolled back without any signal
+        bump_generations([backend_scope('WithPathPrefix', 'pathprefix')])
+        self.model = WithPathPrefix._meta.get_model('pathprefix')
+        self.catalog = self.model.objects.create(_prefix='/catalog/', title='Catalog',
+                                                 description='Everything we sell')
+        self.shoes = self.model.objects.create(_prefix='/catalog/shoes/', title='Shoes')
+
+    def test_longest_prefix(self):
+        metadata = seo_get_metadata('/catalog/shoes/boots/', name='WithPathPrefix')
+        self.assertEqual(metadata.title.value, 'Shoes')
+        # Values missing for the longest prefix come from shorter ones
+        self.assertEqual(metadata.description.value, 'Everything we sell')
+        self.assertEqual(seo_get_metadata('/catalog/hats/', name='WithPathPrefix').title.value, 'Catalog')
+        self.assertEqual(seo_get_metadata('/catalog', name='WithPathPrefix').title.value, None)
+        self.assertEqual(seo_get_metadata('/about/', name='WithPathPrefix').title.value, None)
+
+        # Path metadata comes first
+        WithPathPrefix._meta.get_model('path').objects.create(_path='/catalog/shoes/boots/', title='Boots')
+        self.assertEqual(seo_get_metadata('/catalog/shoes/boots/', name='WithPathPrefix').title.value, 'Boots')
+
+    def test_no_queries(self):
+        seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'Shoes')
+            metadata = seo_get_metadata_many(['/catalog/', '/catalog/shoes/x/'], name='WithPathPrefix')
+            self.assertEqual([m.title.value for m in metadata.values()], ['Catalog', 'Shoes'])
+        self.assertFalse([q for q in queries.captured_queries if self.model._meta.db_table in q['sql']])
+
+    def test_refresh(self):
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'Shoes')
+        self.shoes.title = 'All shoes'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shoes.save()
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'All shoes')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shoes.delete()
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'Catalog')
+
+    def test_refresh_on_commit(self):
+        """ The trie is only rebuilt once a change is committed, so it cannot be rebuilt from the old rows. """
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'Shoes')
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                self.shoes.title = 'All shoes'
+                self.shoes.save()
+            self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'Shoes')
+        for callback in callbacks:
+            callback()
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix').title.value, 'All shoes')
+
+    def test_subdomains(self):
+        self.shoes._all_subdomains = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shoes.save()
+            self.model.objects.create(_prefix='/catalog/shoes/', _subdomain='msk', title='Moscow shoes')
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix', subdomain='msk').title.value,
+                         'Moscow shoes')
+        self.assertEqual(seo_get_metadata('/catalog/shoes/', name='WithPathPrefix', subdomain='spb').title.value,
+                         'Shoes')
+
+    def test_union_lookup(self):
+        WithPathPrefix._meta.get_model('path').objects.create(_path='/catalog/shoes/', description='Shoe shop')
+        WithPathPrefix._meta.use_union_lookup = True
+        try:
+            metadata = seo_get_metadata('/catalog/shoes/', name='WithPathPrefix')
+            self.assertEqual(metadata.title.value, 'Shoes')
+            self.assertEqual(metadata.description.value, 'Shoe shop')
+        finally:
+            WithPathPrefix._meta.use_union_lookup = False
+
+
+class Snapshots(TestCase):
+    """ Tests serving metadata from an in-process snapshot. """
+
+    def setUp(self):
+        # Rows from other tests are rolled back without any signal
+        bump_generations([snapshot_scope('WithSnapshot')])
+        self.page = Page.objects.create(type='snapshot')
+        self.path = self.page.get_absolute_url()
+        self.content_type = ContentType.objects.get_for_model(Page)
+        WithSnapshot._meta.get_model('path').objects.create(_path='/about/', title='About', heading='About us')
+        self.model_md = WithSnapshot._meta.get_model('model').objects.create(
+            _content_type=self.content_type, title='Page', heading='Page {{ page.type }}')
+        WithSnapshot._meta.get_model('view').objects.create(_view='userapp_page_detail', title='View title')
+        instance_md = WithSnapshot._meta.get_model('modelinstance').objects.get(_object_id=self.page.pk)
+        instance_md.title = 'Page title'
+        instance_md.save()
+
+    def test_values(self):
+        metadata = seo_get_metadata('/about/', name='WithSnapshot')
+        self.assertEqual(metadata.title.value, 'About')
+        self.assertEqual(metadata.heading.value, 'About us')
+        metadata = seo_get_metadata(self.path, name='WithSnapshot')
+        self.assertEqual(metadata.title.value, 'Page title')
+        self.assertEqual(metadata.heading.value, 'Page snapshot')
+        self.assertEqual(seo_get_metadata('/pages/other/', name='WithSnapshot').title.value, 'View title')
+        self.assertEqual(seo_get_metadata('/missing/', name='WithSnapshot').title.value, None)
+        metadata = seo_get_metadata_many(['/about/', self.path], name='WithSnapshot')
+        self.assertEqual([m.title.value for m in metadata.values()], ['About', 'Page title'])
+
+    def test_no_queries(self):
+        seo_get_metadata('/about/', name='WithSnapshot').title.value
+        with self.assertNumQueries(0):
+            self.assertEqual(seo_get_metadata('/about/', name='WithSnapshot').title.value, 'About')
+            self.assertEqual(seo_get_metadata('/missing/', name='WithSnapshot').title.value, None)
+            # The content object is taken from the view
+            metadata = seo_get_metadata(self.path, name='WithSnapshot', context=Context({'object': self.page}))
+            self.assertEqual(metadata.heading.value, 'Page snapshot')
+            # or from the snapshot
+            for i in range(3):
+                self.assertEqual(seo_get_metadata(self.path, name='WithSnapshot').heading.value, 'Page snapshot')
+
+    def test_content_object_changes(self):
+        """ The snapshot is built again when a content object is changed or deleted. """
+        self.assertEqual(seo_get_metadata(self.path, name='WithSnapshot').heading.value, 'Page snapshot')
+        snapshot = WithSnapshot._meta.snapshot
+        self.page.content = 'Changed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.page.save()
+        self.assertEqual(seo_get_metadata(self.path, name='WithSnapshot').heading.value, 'Page snapshot')
+        self.assertIsNot(WithSnapshot._meta.snapshot, snapshot)
+
+        # Deleted without any signal, the metadata is still rendered
+        Page.objects.filter(pk=self.page.pk)._raw_delete(connection.alias)
+        with self.captureOnCommitCallbacks(execute=True):
+            WithSnapshot._meta.get_model('path').objects.create(_path='/new/', title='New')
+        self.assertEqual(seo_get_metadata(self.path, name='WithSnapshot').title.value, 'Page title')
+        self.assertEqual(seo_get_metadata(self.path, name='WithSnapshot').heading.value, 'Page')
+
+    def test_refresh(self):
+        snapshot = WithSnapshot._meta.snapshot
+        self.assertEqual(seo_get_metadata('/about/', name='WithSnapshot').title.value, 'About')
+        self.assertIsNot(WithSnapshot._meta.snapshot, snapshot)
+        snapshot = WithSnapshot._meta.snapshot
+        self.assertEqual(seo_get_metadata('/about/', name='WithSnapshot').title.value, 'About')
+        self.assertIs(WithSnapshot._meta.snapshot, snapshot)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.model_md.delete()
+        with self.assertLogs('djangoseo.snapshot', 'INFO'):
+            self.assertEqual(seo_get_metadata(self.path, name='WithSnapshot').heading.value, None)
+        self.assertEqual(WithSnapshot._meta.snapshot.count, 3)
+        self.assertTrue(WithSnapshot._meta.snapshot.size)
+        with self.assertRaises(TypeError):
+            WithSnapshot._meta.snapshot.tables['path']['/new/'] = ()
+
+    def test_refresh_on_commit(self):
+        """ The snapshot is only rebuilt once a change is committed, so that it cannot
+            be rebuilt from the old rows and then kept until the next change.
+        """
+        self.assertEqual(seo_get_metadata('/about/', name='WithSnapshot').title.value, 'About')
+        snapshot = WithSnapshot._meta.snapshot
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                WithSnapshot._meta.get_model('path').objects.filter(_path='/about/').get().delete()
+                self.assertEqual(seo_get_metadata('/about/', name='WithSnapshot').title.value, 'About')
+                self.assertIs(WithSnapshot._meta.snapshot, snapshot)
+        self.assertEqual(len(callbacks), 1)
+
+        callbacks[0]()
+        self.assertEqual(seo_get_metadata('/about/', name='WithSnapshot').title.value, None)
+        self.assertIsNot(WithSnapshot._meta.snapshot, snapshot)
+
+    def test_sites(self):
+        other_site = Site.objects.create(domain='example.net', name='example.net')
+        WithSnapshot._meta.get_model('path').objects.create(_path='/other/', title='Other', _site=other_site)
+        self.assertEqual(seo_get_metadata('/other/', name='WithSnapshot').title.value, None)
+        self.assertEqual(seo_get_metadata('/other/', name='WithSnapshot', site=other_site).title.value, 'Other')
+        self.assertEqual(seo_get_metadata('/other/', name='WithSnapshot', site='example.net').title.value, 'Other')
+
+
+class AsyncAPI(TestCase):
+    """ Checks the coroutine versions of get_metadata and get_linked_metadata. """
+
+    def setUp(self):
+        self.page = Page.objects.create(title="Async page", type="async", content="Async content")
+        self.path = self.page.get_absolute_url()
+        InstanceMetadata = WithSEOModels._meta.get_model('modelinstance')
+        self.metadata = InstanceMetadata.objects.get(_content_type=ContentType.objects.get_for_model(Page),
+                                                     _object_id=self.page.pk)
+        self.metadata.title = "Async title"
+        self.metadata.save()
+
+    def test_get_metadata(self):
+        metadata = async_to_sync(seo_aget_metadata)(self.path, name="WithSEOModels")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(metadata.title.value, "Async title")
+            self.assertEqual(six.text_type(metadata.title), "<title>Async title</title>")
+        self.assertEqual(len(queries), 0)
+
+    def test_get_linked_metadata(self):
+        metadata = async_to_sync(seo_aget_linked_metadata)(self.page, name="WithSEOModels")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(metadata.title.value, "Async title")
+            self.assertEqual(six.text_type(metadata), "")
+        self.assertEqual(len(queries), 0)
+
+    def test_coroutine_functions(self):
+        self.assertTrue(asyncio.iscoroutinefunction(seo_aget_metadata))
+        self.assertTrue(asyncio.iscoroutinefunction(seo_aget_linked_metadata))
+
+
 class Formatting(TestCase):
     """ Formatting (unit tests)
     """
@@ -725,88 +1251,275 @@ class MetaOptions(TestCase):
         + HelpText: Help text can be applied in bulk by using a special class, like 'Meta'
     """
 
+    @staticmethod
+    def get_cache_prefix(name, path, *bits, **kwargs):
+        """ Returns the prefix of the cache keys of the given path, with the current generations. """
+        generations = get_generations([global_scope(name), path_scope(name, path)])
+        hashed = iri_to_uri(kwargs.get('domain', '') + path)
+        hexpath = hashlib.md5(hashed.encode('utf-8')).hexdigest()
+        return '.'.join(('djangoseo', name, '-'.join(str(g) for g in generations), hexpath) + bits)
+
     def test_use_cache(self):
         """ Checks that cache is being used when use_cache is set.
-            Will only work if cache backend is not dummy.
         """
-        if 'dummy' not in settings.CACHE_BACKEND:
-            path = '/'
-            hexpath = hashlib.md5(iri_to_uri(path)).hexdigest()
-
-            # six.text_type(seo_get_metadata(path, name="Coverage"))
-            six.text_type(seo_get_metadata(path, name="WithCache"))
+        cache.clear()
+        path = '/'
+        six.text_type(seo_get_metadata(path, name="Coverage"))
+        six.text_type(seo_get_metadata(path, name="WithCache"))
 
-            self.assertEqual(cache.get('djangoseo.Coverage.%s.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithCache.%s.title' % hexpath), "1234")
-            self.assertEqual(cache.get('djangoseo.WithCache.%s.subtitle' % hexpath), "")
+        self.assertEqual(cache.get('%s.title' % self.get_cache_prefix('Coverage', path)), None)
+        prefix = self.get_cache_prefix('WithCache', path)
+        self.assertEqual(cache.get('%s.title' % prefix), "1234")
+        self.assertEqual(cache.get('%s.subtitle' % prefix), "")
 
     def test_use_cache_site(self):
         """ Checks that the cache plays nicely with sites.
         """
-        if 'dummy' not in settings.CACHE_BACKEND:
-            path = '/'
-            site = Site.objects.get_current()
-            hexpath = hashlib.md5(iri_to_uri(site.domain + path)).hexdigest()
-
-            # six.text_type(seo_get_metadata(path, name="Coverage"))
-            six.text_type(seo_get_metadata(path, name="WithCacheSites", site=site))
+        cache.clear()
+        path = '/'
+        site = Site.objects.get_current()
+        six.text_type(seo_get_metadata(path, name="WithCacheSites", site=site))
 
-            self.assertEqual(cache.get('djangoseo.Coverage.%s.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithCacheSites.%s.title' % hexpath), "1234")
-            self.assertEqual(cache.get('djangoseo.WithCacheSites.%s.subtitle' % hexpath), "")
+        prefix = self.get_cache_prefix('WithCacheSites', path, domain=site.domain)
+        self.assertEqual(cache.get('%s.title' % prefix), "1234")
+        self.assertEqual(cache.get('%s.subtitle' % prefix), "")
+        self.assertEqual(cache.get('%s.title' % self.get_cache_prefix('WithCacheSites', path)), None)
 
     def test_use_cache_i18n(self):
         """ Checks that the cache plays nicely with i18n.
         """
-        if 'dummy' not in settings.CACHE_BACKEND:
-            path = '/'
-            hexpath = hashlib.md5(iri_to_uri(path)).hexdigest()
+        cache.clear()
+        path = '/'
+        six.text_type(seo_get_metadata(path, name="WithCacheI18n", language='de'))
 
-            # six.text_type(seo_get_metadata(path, name="Coverage"))
-            six.text_type(seo_get_metadata(path, name="WithCacheI18n", language='de'))
-
-            self.assertEqual(cache.get('djangoseo.Coverage.%s.de.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithCacheI18n.%s.en.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithCacheI18n.%s.de.title' % hexpath), "1234")
-            self.assertEqual(cache.get('djangoseo.WithCacheI18n.%s.de.subtitle' % hexpath), "")
+        self.assertEqual(cache.get('%s.title' % self.get_cache_prefix('WithCacheI18n', path, 'en')), None)
+        prefix = self.get_cache_prefix('WithCacheI18n', path, 'de')
+        self.assertEqual(cache.get('%s.title' % prefix), "1234")
+        self.assertEqual(cache.get('%s.subtitle' % prefix), "")
 
     def test_use_cache_i18n_subdomain(self):
         """ Checks that the cache plays nicely with i18n and subdomain.
         """
-        if 'dummy' not in settings.CACHE_BACKEND:
-            path = '/'
-            hexpath = hashlib.md5(iri_to_uri(path)).hexdigest()
-
-            six.text_type(seo_get_metadata(path, name='WithSubdomains', language='ru', subdomain='msk'))
+        cache.clear()
+        path = '/'
+        six.text_type(seo_get_metadata(path, name='WithCacheSubdomains', language='ru', subdomain='msk'))
 
-            self.assertEqual(cache.get('djangoseo.Coverage.%s.de.msk.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.en.msk.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru.spb.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru.spb.subtitle' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru.msk.title' % hexpath), '1234')
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru.msk.subtitle' % hexpath), '')
+        self.assertEqual(cache.get('%s.title' % self.get_cache_prefix('WithCacheSubdomains', path, 'en', 'msk')), None)
+        self.assertEqual(cache.get('%s.title' % self.get_cache_prefix('WithCacheSubdomains', path, 'ru', 'spb')), None)
+        prefix = self.get_cache_prefix('WithCacheSubdomains', path, 'ru', 'msk')
+        self.assertEqual(cache.get('%s.title' % prefix), '1234')
+        self.assertEqual(cache.get('%s.subtitle' % prefix), '')
 
     def test_use_cache_i18n_with_empty_subdomain(self):
         """
         Checks that the cache plays nicely with i18n and subdomain, but sudomain is None.
         """
-        if 'dummy' not in settings.CACHE_BACKEND:
-            path = '/'
-            hexpath = hashlib.md5(iri_to_uri(path)).hexdigest()
+        cache.clear()
+        path = '/'
+        six.text_type(seo_get_metadata(path, name='WithCacheSubdomains', language='ru', subdomain=None))
 
-            six.text_type(seo_get_metadata(path, name='WithSubdomains', language='ru', subdomain=None))
+        prefix = self.get_cache_prefix('WithCacheSubdomains', path, 'ru')
+        self.assertEqual(cache.get('%s.title' % prefix), '1234')
+        self.assertEqual(cache.get('%s.subtitle' % prefix), '')
+        self.assertEqual(cache.get('%s.title' % self.get_cache_prefix('WithCacheSubdomains', path, 'ru', '')), None)
 
-            self.assertEqual(cache.get('djangoseo.Coverage.%s.de.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithCacheI18n.%s.en.title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru.title' % hexpath), '1234')
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru.subtitle' % hexpath), '')
+        six.text_type(seo_get_metadata(path, name='WithCacheSubdomains', language='ru', subdomain=''))
 
-            six.text_type(seo_get_metadata(path, name='WithSubdomains', language='ru', subdomain=''))
+        prefix = self.get_cache_prefix('WithCacheSubdomains', path, 'ru', '')
+        self.assertEqual(cache.get('%s.title' % prefix), '1234')
+        self.assertEqual(cache.get('%s.subtitle' % prefix), '')
 
-            self.assertEqual(cache.get('djangoseo.Coverage.%s.de..title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithCacheI18n.%s.en..title' % hexpath), None)
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru..title' % hexpath), '1234')
-            self.assertEqual(cache.get('djangoseo.WithSubdomains.%s.ru..subtitle' % hexpath), '')
+    def test_use_cache_bundle(self):
+        """ Checks that the bundled cache stores all values in a single entry.
+        """
+        cache.clear()
+        path = '/bundle/'
+        WithCacheBundle._meta.get_model('path').objects.create(_path=path, subtitle='Sub', raw='<b>Raw</b>')
+        prefix = self.get_cache_prefix('WithCacheBundle', path)
+
+        metadata = seo_get_metadata(path, name='WithCacheBundle')
+        head = six.text_type(metadata)
+        self.assertEqual(head, '<title>1234</title>\n<subtitle>Sub</subtitle>')
+
+        bundle = cache.get('%s.__bundle__' % prefix)
+        self.assertEqual(bundle['title'], '1234')
+        self.assertEqual(bundle['subtitle'], 'Sub')
+        self.assertEqual(bundle['extra'], '<subtitle>Sub</subtitle>\n<b>Raw</b>')
+        self.assertEqual(cache.get('%s.title' % prefix), None)
+
+        with self.assertNumQueries(0):
+            metadata = seo_get_metadata(path, name='WithCacheBundle')
+            self.assertEqual(metadata.subtitle.value, 'Sub')
+            self.assertEqual(metadata.extra, '<subtitle>Sub</subtitle>\n<b>Raw</b>')
+            self.assertEqual(six.text_type(metadata), head)
+
+    def test_use_cache_bundle_partial(self):
+        """ Checks that per-field cache entries are reused when the bundle is missing.
+        """
+        cache.clear()
+        path = '/bundle/'
+        prefix = self.get_cache_prefix('WithCacheBundle', path)
+        cache.set('%s.subtitle' % prefix, 'Cached subtitle')
+
+        metadata = seo_get_metadata(path, name='WithCacheBundle')
+        self.assertEqual(metadata.subtitle.value, 'Cached subtitle')
+        self.assertEqual(metadata.title.value, '1234')
+        self.assertEqual(cache.get('%s.__bundle__' % prefix)['subtitle'], 'Cached subtitle')
+
+    def test_cache_invalidation(self):
+        """ Checks that saving or deleting metadata invalidates cached values.
+        """
+        cache.clear()
+        path = '/invalidation/'
+        self.assertEqual(seo_get_metadata(path, name='WithCache').subtitle.value, None)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            path_metadata = WithCache._meta.get_model('path').objects.create(_path=path, subtitle='Path subtitle')
+        self.assertEqual(seo_get_metadata(path, name='WithCache').subtitle.value, 'Path subtitle')
+
+        path_metadata.subtitle = 'New subtitle'
+        with self.captureOnCommitCallbacks(execute=True):
+            path_metadata.save()
+        self.assertEqual(seo_get_metadata(path, name='WithCache').subtitle.value, 'New subtitle')
+
+        # Moving the metadata to another path invalidates both paths
+        path_metadata._path = '/moved/'
+        with self.captureOnCommitCallbacks(execute=True):
+            path_metadata.save()
+        self.assertEqual(seo_get_metadata(path, name='WithCache').subtitle.value, None)
+        self.assertEqual(seo_get_metadata('/moved/', name='WithCache').subtitle.value, 'New subtitle')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            path_metadata.delete()
+        self.assertEqual(seo_get_metadata('/moved/', name='WithCache').subtitle.value, None)
+
+        # View metadata can affect any path
+        with self.captureOnCommitCallbacks(execute=True):
+            view_metadata = WithCache._meta.get_model('view').objects.create(_view='userapp_my_view',
+                                                                             subtitle='View subtitle')
+        self.assertEqual(seo_get_metadata('/my/view/text/', name='WithCache').subtitle.value, 'View subtitle')
+        view_metadata.subtitle = 'New view subtitle'
+        with self.captureOnCommitCallbacks(execute=True):
+            view_metadata.save()
+        self.assertEqual(seo_get_metadata('/my/view/text/', name='WithCache').subtitle.value, 'New view subtitle')
+
+    def test_cache_invalidation_on_commit(self):
+        """ Checks that cached values are only invalidated once the change is committed,
+            so that other requests cannot cache the old values again in the meantime.
+        """
+        cache.clear()
+        path = '/invalidation/'
+        scopes = [global_scope('WithCache'), path_scope('WithCache', path)]
+        generations = get_generations(scopes)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                WithCache._meta.get_model('path').objects.create(_path=path, subtitle='Path subtitle')
+                self.assertEqual(get_generations(scopes), generations)
+            self.assertEqual(get_generations(scopes), generations)
+        self.assertEqual(len(callbacks), 1)
+
+        callbacks[0]()
+        self.assertNotEqual(get_generations(scopes)[1], generations[1])
+        self.assertEqual(seo_get_metadata(path, name='WithCache').subtitle.value, 'Path subtitle')
+
+    def test_cache_empty_path(self):
+        """ Checks that paths without any metadata are remembered in the cache.
+        """
+        cache.clear()
+        path = '/empty/'
+        self.assertEqual(seo_get_metadata(path, name='WithCache').title.value, '1234')
+
+        # Nothing needs to be looked up for fields that are not cached yet
+        with self.assertNumQueries(0):
+            self.assertEqual(seo_get_metadata(path, name='WithCache').subtitle.value, None)
+
+        # Creating metadata for the path removes the marker
+        with self.captureOnCommitCallbacks(execute=True):
+            WithCache._meta.get_model('path').objects.create(_path=path, title='Path title')
+        self.assertEqual(seo_get_metadata(path, name='WithCache').title.value, 'Path title')
+
+    def test_local_cache(self):
+        """ Checks that the local cache is used in front of the django cache.
+        """
+        cache.clear()
+        WithLocalCache._meta.cache.local.clear()
+        path = '/local/'
+        WithLocalCache._meta.get_model('path').objects.create(_path=path, subtitle='Path subtitle')
+        self.assertEqual(seo_get_metadata(path, name='WithLocalCache').subtitle.value, 'Path subtitle')
+
+        # Values are still available once they have gone from the django cache
+        cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(seo_get_metadata(path, name='WithLocalCache').subtitle.value, 'Path subtitle')
+
+        # Changes made in this process are seen as soon as they are committed
+        with self.captureOnCommitCallbacks(execute=True):
+            WithLocalCache._meta.get_model('path').objects.filter(_path=path).get().delete()
+        self.assertEqual(seo_get_metadata(path, name='WithLocalCache').subtitle.value, None)
+
+    def test_local_cache_remote_invalidation(self):
+        """ Checks that changes from other processes are seen once the local counters expire.
+        """
+        cache.clear()
+        WithLocalCache._meta.cache.local.clear()
+        path = '/local/'
+        self.assertEqual(seo_get_metadata(path, name='WithLocalCache').subtitle.value, None)
+
+        # Simulate another process changing the metadata
+        WithLocalCache._meta.get_model('path').objects.bulk_create([
+            WithLocalCache._meta.get_model('path')(_path=path, subtitle='Path subtitle')])
+        bump_generations([path_scope('WithLocalCache', path)])
+        self.assertEqual(seo_get_metadata(path, name='WithLocalCache').subtitle.value, None)
+
+        with mock.patch('djangoseo.cache.time.time', return_value=time.time() + 61):
+            self.assertEqual(seo_get_metadata(path, name='WithLocalCache').subtitle.value, 'Path subtitle')
+
+    def test_local_cache_size(self):
+        local_cache = LocalCache(2, 10)
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+        local_cache.get('a')
+        local_cache.set('c', 3)
+        self.assertEqual(local_cache.get('a'), 1)
+        self.assertEqual(local_cache.get('b'), None)
+        self.assertEqual(local_cache.get('c'), 3)
+
+    def test_store_rendered(self):
+        """ Cleaned and rendered values are stored with the instance. """
+        PathMetadata = WithStoredRendered._meta.get_model('path')
+        md = PathMetadata.objects.create(_path='/stored/', title='Stored & <b>bold</b>',
+                                         description='Line one\nline two', raw='text <meta name="a" content="b" />')
+        md = PathMetadata.objects.get(pk=md.pk)
+        self.assertEqual(md._get_rendered('title').html, '<title>Stored &amp; <b>bold</b></title>')
+
+        elements = WithStoredRendered._meta.elements
+        with mock.patch.object(elements['title'], 'clean') as clean_title, \
+                mock.patch.object(elements['description'], 'clean') as clean_description:
+            metadata = seo_get_metadata('/stored/', name="WithStoredRendered")
+            self.assertEqual(metadata.title.value, 'Stored &amp; <b>bold</b>')
+            self.assertEqual(six.text_type(metadata.title), '<title>Stored &amp; <b>bold</b></title>')
+            self.assertEqual(six.text_type(metadata.description),
+                             '<meta name="description" content="Line one line two" />')
+            self.assertEqual(six.text_type(metadata.raw), '<meta name="a" content="b" />')
+        self.assertFalse(clean_title.called)
+        self.assertFalse(clean_description.called)
+
+    def test_store_rendered_fallback(self):
+        """ Templated, default and changed values are still rendered when they are displayed. """
+        PathMetadata = WithStoredRendered._meta.get_model('path')
+        md = PathMetadata.objects.create(_path='/stored/', description='{{ 1 }} and 2')
+        self.assertEqual(json.loads(md._rendered), {})
+        metadata = seo_get_metadata('/stored/', name="WithStoredRendered")
+        self.assertEqual(six.text_type(metadata.title), '<title>example.com</title>')
+        self.assertEqual(six.text_type(metadata.description), '<meta name="description" content="1 and 2" />')
+
+        md.title = 'Saved'
+        md.save()
+        md.title = 'Not saved'
+        self.assertEqual(md._get_rendered('title'), None)
+        md.save(update_fields=['title'])
+        self.assertEqual(PathMetadata.objects.get(pk=md.pk)._get_rendered('title').html, '<title>Not saved</title>')
 
 
 class Templates(TestCase):
@@ -957,6 +1670,20 @@ class Templates(TestCase):
         self.compilesTo("{% get_metadata Coverage for obj %}", six.text_type(self.metadata))
         self.compilesTo("{% get_metadata Coverage for obj as var %}{{ var }}", six.text_type(self.metadata))
 
+    def test_request_memo(self):
+        """ Checks that metadata is only resolved once while rendering a request. """
+        self.deregister_alternatives()
+        single = Template('{% load seo %}{% get_metadata %}')
+        multiple = Template('{% load seo %}{% get_metadata %}{% get_metadata as var %}{{ var.title }}'
+                            '{% get_metadata as other %}{{ other.description }}')
+        with CaptureQueriesContext(connection) as queries:
+            single.render(RequestContext(RequestFactory().get(self.path)))
+        output = multiple.render(RequestContext(RequestFactory().get(self.path)))
+        self.assertIn(six.text_type(self.metadata.title), output)
+        self.assertIn(six.text_type(self.metadata.description), output)
+        with self.assertNumQueries(len(queries)):
+            multiple.render(RequestContext(RequestFactory().get(self.path)))
+
     def test_variable_group(self):
         self.deregister_alternatives()
         self.compilesTo("{% get_metadata as var %}{{ var.advanced }}", six.text_type(self.metadata.raw1))
@@ -1237,8 +1964,155 @@ class ImportTrackedModels(TestCase):
         self.assertNotIn(Category, tracked_models)
 
 
+class ViewNames(TestCase):
+    """ Checks the resolution of paths to view names. """
+
+    def test_resolve_to_name(self):
+        self.assertEqual(resolve_to_name('/pages/abc/'), 'userapp_page_detail')
+        self.assertEqual(resolve_to_name('/my/view/abc/'), 'userapp_my_view')
+        self.assertEqual(resolve_to_name('/my/other/view/abc/'), 'userapp_my_other_view')
+        self.assertEqual(resolve_to_name('/products/abc/'), None)
+        self.assertEqual(resolve_to_name('/nothing/here/'), None)
+        # Cached results are the same
+        self.assertEqual(resolve_to_name('/pages/abc/'), 'userapp_page_detail')
+        self.assertEqual(resolve_to_name('/products/abc/'), None)
+
+    def test_static_prefix(self):
+        index = ViewNameIndex(get_resolver())
+        for prefix in ('/my/view/', '/pages/', '/products/', '/admin/'):
+            self.assertIn(prefix, index.prefixes)
+        self.assertEqual(index.prefixes['/tags/'], [len(index.entries) - 3])
+
+    def test_request(self):
+        request = RequestFactory().get('/pages/abc/')
+        request.resolver_match = resolve('/my/view/abc/')
+        self.assertEqual(resolve_to_name('/pages/abc/', request=request), 'userapp_my_view')
+        # The request is only used for its own path
+        self.assertEqual(resolve_to_name('/pages/def/', request=request), 'userapp_page_detail')
+
+    def test_urlconf_changes(self):
+        self.assertEqual(resolve_to_name('/admin/'), 'index')
+        with override_settings(ROOT_URLCONF='tests.userapp.urls'):
+            self.assertEqual(resolve_to_name('/admin/'), None)
+            self.assertEqual(resolve_to_name('/pages/abc/'), 'userapp_page_detail')
+        self.assertEqual(resolve_to_name('/admin/'), 'index')
+
+
+class Sitemaps(TestCase):
+    """ Checks the sitemap of paths with metadata. """
+
+    def setUp(self):
+        self.pages = [Page.objects.create(type="sitemap-%d" % i) for i in range(3)]
+        PathMetadata = Coverage._meta.get_model('path')
+        PathMetadata.objects.create(_path=self.pages[0].get_absolute_url(), title="Duplicate path")
+        PathMetadata.objects.create(_path='/a&b/', title="Path only")
+        self.paths = sorted([page.get_absolute_url() for page in self.pages] + ['/a&b/'])
+
+    def test_items(self):
+        sitemap = MetadataSitemap(name="Coverage")
+        self.assertEqual(list(sitemap.items()), self.paths)
+        self.assertEqual(sitemap.paginator.count, 4)
+        self.assertEqual([url['location'] for url in sitemap.get_urls(page=1)],
+                         ['http://example.com%s' % path for path in self.paths])
+
+        sitemap = MetadataSitemap(name="Coverage", backends=('path',))
+        self.assertEqual(list(sitemap.items()), sorted([self.pages[0].get_absolute_url(), '/a&b/']))
+
+    def test_write_sitemaps(self):
+        Site.objects.create(domain="example.org", name="example.org")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        call_command('write_sitemaps', directory, name="Coverage", limit=3, domain="example.org",
+                     stdout=six.StringIO())
+
+        self.assertEqual(sorted(os.listdir(directory)), ['sitemap-1.xml.gz', 'sitemap-2.xml.gz', 'sitemap.xml'])
+        with open(os.path.join(directory, 'sitemap.xml')) as index:
+            self.assertEqual(index.read().count('<loc>https://example.org/sitemap-'), 2)
+        locations = []
+        for filename in ('sitemap-1.xml.gz', 'sitemap-2.xml.gz'):
+            with gzip.open(os.path.join(directory, filename), 'rt') as sitemap:
+                locations.append(re.findall('<loc>(.*?)</loc>', sitemap.read()))
+        self.assertEqual([len(found) for found in locations], [3, 1])
+        self.assertEqual(locations[0][0], 'https://example.org/a&amp;b/')
+
+    def test_write_sitemaps_domain(self):
+        """ Checks that only the paths of the site with the given domain are listed. """
+        site = Site.objects.get_current()
+        other_site = Site.objects.create(domain="example.org", name="example.org")
+        PathMetadata = WithSites._meta.get_model('path')
+        PathMetadata.objects.create(_path='/current/', _site=site, title="Current site")
+        PathMetadata.objects.create(_path='/other/', _site=other_site, title="Other site")
+        PathMetadata.objects.create(_path='/all/', title="All sites")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        call_command('write_sitemaps', directory, name="WithSites", backends='path', domain="example.org",
+                     stdout=six.StringIO())
+        with gzip.open(os.path.join(directory, 'sitemap-1.xml.gz'), 'rt') as sitemap:
+            self.assertEqual(re.findall('<loc>(.*?)</loc>', sitemap.read()),
+                             ['https://example.org/all/', 'https://example.org/other/'])
+
+        with self.assertRaises(CommandError):
+            call_command('write_sitemaps', directory, name="WithSites", domain="example.net", stdout=six.StringIO())
+
+
 class RedirectsMiddlewareTest(TestCase):
 
+    def tearDown(self):
+        # Rows are rolled back without any signal, forget what was loaded from them
+        site_id = Site.objects.get_current().id
+        redirect_cache.bump_generations([redirect_scope(site_id), redirect_pattern_scope(site_id)])
+
+    def test_pattern_matcher(self):
+        patterns = [
+            {'url_pattern': r'/news/(\d+)/', 'redirect_path': '/news/'},
+            {'url_pattern': r'/news/(?P<slug>[\w-]+)/', 'redirect_path': '/slug/'},
+            {'url_pattern': r'/(?:blog|news)/', 'redirect_path': '/blog/'},
+        ]
+        matcher = PatternMatcher(patterns)
+        self.assertEqual([combined for regex, index, combined in matcher.chunks], [True])
+        self.assertEqual(matcher.match('/news/12/')['redirect_path'], '/news/')
+        self.assertEqual(matcher.match('/news/foo/')['redirect_path'], '/slug/')
+        self.assertEqual(matcher.match('/news/')['redirect_path'], '/blog/')
+        self.assertEqual(matcher.match('/blog/1/')['redirect_path'], '/blog/')
+        self.assertIsNone(matcher.match('/other/news/1/'))
+        self.assertIsNone(PatternMatcher([]).match('/news/'))
+
+        # Patterns that cannot be combined are matched one after another
+        for extra in (r'/(?P<slug>x)/', r'/(a)\1/', r'/[/'):
+            matcher = PatternMatcher(patterns + [{'url_pattern': extra, 'redirect_path': '/extra/'}])
+            self.assertFalse([combined for regex, index, combined in matcher.chunks if combined])
+            self.assertEqual(matcher.match('/news/foo/')['redirect_path'], '/slug/')
+
+        # Patterns are combined in chunks
+        many = [{'url_pattern': r'/page-%d/(\d+)/' % i, 'redirect_path': '/%d/' % i} for i in range(60)]
+        many[30:30] = [{'url_pattern': r'/(?P<slug>x)/', 'redirect_path': '/x/'},
+                       {'url_pattern': r'/(?P<slug>y)/', 'redirect_path': '/y/'}]
+        matcher = PatternMatcher(many)
+        self.assertEqual(len(matcher.chunks), 1 + 25 + 1)
+        paths = ['/page-%d/1/' % i for i in range(60)]
+        paths[30:30] = ['/x/', '/y/']
+        for pattern, path in zip(many, paths):
+            self.assertIs(matcher.match(path), pattern)
+        self.assertEqual(PatternMatcher([{'url_pattern': r'/(a)\1/', 'redirect_path': '/a/'}]).match('/aa/'),
+                         {'url_pattern': r'/(a)\1/', 'redirect_path': '/a/'})
+
+    def test_pattern_matcher_cached(self):
+        current_site = Site.objects.get_current()
+        product_path = reverse('userapp_product_detail', args=('1',))
+        self.assertEqual(self.client.get(product_path).status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            RedirectPattern.objects.create(url_pattern='/products/1/', redirect_path='/cached/', site=current_site)
+        self.assertEqual(self.client.get(product_path).status_code, 301)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('userapp_product_detail', args=('2',))).status_code, 404)
+        self.assertFalse([q for q in queries.captured_queries if RedirectPattern._meta.db_table in q['sql']])
+
+        # Changes are picked up
+        with self.captureOnCommitCallbacks(execute=True):
+            RedirectPattern.objects.create(url_pattern='/products/', redirect_path='/cached/', site=current_site)
+        self.assertEqual(self.client.get(reverse('userapp_product_detail', args=('2',))).status_code, 301)
+
     def test_create_redirect(self):
         middleware = RedirectsMiddleware()
         request_factory = RequestFactory()
@@ -1250,17 +2124,18 @@ class RedirectsMiddlewareTest(TestCase):
 
         current_site = Site.objects.get_current()
         redirect_path = reverse('userapp_page_detail', args=('product',))
-        redirect_pattern1 = RedirectPattern.objects.create(
-            url_pattern='/products/(\d+)/',
-            redirect_path=redirect_path,
-            site=current_site
-        )
-        redirect_pattern2 = RedirectPattern.objects.create(
-            url_pattern='/products/(\d+)/',
-            redirect_path=redirect_path,
-            site=current_site,
-            all_subdomains=True,
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            redirect_pattern1 = RedirectPattern.objects.create(
+                url_pattern='/products/(\d+)/',
+                redirect_path=redirect_path,
+                site=current_site
+            )
+            redirect_pattern2 = RedirectPattern.objects.create(
+                url_pattern='/products/(\d+)/',
+                redirect_path=redirect_path,
+                site=current_site,
+                all_subdomains=True,
+            )
 
         # main scenario
         response = self.client.get(product_path)
@@ -1273,9 +2148,10 @@ class RedirectsMiddlewareTest(TestCase):
         self.assertEqual(redirect.all_subdomains, redirect_pattern1.all_subdomains)
 
         # with subdomain
-        redirect.delete()
         redirect_pattern1.subdomain = 'msk'
-        redirect_pattern1.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            redirect.delete()
+            redirect_pattern1.save()
         request = request_factory.get(product_path)
         request.subdomain = 'msk'
         try:
@@ -1288,15 +2164,17 @@ class RedirectsMiddlewareTest(TestCase):
         self.assertEqual(redirect.all_subdomains, redirect_pattern1.all_subdomains)
 
         # all subdomain flag
-        Redirect.objects.first().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            Redirect.objects.first().delete()
         response = self.client.get(product_path)
         self.assertEqual(response.status_code, 301)
         self.assertEqual(Redirect.objects.count(), 1)
         redirect = Redirect.objects.first()
         self.assertEqual(redirect.subdomain, redirect_pattern2.subdomain)
         self.assertEqual(redirect.all_subdomains, redirect_pattern2.all_subdomains)
-        redirect_pattern2.delete()
-        redirect.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            redirect_pattern2.delete()
+            redirect.delete()
 
         # with another site
         another_site = Site.objects.create(
@@ -1304,7 +2182,8 @@ class RedirectsMiddlewareTest(TestCase):
             name='example.net'
         )
         redirect_pattern1.site = another_site
-        redirect_pattern1.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            redirect_pattern1.save()
         response = self.client.get(product_path)
         self.assertEqual(response.status_code, 404)
         self.assertEqual(Redirect.objects.count(), 0)
@@ -1380,6 +2259,184 @@ class RedirectsMiddlewareTest(TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(Redirect.objects.count(), 0)
 
+    def test_redirect_path_hash(self):
+        """ Redirects can be looked up by the hash of their path. """
+        site = Site.objects.get_current()
+        path = '/long/%s/' % ('x' * 1000)
+        redirect = HashedRedirect.objects.create(site=site, old_path=path, new_path='/new/')
+        self.assertEqual(redirect.old_path_hash, path_hash(path))
+        self.assertEqual(redirect_lookup(path, HashedRedirect), {'old_path': path, 'old_path_hash': path_hash(path)})
+        self.assertEqual(HashedRedirect.objects.get(**redirect_lookup(path, HashedRedirect)), redirect)
+        self.assertEqual(HashedRedirect._meta.unique_together, (('site', 'old_path_hash', 'old_path'),))
+        self.assertFalse(HashedRedirect._meta.get_field('old_path').db_index)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                HashedRedirect.objects.create(site=site, old_path=path, new_path='/other/')
+
+        # Paths with the same hash are stored and found apart
+        with mock.patch('djangoseo.models.path_hash', return_value=42), \
+                mock.patch('djangoseo.utils.path_hash', return_value=42):
+            HashedRedirect.objects.create(site=site, old_path='/one/', new_path='/1/')
+            HashedRedirect.objects.create(site=site, old_path='/two/', new_path='/2/')
+            self.assertEqual(HashedRedirect.objects.get(**redirect_lookup('/two/', HashedRedirect)).new_path, '/2/')
+
+        # Redirects stored before hashes were used are filled in
+        HashedRedirect.objects.bulk_create([HashedRedirect(site=site, old_path='/a/', new_path='/b/'),
+                                            HashedRedirect(site=site, old_path='/c/', new_path='/d/')])
+        self.assertEqual(backfill_redirect_hashes(batch_size=1, model=HashedRedirect), 2)
+        self.assertEqual(HashedRedirect.objects.get(**redirect_lookup('/c/', HashedRedirect)).new_path, '/d/')
+        self.assertFalse(HashedRedirect.objects.filter(old_path_hash__isnull=True).exists())
+        self.assertEqual(backfill_redirect_hashes(model=HashedRedirect), 0)
+
+    @override_settings(SEO_REDIRECT_PATH_HASH=True)
+    def test_redirect_path_hash_setting(self):
+        """ Whether hashes are used is decided when the model is created, not on each lookup. """
+        self.assertFalse(Redirect.use_path_hash)
+        self.assertEqual(redirect_lookup('/old/'), {'old_path': '/old/'})
+        Redirect.objects.create(site=Site.objects.get_current(), old_path='/old/', new_path='/new/')
+        response = self.client.get('/old/')
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'], '/new/')
+
+        # Only the hash of the target is filled in
+        Redirect.objects.bulk_create([Redirect(site=Site.objects.get_current(), old_path='/a/', new_path='/b/')])
+        stdout = six.StringIO()
+        call_command('backfill_redirect_hashes', stdout=stdout)
+        self.assertIn('Filled in the path hashes of 1 redirects.', stdout.getvalue())
+        self.assertEqual(Redirect.objects.get(old_path='/a/').new_path_hash, path_hash('/b/'))
+
+    @override_settings(SEO_REDIRECT_INDEX=True)
+    def test_redirect_index(self):
+        current_site = Site.objects.get_current()
+        redirect = Redirect.objects.create(site=current_site, old_path='/old/', new_path='/new/', all_subdomains=True)
+        Redirect.objects.create(site=current_site, old_path='/gone/', new_path='')
+        self.client.get('/old/')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/old/')
+            self.assertEqual(response.status_code, 301)
+            self.assertEqual(response['Location'], '/new/')
+            self.assertEqual(self.client.get('/old').status_code, 301)
+            self.assertEqual(self.client.get('/gone/').status_code, 410)
+            self.assertEqual(self.client.get('/missing/').status_code, 404)
+        self.assertFalse([q for q in queries.captured_queries if Redirect._meta.db_table in q['sql']])
+
+        # Changes are picked up
+        redirect.new_path = '/newer/'
+        with self.captureOnCommitCallbacks(execute=True):
+            redirect.save()
+        self.assertEqual(self.client.get('/old/')['Location'], '/newer/')
+
+        # Redirects for a single subdomain
+        with self.captureOnCommitCallbacks(execute=True):
+            Redirect.objects.create(site=current_site, old_path='/msk/', new_path='/moscow/', subdomain='msk')
+        middleware = RedirectFallbackMiddleware()
+        request = RequestFactory().get('/msk/')
+        request.subdomain = 'msk'
+        response = middleware.process_response(request, HttpResponseNotFound())
+        self.assertEqual(response['Location'], '/moscow/')
+        request.subdomain = 'spb'
+        response = middleware.process_response(request, HttpResponseNotFound())
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(SEO_REDIRECT_INDEX=True)
+    def test_redirect_invalidation_on_commit(self):
+        """ Redirects and patterns are only loaded again once a change is committed, so that
+            other processes cannot load the old rows under the new generation.
+        """
+        current_site = Site.objects.get_current()
+        scopes = [redirect_scope(current_site.id), redirect_pattern_scope(current_site.id)]
+        generations = get_generations(scopes)
+        self.assertEqual(self.client.get('/old/').status_code, 404)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                Redirect.objects.create(site=current_site, old_path='/old/', new_path='/new/', all_subdomains=True)
+                RedirectPattern.objects.create(url_pattern='/products/', redirect_path='/new/', site=current_site)
+            self.assertEqual(get_generations(scopes), generations)
+            self.assertEqual(self.client.get('/old/').status_code, 404)
+        self.assertEqual(len(callbacks), 2)
+
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(get_generations(scopes)[0], generations[0])
+        self.assertNotEqual(get_generations(scopes)[1], generations[1])
+        self.assertEqual(self.client.get('/old/').status_code, 301)
+
+    @override_settings(SEO_REDIRECT_BLOOM_FILTER=True)
+    def test_bloom_filter(self):
+        current_site = Site.objects.get_current()
+        Redirect.objects.create(site=current_site, old_path='/old/', new_path='/new/', all_subdomains=True)
+
+        def redirect_queries(path):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path)
+            return response.status_code, len([q for q in queries.captured_queries
+                                              if Redirect._meta.db_table in q['sql']])
+
+        # The redirects are queried while the filter is being built
+        with mock.patch('djangoseo.redirects._build_bloom_filter_in_background') as build:
+            self.assertEqual(redirect_queries('/junk'), (404, 2))
+            build.assert_called_once_with(current_site.id)
+
+        with mock.patch('djangoseo.redirects._build_bloom_filter_in_background', side_effect=build_bloom_filter):
+            self.assertEqual(redirect_queries('/junk/')[0], 404)
+            self.assertEqual(redirect_queries('/junk/'), (404, 0))
+            self.assertEqual(redirect_queries('/old/'), (301, 1))
+            self.assertEqual(redirect_queries('/old'), (301, 2))
+
+            # The filter is built again when a redirect is added
+            with self.captureOnCommitCallbacks(execute=True):
+                Redirect.objects.create(site=current_site, old_path='/added/', new_path='/new/', all_subdomains=True)
+            self.assertEqual(redirect_queries('/added/')[0], 301)
+            self.assertEqual(redirect_queries('/junk/'), (404, 0))
+
+    @override_settings(SEO_REDIRECT_BLOOM_FILTER=True)
+    def test_bloom_filter_not_stored(self):
+        current_site = Site.objects.get_current()
+        Redirect.objects.create(site=current_site, old_path='/old/', new_path='/new/', all_subdomains=True)
+        lock_key = BLOOM_FILTER_LOCK_KEY % current_site.id
+        cache.delete(lock_key)
+        _bloom_filters.clear()
+
+        cache_set = cache.set
+
+        def run_now(target, name):
+            return mock.Mock(start=target)
+
+        def drop_filter(key, *args):
+            # As memcached does with values over its item size limit
+            if key != BLOOM_FILTER_KEY % current_site.id:
+                cache_set(key, *args)
+
+        with mock.patch('djangoseo.redirects.threading.Thread', side_effect=run_now) as thread, \
+                mock.patch('djangoseo.redirects.connection.close'), \
+                mock.patch('djangoseo.redirects.cache.set', side_effect=drop_filter):
+            self.assertEqual(self.client.get('/junk/').status_code, 404)
+            self.assertEqual(thread.call_count, 1)
+            self.assertIsNone(cache.get(BLOOM_FILTER_KEY % current_site.id))
+
+            # The filter built by this process is still used
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get('/junk/').status_code, 404)
+            self.assertFalse([q for q in queries.captured_queries if Redirect._meta.db_table in q['sql']])
+
+            # The lock is kept, so the other processes do not build the filter again on every request
+            self.assertTrue(cache.get(lock_key))
+            _bloom_filters.clear()
+            self.assertEqual(self.client.get('/junk/').status_code, 404)
+            self.assertEqual(thread.call_count, 1)
+        cache.delete(lock_key)
+
+    def test_bloom_filter_error_rate(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add('/path/%d/' % i)
+        self.assertTrue(all('/path/%d/' % i in bloom_filter for i in range(1000)))
+        false_positives = sum('/other/%d/' % i in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 200)
+        self.assertEqual(bloom_filter_keys('/a/?b=1'), ['/a/?b=1', '/a?b=1'])
+        self.assertEqual(bloom_filter_keys('/'), ['/'])
+
 
 class RedirectsFromModelsTest(TestCase):
 
@@ -1395,3 +2452,232 @@ class RedirectsFromModelsTest(TestCase):
         self.assertTrue(redirect.old_path == reverse('userapp_page_detail', args=['asd']))
         self.assertTrue(redirect.new_path == reverse('userapp_page_detail', args=['dsa']))
         self.assertTrue(redirect.site == Site.objects.get_current())
+
+    def test_redirect_chains(self):
+        """ Redirects to an old URL are pointed at the new one. """
+        paths = dict((slug, reverse('userapp_page_detail', args=[slug])) for slug in ('asd', 'dsa', 'xyz'))
+        for slug in ('dsa', 'xyz'):
+            self.page.type = slug
+            self.page.save()
+        self.assertEqual(dict(Redirect.objects.values_list('old_path', 'new_path')),
+                         {paths['asd']: paths['xyz'], paths['dsa']: paths['xyz']})
+
+        # Back to the first URL, which must not redirect anymore
+        self.page.type = 'asd'
+        self.page.save()
+        self.assertEqual(dict(Redirect.objects.values_list('old_path', 'new_path')),
+                         {paths['dsa']: paths['asd'], paths['xyz']: paths['asd']})
+
+    def test_redirect_target_hash(self):
+        """ Redirects are found by their target through the index on its hash. """
+        self.assertFalse(Redirect._meta.get_field('new_path').db_index)
+        self.assertTrue(Redirect._meta.get_field('new_path_hash').db_index)
+        self.assertFalse(HashedRedirect._meta.get_field('new_path').db_index)
+        self.assertTrue(HashedRedirect._meta.get_field('new_path_hash').db_index)
+        old_path = reverse('userapp_page_detail', args=['asd'])
+        new_path = reverse('userapp_page_detail', args=['dsa'])
+
+        self.page.type = 'dsa'
+        with CaptureQueriesContext(connection) as queries:
+            self.page.save()
+        redirect = Redirect.objects.get(old_path=old_path)
+        self.assertEqual(redirect.new_path_hash, path_hash(new_path))
+        self.assertEqual(Redirect.objects.get(redirect_target_filter(new_path)), redirect)
+        lookups = [q['sql'] for q in queries.captured_queries if q['sql'].startswith(('UPDATE', 'DELETE'))
+                   and Redirect._meta.db_table in q['sql']]
+        self.assertTrue(lookups)
+        self.assertTrue(all('new_path_hash' in sql for sql in lookups))
+
+        # The hash follows the target when the redirect is pointed at a newer URL
+        self.page.type = 'xyz'
+        self.page.save()
+        redirect.refresh_from_db()
+        self.assertEqual(redirect.new_path_hash, path_hash(reverse('userapp_page_detail', args=['xyz'])))
+
+        # Redirects stored before the hash was added are found by their target alone
+        Redirect.objects.bulk_create([Redirect(site=Site.objects.get_current(), old_path='/legacy/',
+                                               new_path=reverse('userapp_page_detail', args=['xyz']))])
+        self.page.type = 'zyx'
+        self.page.save()
+        legacy = Redirect.objects.get(old_path='/legacy/')
+        self.assertEqual(legacy.new_path, reverse('userapp_page_detail', args=['zyx']))
+        self.assertEqual(legacy.new_path_hash, path_hash(legacy.new_path))
+
+    def test_flatten_redirects(self):
+        site = Site.objects.get_current()
+        redirects = [
+            ('/a/', '/b/', None, True), ('/b/', '/c/', None, True), ('/c/', '/d/', None, True),
+            ('/x/', '/y/', None, True), ('/y/', '/x/', None, True), ('/in/', '/x/', None, True),
+            # Chains only continue through redirects that apply to the same subdomains
+            ('/s1/', '/s2/', None, True), ('/s2/', '/s3/', 'msk', False), ('/m1/', '/s2/', 'msk', False),
+            ('/f/', 'https://example.net/b/', None, True), ('/g/', '/h/', None, True), ('/h/', '', None, True),
+        ]
+        Redirect.objects.bulk_create([
+            Redirect(site=site, old_path=old_path, new_path=new_path, subdomain=subdomain,
+                     all_subdomains=all_subdomains)
+            for old_path, new_path, subdomain, all_subdomains in redirects])
+        before = dict(Redirect.objects.values_list('old_path', 'new_path'))
+
+        stdout, stderr = six.StringIO(), six.StringIO()
+        call_command('flatten_redirects', dry_run=True, stdout=stdout, stderr=stderr)
+        self.assertIn('Would flatten 4 redirects on %s, found 1 cycles.' % site.domain, stdout.getvalue())
+        # Chains are followed across batches, and each cycle is reported once
+        stdout = six.StringIO()
+        call_command('flatten_redirects', dry_run=True, batch_size=1, stdout=stdout, stderr=stderr)
+        self.assertIn('Would flatten 4 redirects on %s, found 1 cycles.' % site.domain, stdout.getvalue())
+        self.assertEqual(dict(Redirect.objects.values_list('old_path', 'new_path')), before)
+
+        call_command('flatten_redirects', stdout=stdout, stderr=stderr)
+        self.assertIn('Redirect cycle on %s: /x/ -> /y/ -> /x/' % site.domain, stderr.getvalue())
+        after = dict(Redirect.objects.values_list('old_path', 'new_path'))
+        self.assertEqual(dict((path, after[path]) for path in after if after[path] != before[path]),
+                         {'/a/': '/d/', '/b/': '/d/', '/m1/': '/s3/', '/g/': ''})
+        self.assertEqual(Redirect.objects.get(old_path='/a/').new_path_hash, path_hash('/d/'))
+
+    def test_import_redirects(self):
+        site = Site.objects.get_current()
+        Redirect.objects.create(site=site, old_path='/existing/', new_path='/old/')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'redirects.csv')
+        with open(filename, 'w') as f:
+            f.write('old_path,new_path,subdomain,all_subdomains\n'
+                    '/a/,/b/,,true\n'
+                    'https://example.com/c/?q=1,https://example.net/,msk,no\n'
+                    '/existing/,/new/,,\n'
+                    '/a/,/ignored/,,\n'
+                    'no-slash,/b/,,\n'
+                    '/d/,javascript:alert(1),,\n'
+                    '/e/,/f/,,maybe\n'
+                    '/gone/,,,\n')
+
+        stdout, stderr = six.StringIO(), six.StringIO()
+        call_command('import_redirects', filename, dry_run=True, stdout=stdout, stderr=stderr)
+        self.assertIn('Dry run: 8 rows, 3 created, 0 updated, 1 skipped, 1 duplicates, 3 invalid.',
+                      stdout.getvalue())
+        self.assertEqual(Redirect.objects.count(), 1)
+        self.assertEqual(stderr.getvalue().count('\n'), 3)
+        self.assertIn('Line 6:', stderr.getvalue())
+
+        generation = get_generations([redirect_scope(site.id)])[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_redirects', filename, stdout=stdout, stderr=stderr)
+        self.assertNotEqual(get_generations([redirect_scope(site.id)])[0], generation)
+        self.assertEqual(sorted(Redirect.objects.values_list('old_path', 'new_path', 'subdomain', 'all_subdomains')), [
+            ('/a/', '/b/', '', True), ('/c/?q=1', 'https://example.net/', 'msk', False),
+            ('/existing/', '/old/', '', False), ('/gone/', '', '', False)])
+
+        # Importing the same file again changes nothing, unless existing redirects are updated
+        stdout = six.StringIO()
+        call_command('import_redirects', filename, stdout=stdout, stderr=stderr)
+        self.assertIn('0 created, 0 updated, 4 skipped', stdout.getvalue())
+        call_command('import_redirects', filename, on_conflict='update', batch_size=2, stdout=stdout, stderr=stderr)
+        self.assertEqual(Redirect.objects.get(old_path='/existing/').new_path, '/new/')
+        self.assertEqual(Redirect.objects.get(old_path='/a/').new_path, '/ignored/')
+        self.assertEqual(Redirect.objects.get(old_path='/a/').new_path_hash, path_hash('/ignored/'))
+        self.assertEqual(Redirect.objects.get(old_path='/c/?q=1').new_path_hash, path_hash('https://example.net/'))
+        self.assertEqual(Redirect.objects.count(), 4)
+        with self.assertRaises(CommandError):
+            call_command('import_redirects', filename, on_conflict='error', stdout=stdout, stderr=stderr)
+
+    def test_import_redirects_batches(self):
+        """ Redirects repeated across batches are found in the database: those written by this import
+            are handled as duplicates within a batch, those stored before are skipped or updated again.
+        """
+        site = Site.objects.get_current()
+        Redirect.objects.create(site=site, old_path='/existing/', new_path='/old/')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'redirects.csv')
+        with open(filename, 'w') as f:
+            f.write('old_path,new_path\n/a/,/b/\n/c/,/d/\n/a/,/e/\n/existing/,/new/\n/existing/,/newer/\n')
+
+        for on_conflict, summary in (('skip', '5 rows, 2 created, 0 updated, 2 skipped, 1 duplicates'),
+                                     ('update', '5 rows, 2 created, 2 updated, 0 skipped, 1 duplicates')):
+            stdout = six.StringIO()
+            call_command('import_redirects', filename, on_conflict=on_conflict, batch_size=1, dry_run=True,
+                         stdout=stdout)
+            self.assertIn('Dry run: ' + summary, stdout.getvalue())
+            self.assertEqual(Redirect.objects.count(), 1)
+
+        stdout = six.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_redirects', filename, on_conflict='update', batch_size=1, stdout=stdout)
+        self.assertIn('5 rows, 2 created, 2 updated, 0 skipped, 1 duplicates', stdout.getvalue())
+        self.assertEqual(dict(Redirect.objects.values_list('old_path', 'new_path')),
+                         {'/a/': '/e/', '/c/': '/d/', '/existing/': '/newer/'})
+
+        # A path repeated in a later batch is not mistaken for a stored redirect
+        Redirect.objects.exclude(old_path='/existing/').delete()
+        with open(filename, 'w') as f:
+            f.write('old_path,new_path\n/a/,/b/\n/a/,/c/\n')
+        stdout = six.StringIO()
+        call_command('import_redirects', filename, on_conflict='error', batch_size=1, stdout=stdout)
+        self.assertIn('2 rows, 1 created, 0 updated, 0 skipped, 1 duplicates', stdout.getvalue())
+
+    def test_import_redirects_counts(self):
+        """ Redirects created by others meanwhile are not counted, and batches written before an error are seen. """
+        site = Site.objects.get_current()
+        Redirect.objects.create(site=site, old_path='/existing/', new_path='/old/')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'redirects.csv')
+        with open(filename, 'w') as f:
+            f.write('old_path,new_path\n/a/,/b/\n/existing/,/new/\n')
+
+        # The stored redirect is not found by the first lookup, as if it had been created since
+        find_existing = ImportRedirects.find_existing
+        lookups = []
+
+        def find_existing_later(command, batch):
+            lookups.append(batch)
+            return {} if len(lookups) == 1 else find_existing(command, batch)
+
+        stdout = six.StringIO()
+        with mock.patch.object(ImportRedirects, 'find_existing', find_existing_later):
+            call_command('import_redirects', filename, stdout=stdout)
+        self.assertIn('2 rows, 1 created, 0 updated', stdout.getvalue())
+        self.assertEqual(Redirect.objects.get(old_path='/existing/').new_path, '/old/')
+
+        # The first batch is committed when the second one fails
+        Redirect.objects.filter(old_path='/a/').delete()
+        generation = get_generations([redirect_scope(site.id)])[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(CommandError):
+                call_command('import_redirects', filename, on_conflict='error', batch_size=1, stdout=stdout)
+        self.assertTrue(Redirect.objects.filter(old_path='/a/').exists())
+        self.assertNotEqual(get_generations([redirect_scope(site.id)])[0], generation)
+
+    def test_export_redirects(self):
+        site = Site.objects.get_current()
+        Redirect.objects.create(site=site, old_path='/a/', new_path='/b/', all_subdomains=True)
+        Redirect.objects.create(site=site, old_path='/c/?q=1', new_path='https://example.net/', subdomain='msk')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        for file_format in ('csv', 'jsonl'):
+            filename = os.path.join(directory, 'redirects.' + file_format)
+            with CaptureQueriesContext(connection) as queries:
+                call_command('export_redirects', filename, stdout=six.StringIO())
+            # Redirects are sorted by the site id, without joining the sites
+            self.assertFalse([q for q in queries.captured_queries
+                              if Redirect._meta.db_table in q['sql'] and 'django_site' in q['sql']])
+            with open(filename) as f:
+                exported = f.read()
+            if file_format == 'csv':
+                self.assertEqual(exported, 'site,old_path,new_path,subdomain,all_subdomains\n'
+                                           '%s,/a/,/b/,,true\n'
+                                           '%s,/c/?q=1,https://example.net/,msk,false\n' % (site.domain, site.domain))
+            else:
+                self.assertEqual([json.loads(line) for line in exported.splitlines()], [
+                    {'site': site.domain, 'old_path': '/a/', 'new_path': '/b/', 'subdomain': '',
+                     'all_subdomains': True},
+                    {'site': site.domain, 'old_path': '/c/?q=1', 'new_path': 'https://example.net/',
+                     'subdomain': 'msk', 'all_subdomains': False}])
+
+            # Exported redirects import back unchanged
+            before = sorted(Redirect.objects.values_list('site', 'old_path', 'new_path', 'subdomain', 'all_subdomains'))
+            Redirect.objects.all().delete()
+            call_command('import_redirects', filename, stdout=six.StringIO())
+            self.assertEqual(sorted(Redirect.objects.values_list(
+                'site', 'old_path', 'new_path', 'subdomain', 'all_subdomains')), before)